@@ -0,0 +1,42 @@
+"""
+Benchmark the JSON and npz formats of the API, on payload size and decode time
+
+Fetches the same image and measurement lists in both formats from a running server, and times turning each into
+the arrays used by the tools: for JSON, parsing then :py:func:`libtools.get_columns`, for npz, just reading the
+arrays.
+
+Usage: python bench_api_formats.py [base url, default http://127.0.0.1:8000/api/v1/] [max number of results]
+"""
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'tools')))
+import libtools
+import numpy as np
+import requests
+import json
+import timeit
+from io import BytesIO
+
+base_url = sys.argv[1] if len(sys.argv) > 1 else 'http://127.0.0.1:8000/api/v1/'
+limit = int(sys.argv[2]) if len(sys.argv) > 2 else 0   # 0 returns all the results
+
+
+def decode_json(content):
+    return libtools.get_columns(json.loads(content)['objects'])
+
+
+def decode_npz(content):
+    npz = np.load(BytesIO(content))
+    return dict((field, npz[field]) for field in npz.files)
+
+
+for resource in ('image', 'measurement'):
+    for name, decode in (('json', decode_json), ('npz', decode_npz)):
+        tic = timeit.default_timer()
+        r = requests.get(base_url + resource + '/', params={'format': name, 'limit': limit})
+        r.raise_for_status()
+        toc = timeit.default_timer()
+        decode_time = min(timeit.repeat(lambda: decode(r.content), number=1, repeat=3))
+        nresults = len(decode(r.content)['value' if resource == 'measurement' else 'time'])
+        print '%-12s %-5s %8i results %12i bytes   request %8.3f s   decode %8.3f s' % \
+              (resource, name, nresults, len(r.content), toc - tic, decode_time)
@@ -0,0 +1,79 @@
+"""
+Benchmark the bounding box search (toucan_db.spatial.filter_bbox) against the polygon containment search
+(point__within) it replaces
+
+Fills the database with synthetic points (by default 10 million) spread over the globe and over ten years, then
+prints the plans and timings of both searches, on their own and combined with time and deployment filters.
+
+The synthetic data is deleted at the end. Run this against an empty scratch database, not one holding real data:
+it stops if there are points in the database already.
+
+Usage: python bench_bbox.py [number of points]
+"""
+from os import environ
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+environ['DJANGO_SETTINGS_MODULE'] = 'toucan.settings'
+from django.contrib.gis.geos import Polygon
+from django.db import connection, transaction
+from toucan_db.models import *
+from toucan_db.spatial import filter_bbox
+import datetime
+import pytz
+
+npoints = int(sys.argv[1]) if len(sys.argv) > 1 else 10000000
+ndeployments = 50
+
+if Point.objects.exists():
+    sys.exit('There are points in the database already: run this against an empty database')
+
+cursor = connection.cursor()
+
+print 'Creating %i points' % npoints
+with transaction.atomic():
+    campaign = Campaign.objects.create(campaign='benchmark')
+    Deployment.objects.bulk_create([Deployment(site='site_%i' % i, pi='pi', campaign=campaign)
+                                    for i in range(ndeployments)])
+    first_deployment = Deployment.objects.filter(campaign=campaign).order_by('id')[0].id
+    cursor.execute("INSERT INTO toucan_db_point (matchup_id, point, time_is, pqc, mqc, land_dist_is, thetas_is, "
+                   "deployment_id) "
+                   "SELECT 'matchup_' || i, ST_SetSRID(ST_MakePoint(random() * 180 - 90, random() * 360 - 180), 4326), "
+                   "timestamp with time zone '2002-01-01 00:00:00+00' + random() * interval '3650 days', "
+                   "'P00000000', 'M000000000000000000', 0, 0, %s + i %% %s FROM generate_series(1, %s) i",
+                   [first_deployment, ndeployments, npoints])
+cursor.execute('ANALYZE toucan_db_point')
+
+# A 2 x 2 degree box, and a year
+lat_min, lon_min, lat_max, lon_max = 30, 10, 32, 12
+box = Polygon.from_bbox((lat_min, lon_min, lat_max, lon_max))
+box.srid = 4326
+start = datetime.datetime(2005, 1, 1, tzinfo=pytz.utc)
+end = datetime.datetime(2006, 1, 1, tzinfo=pytz.utc)
+sites = ['site_1', 'site_2', 'site_3']
+
+searches = [
+    ('box only', {}),
+    ('box and time', {'time_is__gte': start, 'time_is__lt': end}),
+    ('box, time and deployment', {'time_is__gte': start, 'time_is__lt': end, 'deployment__site__in': sites}),
+]
+
+
+def explain(title, queryset):
+    sql, params = queryset.query.sql_with_params()
+    cursor.execute('EXPLAIN ANALYZE ' + sql, params)
+    print '\n' + title
+    for row in cursor.fetchall():
+        print '    ' + row[0]
+
+
+for name, filters in searches:
+    points = Point.objects.filter(**filters)
+    explain('point__within, %s' % name, points.filter(point__within=box))
+    explain('filter_bbox, %s' % name, filter_bbox(points, lat_min, lon_min, lat_max, lon_max))
+
+# Tidy up
+with transaction.atomic():
+    cursor.execute('DELETE FROM toucan_db_point')
+    Deployment.objects.filter(campaign=campaign).delete()
+    campaign.delete()
@@ -0,0 +1,147 @@
+"""
+Benchmark the toucan_db indexes on the query patterns of the tools and the API
+
+Fills the database with a synthetic data set (by default 10 million measurements), then prints the plans and
+timings of the main queries, first without the indexes added to the models (composite indexes, unique natural
+keys and the point time index), then with them. The indexes are dropped inside a transaction which is rolled
+back, so the database keeps them.
+
+The synthetic data is deleted at the end. Run this against an empty scratch database (syncdb, then
+manage.py create_indexes), not one holding real data: it stops if there are points or images in the database
+already.
+
+Usage: python bench_indexes.py [number of measurements]
+"""
+from os import environ
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+environ['DJANGO_SETTINGS_MODULE'] = 'toucan.settings'
+from django.db import connection, transaction
+from django.db.models import get_models, get_app
+from toucan_db.models import *
+from toucan_db.indexes import POINT_TIME_INDEX, unique_statements, index_statements
+import datetime
+import pytz
+
+nmeasurements = int(sys.argv[1]) if len(sys.argv) > 1 else 10000000
+npoints = max(nmeasurements // 20, 1)
+nimages = max(nmeasurements // 100, 1)
+ninstruments, nregions, ntypes, nwavelengths, ndeployments = 10, 20, 30, 15, 50
+
+if Point.objects.exists() or Image.objects.exists():
+    sys.exit('There are points or images in the database already: run this against an empty database')
+
+cursor = connection.cursor()
+existing_wavelengths = list(MeasurementWavelength.objects.values_list('id', flat=True))
+
+# Synthetic data, generated in the database. The points are in time order, as they are when ingested.
+print 'Creating %i measurements, %i points and %i images' % (nmeasurements, npoints, nimages)
+with transaction.atomic():
+    cursor.execute("INSERT INTO toucan_db_instrument (name) SELECT 'instrument_' || i FROM generate_series(1, %s) i",
+                   [ninstruments])
+    cursor.execute("INSERT INTO toucan_db_imageregion (region) SELECT 'region_' || i FROM generate_series(1, %s) i",
+                   [nregions])
+    cursor.execute("INSERT INTO toucan_db_measurementtype (type, units, long_name) "
+                   "SELECT 'type_' || i || '_is', 'NA', 'type_' || i FROM generate_series(1, %s) i", [ntypes])
+    cursor.execute("INSERT INTO toucan_db_measurementwavelength (wavelength) "
+                   "SELECT 400 + 20 * i FROM generate_series(1, %s) i", [nwavelengths])
+    cursor.execute("INSERT INTO toucan_db_campaign (campaign) VALUES ('benchmark')")
+    cursor.execute("INSERT INTO toucan_db_deployment (site, pi, campaign_id) "
+                   "SELECT 'site_' || i, 'pi', (SELECT max(id) FROM toucan_db_campaign) FROM generate_series(1, %s) i",
+                   [ndeployments])
+    cursor.execute("INSERT INTO toucan_db_point (matchup_id, point, time_is, pqc, mqc, land_dist_is, thetas_is, "
+                   "deployment_id) "
+                   "SELECT 'matchup_' || i, ST_SetSRID(ST_MakePoint(random() * 180 - 90, random() * 360 - 180), 4326), "
+                   "timestamp with time zone '2002-01-01 00:00:00+00' + i * interval '10 minutes', "
+                   "'P00000000', 'M000000000000000000', 0, 0, "
+                   "(SELECT min(id) FROM toucan_db_deployment) + i %% %s FROM generate_series(1, %s) i",
+                   [ndeployments, npoints])
+    cursor.execute("INSERT INTO toucan_db_measurement (value, measurement_type_id, point_id, wavelength_id, "
+                   "instrument_id) "
+                   "SELECT random(), (SELECT min(id) FROM toucan_db_measurementtype) + i %% %s, "
+                   "(SELECT min(id) FROM toucan_db_point) + i / 20, "
+                   "(SELECT min(id) FROM toucan_db_measurementwavelength) + i %% %s, "
+                   "(SELECT min(id) FROM toucan_db_instrument) FROM generate_series(0, %s) i",
+                   [ntypes, nwavelengths, nmeasurements - 1])
+    cursor.execute("INSERT INTO toucan_db_image (web_location, archive_location, top_left_point, bot_right_point, "
+                   "time, instrument_id, measurement_type_id, region_id, \"SZA\", \"SAA\", \"VZA\", \"VAA\") "
+                   "SELECT '', 'image_' || i, ST_SetSRID(ST_MakePoint(0, 0), 4326), ST_SetSRID(ST_MakePoint(1, 1), 4326), "
+                   "timestamp with time zone '2002-01-01 00:00:00+00' + i * interval '1 hour', "
+                   "(SELECT min(id) FROM toucan_db_instrument) + i %% %s, "
+                   "(SELECT min(id) FROM toucan_db_measurementtype), "
+                   "(SELECT min(id) FROM toucan_db_imageregion) + i %% %s, 0, 0, 0, 0 FROM generate_series(1, %s) i",
+                   [ninstruments, nregions, nimages])
+for table in ('toucan_db_point', 'toucan_db_measurement', 'toucan_db_image'):
+    cursor.execute('ANALYZE ' + table)
+
+start = datetime.datetime(2003, 1, 1, tzinfo=pytz.utc)
+end = datetime.datetime(2003, 2, 1, tzinfo=pytz.utc)
+queries = [
+    ('Images of an instrument over a region (Querydb.get_images)',
+     Image.objects.filter(instrument__name='instrument_3', region__region='region_3',
+                          time__gte=start, time__lte=end).order_by('time')),
+    ('Measurements of a type and wavelength at a site (MeasurementResource)',
+     Measurement.objects.filter(measurement_type__type='type_4_is', point__deployment__site='site_7',
+                                wavelength__wavelength=500)),
+    ('Measurements of a type for the points in a time range (matchups)',
+     Measurement.objects.filter(point__time_is__gte=start, point__time_is__lt=start + datetime.timedelta(days=1),
+                                measurement_type__type='type_4_is')),
+    ('Points in a time range',
+     Point.objects.filter(time_is__gte=start, time_is__lt=end)),
+    ('Points in a bounding box',
+     Point.objects.filter(point__contained='POLYGON((0 0, 0 10, 10 10, 10 0, 0 0))')),
+]
+
+
+def explain(title, queryset):
+    sql, params = queryset.query.sql_with_params()
+    cursor.execute('EXPLAIN ANALYZE ' + sql, params)
+    print '\n' + title
+    for row in cursor.fetchall():
+        print '    ' + row[0]
+
+
+def tuned_indexes():
+    """The indexes and constraints added for the query patterns: (drop statement, name)"""
+    drops = [('DROP INDEX "{0}"'.format(POINT_TIME_INDEX), POINT_TIME_INDEX)]
+    for model in get_models(get_app('toucan_db')):
+        for name, sql in unique_statements(model):
+            drops.append(('ALTER TABLE "{0}" DROP CONSTRAINT "{1}"'.format(model._meta.db_table, name), name))
+        for fields in model._meta.index_together:
+            for name, sql in index_statements(model):
+                if ','.join('"%s"' % model._meta.get_field(field).column for field in fields) in sql.replace(' ', ''):
+                    drops.append(('DROP INDEX "{0}"'.format(name), name))
+    return drops
+
+
+class Rollback(Exception):
+    pass
+
+
+print '\n===== Without the tuned indexes ====='
+try:
+    with transaction.atomic():
+        for sql, name in tuned_indexes():
+            cursor.execute(sql)
+        for title, queryset in queries:
+            explain(title, queryset)
+        raise Rollback
+except Rollback:
+    pass
+
+print '\n===== With the tuned indexes ====='
+for title, queryset in queries:
+    explain(title, queryset)
+
+# Tidy up
+with transaction.atomic():
+    cursor.execute('DELETE FROM toucan_db_measurement')
+    cursor.execute('DELETE FROM toucan_db_image')
+    cursor.execute('DELETE FROM toucan_db_point')
+    Deployment.objects.filter(campaign__campaign='benchmark').delete()
+    Campaign.objects.filter(campaign='benchmark').delete()
+    Instrument.objects.filter(name__startswith='instrument_').delete()
+    ImageRegion.objects.filter(region__startswith='region_').delete()
+    MeasurementType.objects.filter(type__startswith='type_', units='NA').delete()
+    MeasurementWavelength.objects.exclude(id__in=existing_wavelengths).delete()
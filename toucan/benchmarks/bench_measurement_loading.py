@@ -0,0 +1,66 @@
+"""
+Benchmark saving in-situ measurements with bulk_create against PostgreSQL COPY (ingest.copy_measurements)
+
+Creates a set of synthetic points, then times saving the same measurements both ways. The measurements are
+deleted again after each run, so this can be run against a development database.
+
+Usage: python bench_measurement_loading.py [number of measurements]
+"""
+from os import environ
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'ingest_data')))
+environ['DJANGO_SETTINGS_MODULE'] = 'toucan.settings'
+from toucan_db.models import *
+from ingest import copy_measurements, MEASUREMENT_FIELDS
+import datetime
+import pytz
+import timeit
+
+nmeasurements = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+npoints = max(nmeasurements // 20, 1)
+
+# Set up the foreign keys the measurements need
+instrument = Instrument.objects.get_or_create(name='benchmark')[0]
+campaign = Campaign.objects.get_or_create(campaign='benchmark')[0]
+deployment = Deployment.objects.get_or_create(site='benchmark', pi='benchmark', campaign=campaign)[0]
+measurement_type = MeasurementType.objects.get_or_create(type='benchmark_is', units='NA', long_name='benchmark_is')[0]
+wavelength = MeasurementWavelength.objects.get_or_create(wavelength=-1.0)[0]
+time_is = datetime.datetime(2000, 1, 1, tzinfo=pytz.utc)
+Point.objects.bulk_create([Point(matchup_id='benchmark_%i' % i, point='POINT(0 0)', time_is=time_is, pqc='P00000000',
+                                 mqc='M000000000000000000', land_dist_is=0, thetas_is=0, deployment=deployment)
+                           for i in range(npoints)])
+point_ids = list(Point.objects.filter(deployment=deployment).values_list('id', flat=True))
+
+
+def measurements():
+    """Generator giving the synthetic measurements, in the format used by ingest.measurement_rows"""
+    for i in xrange(nmeasurements):
+        yield (str(i * 0.001), measurement_type.id, point_ids[i % len(point_ids)], wavelength.id, instrument.id)
+
+
+def bulk():
+    Measurement.objects.bulk_create([Measurement(**dict(zip(MEASUREMENT_FIELDS, measurement)))
+                                     for measurement in measurements()])
+
+
+def copy():
+    copy_measurements(measurements())
+
+
+for name, loader in (('bulk_create', bulk), ('COPY', copy)):
+    tic = timeit.default_timer()
+    loader()
+    toc = timeit.default_timer()
+    saved = Measurement.objects.filter(instrument=instrument).count()
+    print '%-12s %10i measurements in %8.2f s (%10.0f per second)' % (name, saved, toc - tic, saved / (toc - tic))
+    Measurement.objects.filter(instrument=instrument).delete()
+
+# Tidy up
+Point.objects.filter(deployment=deployment).delete()
+deployment.delete()
+campaign.delete()
+measurement_type.delete()
+wavelength.delete()
+instrument.delete()
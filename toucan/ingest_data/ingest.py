@@ -1,90 +1,358 @@
 import re
+import csv
+from cStringIO import StringIO
+from django.db import connection, transaction, IntegrityError
+from django.utils.encoding import force_text
 from toucan_db.models import *
+from toucan_db.choices import invalidate_choices
 import datetime
 import pytz
 
-def read_data(file_data, instrument, filename):
+# The first measurement column (after all the Point metadata ones)
+FIRST_MEASUREMENT_COLUMN = 10
+
+# Number of rows of the csv file read and saved in each transaction
+CHUNK_SIZE = 10000
+
+# Number of measurements sent to the database in each COPY statement
+COPY_CHUNK_SIZE = 100000
+
+# Fields of the Measurement model, in the order used by measurement_rows
+MEASUREMENT_FIELDS = ('value', 'measurement_type_id', 'point_id', 'wavelength_id', 'instrument_id')
+
+
+def read_data(file_data, instrument, filename, use_copy=False, chunk_size=CHUNK_SIZE, progress=None):
     """Function reading the file and uploading the data to the database\n
+    The file is read and saved in chunks of rows, each one in its own transaction, so the memory used
+    doesn't depend on the size of the file.
+
     :param file file_data: file object to be read
     :param int instrument: id of the instrument used for the measurement
     :param str filename: name of the file, the name of the campaign is extracted form it
+    :param bool use_copy: [Optional] save the measurements with :py:func:`copy_measurements` (PostgreSQL COPY)
+                          instead of bulk_create. This is much faster for large files.
+    :param int chunk_size: [Optional] Number of rows to read and save at a time
+    :param progress: [Optional] Function to call after each chunk is saved, with the total number of rows saved so far
+    :return: The number of rows saved
     """
 
-    # Read the cvs file (turn the string into an array)
-    data = read_file(file_data)
+    # Read the cvs file one row at a time
+    rows = read_rows(file_data)
 
     # Check if the file is legit
-    if not file_ok(data[0]):
+    header = next(rows, None)
+    if header is None or not file_ok(header):
         raise IOError
 
+    # Keep all the foreign key objects in memory while we go through the file
+    session = IngestSession()
+
     # Create new, or get matching, campaign object
-    campaign = get_campaign(filename)
-    
-    # Create list of measurements, which will then all be saved in one go at the end
-    measurements_to_bulk_save = []
+    campaign = session.get_campaign(read_campaign_name(filename))
 
-    i = 1
-    j = 10 # The first measurement column (after all the Point metadata ones)
-    header = data[0]
+    # Work out the type and wavelength of each measurement column once, from the header
+    columns = session.parse_header(header)
 
-    # Loop over all the rows in the file
-    while i < len(data):
-        deployment = get_deployment(site=data[i][1], pi=data[i][2], campaign=campaign)
-        point_id = get_point(data[i][:j], deployment.id)
+    nrows = 0
+    for chunk in read_chunks(rows, chunk_size):
+        with transaction.atomic():
+            # Get all the deployments and points used in this chunk in one go
+            deployments = session.get_deployments(set((row[1], row[2]) for row in chunk), campaign)
+            point_ids = session.get_points(chunk, deployments)
+
+            # Create the measurements, which will then all be saved in one go
+            measurements = measurement_rows(chunk, point_ids, columns, instrument)
+
+            # save all the measurements into the database
+            if use_copy:
+                copy_measurements(measurements)
+            else:
+                Measurement.objects.bulk_create([Measurement(**dict(zip(MEASUREMENT_FIELDS, measurement)))
+                                                 for measurement in measurements])
+
+        nrows += len(chunk)
+        if progress:
+            progress(nrows)
+
+    return nrows
 
+
+def measurement_rows(rows, point_ids, columns, instrument):
+    """
+    Generator going through the measurement columns of each row, and giving the values that are to be saved
+
+    :param list rows: Rows of the csv file
+    :param list point_ids: The point id for each row
+    :param list columns: The measurement columns, as returned by :py:meth:`IngestSession.parse_header`
+    :param int instrument: id of the instrument used for the measurement
+    :return: Yields tuples of (value, measurement type id, point id, wavelength id, instrument id), see
+             MEASUREMENT_FIELDS. Wavelength id is None for measurements that don't have a wavelength.
+    """
+    # Loop over all the rows in the file
+    for row, point_id in zip(rows, point_ids):
         # Loop through all the measurement columns on this row
-        while j < len(data[i]):
-            if re.search(r"^.*_IS$", header[j]):  # all simple measurements must look like XXX_IS
-                measurement = Measurement(measurement_type=get_type(header[j], False),
-                                          value=data[i][j],
-                                          point=Point(id=point_id),
-                                          instrument=Instrument(id=instrument)
-                                          )  # create a measurement using the functions to extract the data
-            elif re.search(r"^.*_IS_.*$", header[j]):  # all radiometric measurements must look like XXX_IS_YYY
-                measurement = Measurement(measurement_type=get_type(header[j], True),
-                                          value=data[i][j],
-                                          wavelength=get_wavelength(header[j]),
-                                          point=Point(id=point_id),
-                                          instrument=Instrument(id=instrument)
-                                          )  # create a measurement using the functions to extract the data
+        for j, measurement_type, wavelength in columns:
+            if j >= len(row):
+                break
 
             # Ignore missing values, which are empty cells in the csv file
             try:
-                float(measurement.value)
-                measurements_to_bulk_save.append(measurement)
-            except:
-                #do nothing
-                pass
-            
-            j += 1
+                float(row[j])
+            except ValueError:
+                continue
 
-        i += 1
-        j = 10
+            yield (row[j], measurement_type.id, point_id, (wavelength.id if wavelength else None), instrument)
 
-    # save all the measurements into the database
-    Measurement.objects.bulk_create(measurements_to_bulk_save)
 
+def copy_measurements(measurements, chunk_size=COPY_CHUNK_SIZE):
+    """
+    Save measurements to the database using PostgreSQL's COPY ... FROM STDIN, which is much faster than the
+    INSERT statement built by bulk_create. The values are written to the database in chunks, so the memory
+    used doesn't depend on the number of measurements, and no model instances are created.
 
-def read_file(file_data):
-    """Creates an array (actually a list of lists) based on the uploaded data\n
-    :param file file_data: file object to be read
+    Falls back to bulk_create (also in chunks) for other database backends.
+
+    :param measurements: Iterable of measurement tuples, as given by :py:func:`measurement_rows`
+    :param int chunk_size: [Optional] Number of measurements to send in each COPY statement
+    """
+    if connection.vendor != 'postgresql':
+        chunk = []
+        for measurement in measurements:
+            chunk.append(Measurement(**dict(zip(MEASUREMENT_FIELDS, measurement))))
+            if len(chunk) == chunk_size:
+                Measurement.objects.bulk_create(chunk)
+                chunk = []
+        Measurement.objects.bulk_create(chunk)
+        return
+
+    quote = connection.ops.quote_name
+    column_names = dict((field.attname, field.column) for field in Measurement._meta.fields)
+    columns = [quote(column_names[name]) for name in MEASUREMENT_FIELDS]
+    sql = 'COPY {0} ({1}) FROM STDIN WITH CSV'.format(quote(Measurement._meta.db_table), ', '.join(columns))
+    cursor = connection.cursor()
+
+    def send(buf):
+        buf.seek(0)
+        cursor.copy_expert(sql, buf)
+
+    buf = StringIO()
+    writer = csv.writer(buf)
+    count = 0
+    for measurement in measurements:
+        # Write the value as a float, so it is in a format postgres understands (None is written as
+        # an empty field, which COPY reads as NULL)
+        writer.writerow((repr(float(measurement[0])),) + tuple(measurement[1:]))
+        count += 1
+        if count == chunk_size:
+            send(buf)
+            buf = StringIO()
+            writer = csv.writer(buf)
+            count = 0
+    if count:
+        send(buf)
+
+
+class IngestSession(object):
     """
+    Keeps the foreign key objects needed while ingesting in-situ data in memory, so that each one only
+    has to be looked up (or created) in the database once, rather than once per row or value.
 
-    # create an empty list to store the data
-    data = []
+    Objects are cached in dictionaries keyed by their natural key: the campaign name for campaigns,
+    (site, pi, campaign id) for deployments, the (lower case) type for measurement types, and the wavelength
+    value for measurement wavelengths. Anything not in the cache yet is fetched with a single query, and only
+    the ones that are truly new are created, in bulk.
+    """
 
-    # read the first line, values are separated by a semicolon
-    line = file_data.readline().split(';')
+    # Maximum number of points to look up in one query
+    chunk_size = 1000
+
+    def __init__(self):
+        self.campaigns = {}
+        self.deployments = {}
+        self.types = {}
+        self.wavelengths = {}
+
+    @staticmethod
+    def fill_cache(cache, keys, lookup, natural_key, model, build, unique=False):
+        """
+        Make sure all the keys are in the cache: fetch the ones we don't have yet from the database, and bulk
+        create any that aren't there either (then fetch those again, as bulk_create doesn't give us their ids)
+
+        :param dict cache: Cache dictionary to fill, keyed by natural key
+        :param keys: Natural keys of the objects that are needed
+        :param lookup: Function taking a set of keys, and returning a queryset containing those objects
+        :param natural_key: Function returning the natural key of an object
+        :param model: The model class
+        :param build: Function creating a new (unsaved) object from its natural key
+        :param unique: [Optional] Whether the natural key is unique in the database (default False). Another
+                       process can then create some of the same objects at the same time, which makes the bulk
+                       create fail; the objects are then created one at a time, skipping the ones that exist.
+        """
+        missing = set(keys) - set(cache)
+        if not missing:
+            return
+
+        def fetch():
+            for obj in lookup(missing):
+                if natural_key(obj) in missing:
+                    cache.setdefault(natural_key(obj), obj)
+
+        fetch()
+        new = [key for key in missing if key not in cache]
+        if new:
+            if not unique:
+                model.objects.bulk_create([build(key) for key in new])
+            else:
+                try:
+                    with transaction.atomic():
+                        model.objects.bulk_create([build(key) for key in new])
+                except IntegrityError:
+                    for key in new:
+                        try:
+                            with transaction.atomic():
+                                build(key).save()
+                        except IntegrityError:
+                            pass   # created by someone else in the meantime
+            # bulk_create sends no post_save signals, so clear the cached choice lists here
+            invalidate_choices(model)
+            fetch()
+
+    def get_campaign(self, campaign_name):
+        """
+        Get the campaign with this name, creating it if necessary
+
+        :param str campaign_name: Name of the campaign
+        :return: the Campaign object found or created
+        """
+        if campaign_name not in self.campaigns:
+            self.campaigns[campaign_name] = Campaign.objects.get_or_create(campaign=campaign_name)[0]
+        return self.campaigns[campaign_name]
+
+    def get_deployments(self, sites, campaign):
+        """
+        Get the deployments for a set of sites, creating any that are new
+
+        :param sites: Set of (site, pi) pairs
+        :param Campaign campaign: Campaign object the deployments are attached to
+        :return: Dictionary of the Deployment objects, keyed by (site, pi)
+        """
+        keys = set((site, pi, campaign.id) for site, pi in sites)
+        self.fill_cache(self.deployments, keys,
+                        lookup=lambda keys: Deployment.objects.filter(campaign=campaign,
+                                                                      site__in=set(key[0] for key in keys)),
+                        natural_key=lambda obj: (obj.site, obj.pi, obj.campaign_id),
+                        model=Deployment,
+                        build=lambda key: Deployment(site=key[0], pi=key[1], campaign=campaign))
+        return dict(((site, pi), self.deployments[(site, pi, campaign_id)]) for site, pi, campaign_id in keys)
+
+    def get_points(self, rows, deployments):
+        """
+        Get the point ids for a list of rows, creating any points that are new
+
+        The rows are deduplicated on their natural key (all the fields of the point, see :py:func:`point_key`) in
+        memory, then looked up in chunks (one query per chunk), and the points that don't exist yet are created with
+        bulk_create. Points aren't kept in the session afterwards, so that memory use stays bounded for large files.
+
+        :param list rows: Rows of the csv file (the point fields are in the first ten columns)
+        :param dict deployments: Deployment objects keyed by (site, pi), as returned by
+                                 :py:meth:`IngestSession.get_deployments`
+        :return: List of point ids, one for each row
+        """
+        keys = [point_key(row[:FIRST_MEASUREMENT_COLUMN], deployments[(row[1], row[2])].id) for row in rows]
+        points = {}
+        unique = list(set(keys))
+        for start in range(0, len(unique), self.chunk_size):
+            self.fill_cache(points, unique[start:start+self.chunk_size],
+                            lookup=lambda keys: Point.objects.filter(matchup_id__in=set(key[0] for key in keys),
+                                                                     deployment_id__in=set(key[-1] for key in keys)),
+                            natural_key=lambda obj: (obj.matchup_id, obj.point.x, obj.point.y, obj.time_is,
+                                                     obj.pqc, obj.mqc, obj.land_dist_is, obj.thetas_is,
+                                                     obj.deployment_id),
+                            model=Point,
+                            build=lambda key: Point(**point_fields(key)))
+        return [points[key].id for key in keys]
+
+    def get_types(self, types):
+        """
+        Get the measurement types with these names, creating any that are new
+
+        :param types: Set of measurement types (lower case)
+        :return: Dictionary of the MeasurementType objects, keyed by type
+        """
+        self.fill_cache(self.types, types,
+                        lookup=lambda keys: MeasurementType.objects.filter(type__in=keys),
+                        natural_key=lambda obj: obj.type,
+                        model=MeasurementType,
+                        build=lambda key: MeasurementType(type=key, units=units_and_name(key)['units'],
+                                                          long_name=units_and_name(key)['long_name']),
+                        unique=True)
+        return dict((key, self.types[key]) for key in types)
+
+    def get_wavelengths(self, wavelengths):
+        """
+        Get the measurement wavelengths with these values, creating any that are new
+
+        :param wavelengths: Set of wavelength values (floats)
+        :return: Dictionary of the MeasurementWavelength objects, keyed by wavelength
+        """
+        self.fill_cache(self.wavelengths, wavelengths,
+                        lookup=lambda keys: MeasurementWavelength.objects.filter(wavelength__in=keys),
+                        natural_key=lambda obj: obj.wavelength,
+                        model=MeasurementWavelength,
+                        build=lambda key: MeasurementWavelength(wavelength=key))
+        return dict((key, self.wavelengths[key]) for key in wavelengths)
+
+    def parse_header(self, header):
+        """
+        Work out the measurement type, and the wavelength for radiometric measurements, of each measurement
+        column in the header. Any types and wavelengths not yet in the database are created.
+
+        :param list header: The first line of the csv file
+        :return: List of (column index, MeasurementType, MeasurementWavelength or None) for each measurement column
+        """
+        parsed = []
+        for j, name in enumerate(header[FIRST_MEASUREMENT_COLUMN:], FIRST_MEASUREMENT_COLUMN):
+            if re.search(r"^.*_IS$", name):  # all simple measurements must look like XXX_IS
+                parsed.append((j, parse_type(name, False).lower(), None))
+            elif re.search(r"^.*_IS_.*$", name):  # all radiometric measurements must look like XXX_IS_YYY
+                parsed.append((j, parse_type(name, True).lower(), parse_wavelength(name)))
+
+        types = self.get_types(set(column[1] for column in parsed))
+        wavelengths = self.get_wavelengths(set(column[2] for column in parsed if column[2] is not None))
+
+        return [(j, types[type], (wavelengths[wavelength] if wavelength is not None else None))
+                for j, type, wavelength in parsed]
+
+
+def read_rows(file_data):
+    """Generator reading the uploaded data one row (list of values) at a time\n
+    Values are separated by a semicolon, and blanks around them are removed. Empty lines are skipped.
+    The values are decoded from UTF-8, so that they compare equal to the (unicode) values read from the database.
 
-    # add all lines to the list
-    while line != ['']:
-        line = map(lambda s: s.strip(), line)  # erase the blanks in the string
+    :param file file_data: file object to be read
+    """
+    for line in csv.reader(file_data, delimiter=';'):
+        line = [s.strip().decode('utf-8') for s in line]  # erase the blanks in the string
+        if not any(line):
+            continue
         if line[-1] == '':  # fixes a bug for one file (NOMAD) where there is an extra semicolon at the end of each line
             line = line[:-1]
-        data.append(line)  # add the line to the array
-        line = file_data.readline().split(';')  # get the next line
+        yield line  # give the next line
 
-    return data
+
+def read_chunks(rows, chunk_size=CHUNK_SIZE):
+    """Generator grouping rows into lists of (at most) chunk_size rows\n
+    :param rows: Iterable of rows, eg from :py:func:`read_rows`
+    :param int chunk_size: [Optional] Number of rows in each chunk
+    """
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
 
 
 def file_ok(line_1):
@@ -129,35 +397,10 @@ def read_campaign_name(filename):
 
     return campaign_name
 
-def get_campaign(filename):
-    """
-    Get the campaign name, and check to see if we already have this campaign in the database. Create new campaign if not.
 
-    :param filename: Name of the file, which contains the campaign name
-    :return: the campaign object found or created
+def point_key(data, dep_id):
     """
-    campaign_name = read_campaign_name(filename)
-    campaign = Campaign.objects.get_or_create(campaign=campaign_name)[0]
-    return campaign        
-
-
-def get_deployment(site, pi, campaign):
-    """
-    Check to see if we already have this deployment in the database. Create new deployment if not.
-
-    :param string site: Name of the deployment site
-    :param string pi: Name of the PI
-    :param Campaign campaign: Campaign object this deployment is attached to
-    :return: the Deployment object found or created
-
-    """
-    deployment = Deployment.objects.get_or_create(site=site, pi=pi, campaign=campaign)[0]       
-    return deployment
-
-
-def get_point(data, dep_id):
-    """
-    Check to see if the current point has already been created. If so, return the point id. If not, create a new point.
+    Read the point fields from the start of a row, and return them as a tuple which identifies the point
 
     .. NOTE::
 
@@ -165,31 +408,44 @@ def get_point(data, dep_id):
 
     :param array data: Data array containing the 10 field values
     :param integer dep_id:   Id number of the deployment this point is attached to
-    :return: the point id of either the point that was found, or the new one created
+    :return: tuple of (matchup_id, x, y, time_is, pqc, mqc, land_dist_is, thetas_is, deployment id). The text
+             fields are unicode (byte strings are decoded from UTF-8), so that keys compare equal to the ones of
+             the points read from the database.
     """
-    matchup_id = data[0]
-    point = 'POINT({0} {1})'.format(data[3], data[4])
+    matchup_id = force_text(data[0])
+    x = float(data[3])
+    y = float(data[4])
     time_is = datetime.datetime.strptime(data[5],'%Y%m%dT%H%M%SZ').replace(tzinfo=pytz.utc)
-    pqc = data[6]
-    mqc = data[7]
+    pqc = force_text(data[6])
+    mqc = force_text(data[7])
     try:
-        float(data[8])
-        land_dist_is = data[8]
-    except:
-        land_dist_is = '-999'
+        land_dist_is = float(data[8])
+    except ValueError:
+        land_dist_is = -999.0
     try:
-        float(data[9])        
-        thetas_is = data[9]
-    except:
-        thetas_is = '-999'
-        
-    deployment = Deployment.objects.get(id=dep_id)
-        
-    thispoint = Point.objects.get_or_create(matchup_id=matchup_id, point=point, time_is=time_is, pqc=pqc, mqc=mqc,
-                          land_dist_is=land_dist_is, thetas_is=thetas_is, deployment=deployment)[0]
-    point_id = thispoint.id
+        thetas_is = float(data[9])
+    except ValueError:
+        thetas_is = -999.0
+
+    return (matchup_id, x, y, time_is, pqc, mqc, land_dist_is, thetas_is, dep_id)
+
 
-    return point_id
+def point_fields(key):
+    """
+    Convert a point key, as returned by :py:func:`point_key`, into a dictionary of the Point model fields
+
+    :param tuple key: The point key
+    :return: dictionary of field values
+    """
+    matchup_id, x, y, time_is, pqc, mqc, land_dist_is, thetas_is, dep_id = key
+    return {'matchup_id': matchup_id,
+            'point': 'POINT({0!r} {1!r})'.format(x, y),
+            'time_is': time_is,
+            'pqc': pqc,
+            'mqc': mqc,
+            'land_dist_is': land_dist_is,
+            'thetas_is': thetas_is,
+            'deployment_id': dep_id}
 
 
 def units_and_name(type):
@@ -237,12 +493,11 @@ def units_and_name(type):
         return {'units':'NA', 'long_name': type.lower()}
 
 
-def get_type(string, radiometric):
-    """Read the measurement type from the string read, if it doesn't exist, create it\n
-    Force the type to be lower case, so that we don't get duplicates with just differences in case
-
+def parse_type(string, radiometric):
+    """Read the measurement type from a column heading\n
     :param string string: string containing the measurement type, i.e. in "Rho_wn_IS_412" the type is "Rho_wn_IS"
     :param boolean radiometric: true if the measurement is radiometric, meaning the string contains the wavelength
+    :return: the measurement type, as a string
     """
 
     type = ''
@@ -258,21 +513,13 @@ def get_type(string, radiometric):
     else:
         type = string
 
-    # get the right measurement type object from the database
-    try:
-        measurement_type = MeasurementType.objects.get(type=type.lower())
-    # if it does not exist, create it
-    except MeasurementType.DoesNotExist:
-        measurement_type = MeasurementType(type=type.lower(), units=units_and_name(type)['units'],
-                                           long_name=units_and_name(type)['long_name'])
-        measurement_type.save()
-
-    return measurement_type
+    return type
 
 
-def get_wavelength(string):
-    """Read the measurement wavelength from the string, if it doesn't exist, create it\n
-    :param string string: containing the wavelength, i.e. in "Rho_wn_IS_412" the type is "412"
+def parse_wavelength(string):
+    """Read the measurement wavelength from a column heading\n
+    :param string string: containing the wavelength, i.e. in "Rho_wn_IS_412" the wavelength is "412"
+    :return: the wavelength, as a float
     """
 
     wavelength = ''
@@ -283,14 +530,4 @@ def get_wavelength(string):
             wavelength += char
 
     # convert the string to float
-    wavelength = float(wavelength)
-
-    # get the right wavelength object from the database
-    try:
-        measurement_wavelength = MeasurementWavelength.objects.get(wavelength=wavelength)
-    except MeasurementWavelength.DoesNotExist:
-    # if it does not exist, create it
-        measurement_wavelength = MeasurementWavelength(wavelength=wavelength)
-        measurement_wavelength.save()
-
-    return measurement_wavelength
+    return float(wavelength)
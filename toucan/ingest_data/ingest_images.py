@@ -1,14 +1,19 @@
+import errno
 import glob
 import json
+import logging
 import os
 import numpy as np
 import matplotlib.pyplot as plt
 
 from toucan_db.models import *
+from toucan_db.statistics import band_statistics, save_statistics
 from ingest_images_file_readers import DataReaders
 from ingest_images_geo_tools import GeoTools
 from ingest import units_and_name
 
+logger = logging.getLogger(__name__)
+
 class IngestImages():
     """
     Image ingestion class, with methods to do everything needed to ingest images
@@ -23,20 +28,109 @@ class IngestImages():
         self.inputdir = inputdir
         self.outdir = outdir
 
-    def ingest_all(self):
+    def ingest_all(self, workers=1):
         """
         Loop through all the metadata files in the given input directory and ingest all image files
+
+        With more than one worker, the metadata files are processed in parallel by a pool of processes (reading,
+        regridding, and writing the geotiffs and quicklooks). The images are still added to the database one at a
+        time by this process, so that the workers never write to the database. With one worker, each image is
+        added to the database as soon as it is processed. Either way, if an image fails, the error is logged and
+        the other images carry on; the metadata file is only tidied up once all its images are ingested, so
+        that the failed ones can be ingested again.
+
+        :param int workers: [Optional] Number of processes to use (default 1, ie ingest one file after another)
+        :return: Dictionary of the files that failed, with the exception raised for each one: the image data files,
+                 or the metadata file if it could not be read
         """
         self.filelist = self.get_file_list()
-        for thisfile in self.filelist:
-            self.ingest_image(thisfile)
-        
+        failures = {}
+        if workers <= 1:
+            for thisfile in self.filelist:
+                try:
+                    failures.update(self.ingest_image(thisfile))
+                except Exception as err:
+                    failures[thisfile] = err
+                    logger.exception("Failed to ingest %s", thisfile)
+            return failures
+
+        from multiprocessing import Pool
+        from django.db import connection
+
+        # Don't let the worker processes inherit our database connection
+        connection.close()
+
+        pool = Pool(processes=workers)
+        try:
+            tasks = [(self.inputdir, self.outdir, thisfile) for thisfile in self.filelist]
+            for thisfile, images, errors in pool.imap_unordered(_process_image, tasks):
+                # The workers have logged their own errors, with the tracebacks
+                try:
+                    failures.update(self.register_all(thisfile, images, errors))
+                except Exception as err:
+                    failures[thisfile] = err
+                    logger.exception("Failed to ingest %s", thisfile)
+        finally:
+            pool.close()
+            pool.join()
+        return failures
+
     def ingest_image(self, thisfile):
         """
-        Ingest images from a single metafile. This method is called by ingest_all,
-        or it can be called manually to ingest one file
+        Ingest images from a single metafile, adding each image to the database as soon as it is processed.
+        This method is called by ingest_all, or it can be called manually to ingest one file
+
+        :param str thisfile: The metadata file for the image to be ingested (including full directory path)
+        :return: Dictionary of the image data files that failed, with the exception raised for each one
+        """
+        errors = {}
+        return self.register_all(thisfile, self.iter_images(thisfile, errors), errors)
+
+    def register_all(self, thisfile, images, errors):
+        """
+        Add the processed images of a metafile to the database, each one as soon as it comes. An image that fails
+        is logged and added to the errors, and the others carry on. The metafile is tidied up at the end if
+        none of its images failed.
+
+        :param str thisfile: The metadata file the images came from
+        :param images: Iterable of the lists of metadata dictionaries of each image, as given by
+                       :py:meth:`IngestImages.iter_images`
+        :param errors: Dictionary of the image data files that failed so far, with the exception raised for each
+                       one, which is added to
+        :return: The errors
+        """
+        for records in images:
+            try:
+                self.register_images(records, meta=False)
+            except Exception as err:
+                errors[records[0]['filename']] = err
+                logger.exception("Failed to add %s to the database", records[0]['filename'])
+        if not errors:
+            self.metafile = thisfile
+            self.tidy_up(meta=True, data=False)
+        return errors
+
+    def process_image(self, thisfile):
+        """
+        Process the images from a single metafile: read the data, save the geotiffs and make the quicklooks.
+        Nothing is written to the database here, so this can safely be run in a separate process.
+
+        :param str thisfile: The metadata file for the image to be ingested (including full directory path)
+        :return: List of the metadata dictionaries (one per image file and direction), as returned by
+                 :py:meth:`IngestImages.image_record`, with the statistics of the bands under the key 'statistics'
+                 (see :py:func:`toucan_db.statistics.band_statistics`), ready to be passed to :py:meth:`IngestImages.register_images`
+        """
+        return [record for records in self.iter_images(thisfile) for record in records]
+
+    def iter_images(self, thisfile, errors=None):
+        """
+        Process the images from a single metafile one at a time, as for :py:meth:`IngestImages.process_image`
 
         :param str thisfile: The metadata file for the image to be ingested (including full directory path)
+        :param errors: [Optional] Dictionary to add the image data files that fail to, with the exception raised
+                       for each one, after logging it and carrying on with the next image. By default the
+                       exception is raised.
+        :return: Generator giving, for each image file, the list of its metadata dictionaries (one per direction)
         """
         # ------------------------------------------------
         # Read this metadata file
@@ -48,36 +142,76 @@ class IngestImages():
         # Loop through all image files in this meta file
         # and process them one at a time
         # ------------------------------------------------
-        last = False
         for image in range(len(metadata_all)):
-            # Only tidy up metafile on the last pass
-            if image==len(metadata_all)-1:
-                last = True
-
             self.metadata = metadata_all[image]
+            try:
+                records = self.image_records()
+            except Exception as err:
+                if errors is None:
+                    raise
+                errors[self.metadata['filename']] = err
+                logger.exception("Failed to process %s", self.metadata['filename'])
+                continue
+            yield records
+
+    def image_records(self):
+        """
+        Process the current image (self.metadata): read the data, save the geotiffs and make the quicklooks
+
+        :return: List of its metadata dictionaries (one per direction), as returned by
+                 :py:meth:`IngestImages.image_record`
+        """
+        # ------------------------------------------------
+        # If current instrument is AATSR, we have separate nadir/forward datasets
+        # Loop over them, to create separate database entry and files for each
+        # ------------------------------------------------
+        if self.metadata['instrument'].lower() == 'aatsr':
+            directions = ('fward', 'nadir')
+        else:  # Leave direction blank for other instruments
+            directions = ('',)  # Needs to be a list so we can iterate over it
+        records = []
+        for direction in directions:
+            self.metadata['direction'] = direction
+            self.read_data()
+            self.save_geotiff()
+            # (before the quicklook, which normalises the RGB bands in place)
+            self.metadata['statistics'] = band_statistics(self.data['bands'])
+            self.make_quicklook()
+            records.append(self.image_record())
+            # Clear keys before we go on to the next direction
+            keys_to_clear = ('variables', 'angle_names', 'flag_name', 'direction', 'statistics')
+            [self.metadata.pop(key) for key in keys_to_clear if key in self.metadata.keys()]
+        return records
+
+    def image_record(self):
+        """
+        Get everything about the current image that is needed to add it to the database
+
+        :return: Copy of the metadata dictionary, with the mean viewing angles added under the key 'angles'
+        """
+        record = dict(self.metadata)
+        record['angles'] = {angle: float(np.nanmean(self.data[angle])) for angle in ('SZA', 'SAA', 'VZA', 'VAA')}
+        return record
+
+    def register_images(self, records, meta=True):
+        """
+        Add processed images to the database, then tidy up their files
+
+        :param records: List of metadata dictionaries, as returned by :py:meth:`IngestImages.process_image`
+                        (self.metafile must be the metadata file they came from)
+        :param meta: [Optional] Whether to tidy up the metafile after the last image (default True)
+        """
+        for index, record in enumerate(records):
+            self.metadata = record
+            self.add_to_database()
 
             # ------------------------------------------------
-            # If current instrument is AATSR, we have separate nadir/forward datasets
-            # Loop over them, to create separate database entry and files for each
-            # ------------------------------------------------
-            if self.metadata['instrument'].lower() == 'aatsr':
-                directions = ('fward', 'nadir')
-            else:  # Leave direction blank for other instruments
-                directions = ('',)  # Needs to be a list so we can iterate over it
-            for direction in directions:
-                self.metadata['direction'] = direction
-                self.read_data()
-                self.save_geotiff()
-                self.make_quicklook()
-                self.add_to_database()
-                # Clear keys before we go on to the next direction
-                keys_to_clear = ('variables', 'angle_names', 'flag_name', 'direction')
-                [self.metadata.pop(key) for key in keys_to_clear if key in self.metadata.keys()]
-            # ------------------------------------------------
-            # Tidy up completed image
+            # Tidy up completed image, once all its directions are done
             # Also tidies metafile if this was the last image
             # ------------------------------------------------
-            self.tidy_up(meta=last)
+            last = (index == len(records)-1)
+            if last or records[index+1]['filename'] != record['filename']:
+                self.tidy_up(meta=(last and meta))
 
     def get_file_list(self):
         """
@@ -125,8 +259,12 @@ class IngestImages():
         """
         savedir = os.path.join(self.outdir, self.metadata['region_name'].upper(), self.metadata['instrument'].upper(),
                                str(self.metadata['datetime'].year))
-        if not os.path.exists(savedir):
+        # Several worker processes can be creating the same directory at once (see ingest_all)
+        try:
             os.makedirs(savedir)
+        except OSError as err:
+            if err.errno != errno.EEXIST:
+                raise
 
         # Set the output file location
         # Append AATSR direction to the file name if required
@@ -139,11 +277,11 @@ class IngestImages():
         rasterOrigin=(self.data['longitude'].min(), self.data['latitude'].min())
         dx = self.data['longitude'][1] - self.data['longitude'][0]
         dy = self.data['latitude'][1] - self.data['latitude'][0]
-        GeoTools.array2raster(outfile, rasterOrigin, dx, dy, self.data, self.metadata['variables'])
+        GeoTools.array2raster(outfile, rasterOrigin, dx, dy, self.data['bands'])
 
         # Save the viewing angles in a separate file
         outfile = os.path.join(savedir, os.path.splitext(os.path.basename(self.metadata['filename']))[0]+dir_str+'_view_angles.tif')
-        GeoTools.array2raster(outfile, rasterOrigin, dx, dy, self.data, self.metadata['angle_names'].keys())
+        GeoTools.array2raster(outfile, rasterOrigin, dx, dy, self.data['angles'])
 
     def make_quicklook(self):
         """
@@ -189,16 +327,16 @@ class IngestImages():
         Add this image to the database
         
         Create new instances of ImageRegion and/or Instrument as required, otherwise fetch existing ones.
-        Then add all the metadata to a new Image instance.
-        
-        :param dict data: the data dictionary, as returned by :py:meth:`IngestImages.read_data`
+        Then add all the metadata to a new Image instance, and the statistics of its bands if there are any.
+
+        self.metadata must be a record as returned by :py:meth:`IngestImages.image_record`, which holds
+        the mean viewing angles.
         """
         # Get foreign key objects, or create new ones if necessary
         image_region,_ = ImageRegion.objects.get_or_create(region=self.metadata['region_name'].lower())
         instrument,_ = Instrument.objects.get_or_create(name=self.metadata['instrument'].lower())
         meas_type,_ = MeasurementType.objects.get_or_create(type=self.metadata['vartype'].lower(),
-                                                            units=units_and_name(self.metadata['vartype'])['units'],
-                                                            long_name=units_and_name(self.metadata['vartype'])['long_name'])
+                                                            defaults=units_and_name(self.metadata['vartype']))
         for band in self.metadata['wavelengths']:
             wavelength,_ = InstrumentWavelength.objects.get_or_create(value=band, instrument=instrument)
 
@@ -213,17 +351,22 @@ class IngestImages():
                                                  top_left_point='POINT({0} {1})'.format(coords[2], coords[1]),
                                                  bot_right_point='POINT({0} {1})'.format(coords[3], coords[0]),
                                                  time=self.metadata['datetime'],
-                                                 SZA=np.nanmean(self.data['SZA']),
-                                                 SAA=np.nanmean(self.data['SAA']),
-                                                 VZA=np.nanmean(self.data['VZA']),
-                                                 VAA=np.nanmean(self.data['VAA']),
+                                                 SZA=self.metadata['angles']['SZA'],
+                                                 SAA=self.metadata['angles']['SAA'],
+                                                 VZA=self.metadata['angles']['VZA'],
+                                                 VAA=self.metadata['angles']['VAA'],
                                                  direction=(direction if direction.isalnum() else None))
         if not new:
             print "Image already ingested!"
+        if 'statistics' in self.metadata and (new or not image.statistics.exists()):
+            save_statistics(image, self.metadata['statistics'])
 
-    def tidy_up(self, meta=False):
+    def tidy_up(self, meta=False, data=True):
         """
         Move files to an "ingested" folder once they are processed, ready to be deleted later
+
+        :param meta: [Optional] Whether to move the metafile (default False)
+        :param data: [Optional] Whether to move the data file of the current image (default True)
         """
         # Create the ingested folder if necessary
         ingested_dir = os.path.join(self.inputdir,'ingested')
@@ -231,10 +374,31 @@ class IngestImages():
             os.mkdir(ingested_dir)
 
         # Make sure the geotiff was created before moving files
-        if os.path.isfile(self.metadata['archive_location']):
+        if data and os.path.isfile(self.metadata['archive_location']):
             # Data file
             os.rename(self.metadata['filename'],
                       os.path.join(ingested_dir, os.path.basename(self.metadata['filename'])))
         if meta:
             # Metadata
             os.rename(self.metafile, os.path.join(ingested_dir,os.path.basename(self.metafile)))
+
+
+def _process_image(task):
+    """
+    Process one metadata file in a worker process, for :py:meth:`IngestImages.ingest_all`
+    (needs to be a module level function so that it can be pickled)
+
+    :param task: The input directory, output directory and metadata file
+    :return: The metadata file, the list of the metadata dictionaries of each image that was processed (see
+             :py:meth:`IngestImages.iter_images`), and the dictionary of the files that failed, with the exception
+             raised for each one (the metadata file itself if it could not be read)
+    """
+    inputdir, outdir, thisfile = task
+    errors = {}
+    try:
+        images = list(IngestImages(inputdir, outdir).iter_images(thisfile, errors))
+    except Exception as err:
+        images = []
+        errors[thisfile] = err
+        logger.exception("Failed to ingest %s", thisfile)
+    return thisfile, images, errors
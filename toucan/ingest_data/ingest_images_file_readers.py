@@ -1,4 +1,4 @@
-from ingest_images_geo_tools import GeoTools
+from ingest_images_geo_tools import GeoTools, RegridPlan
 import os
 import datetime
 from calendar import isleap
@@ -155,6 +155,31 @@ class DataReaders():
 
         return data
 
+    @staticmethod
+    def add_variables(data, get_variables, metadata):
+        """
+        Read and regrid the variables and viewing angles specified in the metadata, adding them to the data dictionary
+
+        The variables are stored as one stack under data['bands'] and the viewing angles as another stack under
+        data['angles'], so they can be written straight to GeoTiff. Each variable and angle is also available under
+        its own name, as a view onto the relevant band of the stack (so any corrections must be applied in place).
+
+        :param data: The data dictionary to add the variables to
+        :param get_variables: Function taking a list of dataset names, and returning the regridded stack of them
+        :param metadata: The metadata dictionary for this image
+        """
+        # Get the variables that were specified in the metadata file
+        variables = metadata['variables']
+        data['bands'] = get_variables([str(variable) for variable in variables])  # str() is needed as json returns unicode
+        for band, variable in enumerate(variables):
+            data[variable] = data['bands'][band]
+
+        # Get the viewing angles, in the same order as angle_names.keys() so the geotiff bands match
+        angles = metadata['angle_names'].keys()
+        data['angles'] = get_variables([metadata['angle_names'][angle] for angle in angles])
+        for band, angle in enumerate(angles):
+            data[angle] = data['angles'][band]
+
     def read_hdf_gdal(self, ingest):
         """Read an HDF format data file (eg VIIRS), using GDAL package
 
@@ -186,8 +211,13 @@ class DataReaders():
         data['longitude'] = new_lon
         data['latitude'] = new_lat
 
-        # Helper function to read a dataset, then extract and regrid to region of interest
-        def get_variable(varname):
+        # Work out the regridding once, it is the same for every variable. This also gives us the window
+        # of the swath that covers our region, so from now on we only read that part of each dataset
+        plan = RegridPlan(longitude, latitude, new_lon, new_lat)
+        xoffset, yoffset, width, height = plan.window
+
+        # Helper function to read the window of a dataset
+        def read_variable(varname):
             ds = [ds for ds,descr in datasets if ' '+varname+' ' in descr][0]
             # Not all bands have offset/scale
             try:
@@ -198,17 +228,18 @@ class DataReaders():
                 offset = float(gdal.Open(ds).GetMetadataItem('Offset'))
             except TypeError:
                 offset = 0.0
-            array = (gdal.Open(ds).ReadAsArray() - offset) * scale_factor
-            array_roi = GeoTools.extract_region_and_regrid(longitude, latitude, new_lon, new_lat, array)
-            return array_roi
+            array = (gdal.Open(ds).ReadAsArray(xoffset, yoffset, width, height) - offset) * scale_factor
+            return array
 
-        # Get the variables that were specified in the metadata file
-        for variable in ingest.metadata['variables']:
-            data[variable] = get_variable(str(variable))  # str() is needed as json returns unicode
+        # Helper function to read a list of datasets into one stack, then extract and regrid
+        # them all to the region of interest in one go
+        def get_variables(varnames):
+            stack = np.empty((len(varnames), height, width))
+            for band, varname in enumerate(varnames):
+                stack[band] = read_variable(varname)
+            return plan.regrid(stack)
 
-        # Get the viewing angles
-        for angle in ingest.metadata['angle_names']:
-            data[angle] = get_variable(ingest.metadata['angle_names'][angle])
+        self.add_variables(data, get_variables, ingest.metadata)
 
         del ds, hdf
         return data, time_temp
@@ -241,34 +272,35 @@ class DataReaders():
         data['longitude'] = new_lon
         data['latitude'] = new_lat
 
+        # Work out the regridding once, it is the same for every variable. This also gives us the window
+        # of the swath that covers our region, so from now on we only read that part of each band
+        plan = RegridPlan(longitude, latitude, new_lon, new_lat)
+        xoffset, yoffset, width, height = plan.window
+
         # Read in flag array, and extract bit for valid/invalid points to remove missing data points
         if 'flag_name' in ingest.metadata.keys():
-            flag_array = image.get_band(ingest.metadata['flag_name']).read_as_array()
+            flag_array = image.get_band(ingest.metadata['flag_name']).read_as_array(width, height, xoffset, yoffset)
             flag_array = flag_array >> ingest.metadata['flag_bit'] & 1
         else:
             flag_array = None
 
-        # Helper function to read a dataset, then extract and regrid to region of interest
+        # Helper function to read a list of datasets into one stack, then extract and regrid
+        # them all to the region of interest in one go
         # NB we read using the higher level get_band, instead of get_database. This is much simpler to use, and also 
         # means that values have already had scaling applied and are converted to floats
-        def get_variable(varname):
-            array = image.get_band(varname).read_as_array()
+        def get_variables(varnames):
+            stack = np.empty((len(varnames), height, width))
+            for band, varname in enumerate(varnames):
+                stack[band] = image.get_band(varname).read_as_array(width, height, xoffset, yoffset)
             if flag_array is not None:
-                array[flag_array==1] = np.nan
-            array_roi = GeoTools.extract_region_and_regrid(longitude, latitude, new_lon, new_lat, array)
-            return array_roi
+                stack[:, flag_array==1] = np.nan
+            return plan.regrid(stack)
 
-        # Get the variables that were specified in the metadata file
-        for variable in ingest.metadata['variables']:
-            data[variable] = get_variable(str(variable))  # str() is needed as json returns unicode
-
-        # Get the viewing angles
-        for angle in ingest.metadata['angle_names']:
-            data[angle] = get_variable(ingest.metadata['angle_names'][angle])
+        self.add_variables(data, get_variables, ingest.metadata)
 
         # If this is MERIS reflectance, apply solar correction
         if ingest.metadata['instrument'].lower() == 'meris' and ingest.metadata['vartype'] == 'radiance':
-            data = self.correct_MERIS(image, longitude, latitude, new_lon, new_lat, ingest.metadata, data)
+            data = self.correct_MERIS(image, plan, ingest.metadata, data)
 
         # If this is AATSR reflectance, apply corrections
         if ingest.metadata['instrument'].lower() == 'aatsr' and ingest.metadata['vartype'] == 'reflectance':
@@ -289,8 +321,9 @@ class DataReaders():
         # Correct angles: convert elevation (zenith==90)
         # to zenith angle (zenith==0)
         # ----------------------------------------
+        # (NB corrections are done in place, so that the stacks in data['bands'] and data['angles'] are updated too)
         for angle in ('SZA', 'VZA'):
-            data[angle] = 90 - data[angle]
+            data[angle][...] = 90 - data[angle]
 
         # ----------------------------------------
         # Correct reflectance for sun zenith angle
@@ -316,7 +349,7 @@ class DataReaders():
             # Convert 1.6um reflectance back to raw signal using linear conversion
             volts = data[band1600]/0.192 * -0.816
             # Convert 1.6um raw signal to reflectance using non-linear conversion function
-            data[band1600] = np.pi*(coeffs[0] + coeffs[1]*volts + coeffs[2]*volts**2 + coeffs[3]*volts**3)/1.553
+            data[band1600][...] = np.pi*(coeffs[0] + coeffs[1]*volts + coeffs[2]*volts**2 + coeffs[3]*volts**3)/1.553
 
         # ----------------------------------------
         # Remove existing drift correction and
@@ -328,7 +361,7 @@ class DataReaders():
             # Only apply to the reflectance bands, not the brightness temp bands
             if 'reflec' in var:
                 uncorrected = self.aatsr_drift_remove(gc1, data[var], band, acq_date)
-                data[var] = self.aatsr_drift_apply(uncorrected, band, acq_date)
+                data[var][...] = self.aatsr_drift_apply(uncorrected, band, acq_date)
 
         return data
 
@@ -416,22 +449,20 @@ class DataReaders():
         return corrected
 
     @staticmethod
-    def correct_MERIS(image, old_lon, old_lat, new_lon, new_lat, metadata, data):
+    def correct_MERIS(image, plan, metadata, data):
             """
             Correct MERIS TOA radiance according to solar irradiance model
             
             :param image: An open image file
-            :param old_lon: Original longitude array (needed for regridding)
-            :param old_lat: Original latitude array (needed for regridding)
-            :param new_lon: New longitude array (needed for regridding)
-            :param new_lat: New latitude array (needed for regridding)
+            :param plan: The :py:class:`RegridPlan` used for the other variables of this image
             :param metadata: Image metadata dictionary
             :param data: Dictionary containing the data
             :returns: Data, with the reflectances corrected
 
             """
-            # Get detector index
-            ccd_ind = image.get_band('detector_index').read_as_array()
+            # Get detector index, for the same window of the image as the other variables
+            xoffset, yoffset, width, height = plan.window
+            ccd_ind = image.get_band('detector_index').read_as_array(width, height, xoffset, yoffset)
 
             # Read in solar model
             aux_path = os.path.abspath(os.path.join(os.path.dirname(__file__), 'aux_files'))
@@ -462,11 +493,13 @@ class DataReaders():
             # Correct solar irradiance for earth-sun distance
             sun_irr *= (1 + 0.0167*np.cos(2*np.pi*(day_in_year-3.0)/year_length))**2
 
+            # Regrid the irradiance for all the bands in one go
+            nbands = len(metadata['variables'])
+            sun_irr_roi = plan.regrid(np.rollaxis(sun_irr[..., :nbands], 2))
+
             # Apply correction to TOA reflectance
             sun_zenith = data['SZA']
             for band, varname in enumerate(metadata['variables']):
-                sun_irr_band = GeoTools.extract_region_and_regrid(old_lon, old_lat, new_lon, new_lat,
-                                                                  sun_irr[..., band])
-                data[varname] *= np.pi * np.cos(np.deg2rad(sun_zenith))/sun_irr_band
+                data[varname] *= np.pi * np.cos(np.deg2rad(sun_zenith))/sun_irr_roi[band]
 
             return data
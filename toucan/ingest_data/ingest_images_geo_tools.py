@@ -10,19 +10,25 @@ class GeoTools():
         self.EARTH_RADIUS = 6378137
 
     @staticmethod
-    def array2raster(newRasterfn,rasterOrigin,pixelWidth,pixelHeight, data, variables, rotate=0):
-        """Convert data dictionary (of arrays) into a multiband GeoTiff
+    def array2raster(newRasterfn,rasterOrigin,pixelWidth,pixelHeight, data, variables=None, rotate=0):
+        """Convert a stack of bands, or a data dictionary (of arrays), into a multiband GeoTiff
 
         :param newRasterfn: filename to save to
         :param rasterOrigin: location of top left corner
         :param pixelWidth: e-w pixel size
         :param pixelHeight: n-s pixel size
-        :param data: dictionary containing the data arrays
-        :param variables: list of which keys from the dictionary to output
+        :param data: 3d array of bands (nbands, rows, cols), which is written straight to the GeoTiff bands,
+                     or a dictionary containing the data arrays
+        :param variables: list of which keys from the dictionary to output (only needed if data is a dictionary)
         :param rotate: Optional rotation angle (in radians)
         """
-        cols = len(data['longitude'])
-        rows = len(data['latitude'])
+        if isinstance(data, np.ndarray):
+            bands = data
+            rows, cols = data.shape[1:]
+        else:
+            bands = [data[key] for key in variables]
+            cols = len(data['longitude'])
+            rows = len(data['latitude'])
         originX = rasterOrigin[0]
         originY = rasterOrigin[1]
 
@@ -32,13 +38,13 @@ class GeoTools():
         ns_res = np.cos(rotate) * pixelHeight
 
         driver = gdal.GetDriverByName('GTiff')
-        nbands = len(variables)
+        nbands = len(bands)
         outRaster = driver.Create(newRasterfn, cols, rows, nbands, gdal.GDT_Float32)
         outRaster.SetGeoTransform((originX, we_res, rotX, originY, rotY, ns_res))
-        for band,key in enumerate(variables, 1):
+        for band,array in enumerate(bands, 1):
             outband = outRaster.GetRasterBand(band)
             outband.SetNoDataValue(0)
-            outband.WriteArray(data[key])
+            outband.WriteArray(array)
             outband.FlushCache()
         outRasterSRS = osr.SpatialReference()
         outRasterSRS.ImportFromEPSG(4326)
@@ -91,8 +97,9 @@ class GeoTools():
         """
         Re-grid data to a regular grid, at the same time as extracting the region of interest
 
-        Go through each point of the original grid, check if it is in the new grid, and if so append the 
-        data value to the closest grid point in the new grid.
+        Find which points of the original grid are in the new grid, and add their data values to the closest
+        grid point in the new grid. This is a one-off use of :py:class:`RegridPlan`; when regridding several
+        variables from the same grid, build the plan once and reuse it instead.
         
         .. NOTE::
 
@@ -106,30 +113,8 @@ class GeoTools():
         :param data: 2d array of data to be regridded
         :return: array containing the mean value for each new grid point.
         """
-        dx = np.diff(new_lon)[0]
-        dy = np.diff(new_lat)[0]
-
-        new_data = np.zeros((len(new_lat), len(new_lon)))
-        count = np.zeros((len(new_lat), len(new_lon)))
-
-        # Generate array of which points are inside the region of interest
-        # Assume our new coordinate points define the edges of the pixels, so we need to search up to
-        # a grid box beyond the max value to properly fill the grid.
-        in_region = (np.min(new_lon) <= old_lon) & (old_lon < np.max(new_lon)+dx) & \
-                    (np.min(new_lat) <= old_lat) & (old_lat < np.max(new_lat)+dy)
-
-        # loop over all points in the OLD grid
-        for j in np.arange(old_lon.shape[0]):
-            for i in np.arange(old_lon.shape[1]):
-                # Ignore points that aren't within the region of interest
-                if in_region[j,i]:
-                    # Find which point this corresponds to on the new grid, and add the data value
-                    new_i = int((old_lon[j,i] - np.min(new_lon)) / dx)
-                    new_j = int((old_lat[j,i] - np.min(new_lat)) / dy)
-                    new_data[new_j, new_i] += data[j,i]
-                    count[new_j, new_i] += 1
-        count[count==0] = np.nan # Prevent division by zero warnings
-        return new_data/count # Return the mean
+        plan = RegridPlan(old_lon, old_lat, new_lon, new_lat)
+        return plan.regrid(data)
 
     def latlon_distance_meters(self, lat, lon):
         """Calculate the great circle distance between two points on the earth using the Haversine equation
@@ -148,3 +133,112 @@ class GeoTools():
 
         distance = self.EARTH_RADIUS * c
         return distance
+
+
+class RegridPlan(object):
+    """
+    Precomputed mapping from an original (swath) grid to a new regular grid, so that many variables on the
+    same grid can be regridded without working out the geometry again each time.
+
+    The plan stores which points of the original grid are inside the region of interest, which point of the new
+    grid each of them belongs to, and how many original points fall in each new grid point. Regridding a data
+    array is then just a gather of the in-region values followed by a scatter-add onto the new grid.
+
+    The plan also works out the smallest window (block of rows and columns) of the original grid that contains
+    all the in-region points. Readers can then read just that window of each dataset from the file, rather than
+    the whole product.
+
+    .. NOTE::
+
+        Assumes that coordinates in the original satellite files are valid for the *centre* of the pixel, and that the
+        new coordinates are for the *edges* of the pixel (which is the GeoTiff convention).
+
+    :param old_lon: Longitude for the original grid (2d)
+    :param old_lat: Latitude for the original grid (2d)
+    :param new_lon: Longitude for the new grid (1d)
+    :param new_lat: Latitude for the new grid (1d)
+    """
+    def __init__(self, old_lon, old_lat, new_lon, new_lat):
+        new_lon = np.asarray(new_lon)
+        new_lat = np.asarray(new_lat)
+        dx = np.diff(new_lon)[0]
+        dy = np.diff(new_lat)[0]
+        min_lon = np.min(new_lon)
+        min_lat = np.min(new_lat)
+        self.shape = (len(new_lat), len(new_lon))
+        ncells = self.shape[0] * self.shape[1]
+
+        # Generate array of which points are inside the region of interest
+        # Assume our new coordinate points define the edges of the pixels, so we need to search up to
+        # a grid box beyond the max value to properly fill the grid.
+        in_region = (min_lon <= old_lon) & (old_lon < np.max(new_lon)+dx) & \
+                    (min_lat <= old_lat) & (old_lat < np.max(new_lat)+dy)
+
+        # Find the window of the original grid containing all the in-region points, as
+        # (xoffset, yoffset, width, height). If there are none, keep a single pixel window
+        # so that readers still get a valid (all missing) result.
+        rows = np.flatnonzero(in_region.any(axis=1))
+        cols = np.flatnonzero(in_region.any(axis=0))
+        if rows.size:
+            self.window = (int(cols[0]), int(rows[0]), int(cols[-1]-cols[0]+1), int(rows[-1]-rows[0]+1))
+        else:
+            self.window = (0, 0, 1, 1)
+        self.full_shape = in_region.shape
+        in_region = self.crop(in_region)
+        old_lon = self.crop(old_lon)
+        old_lat = self.crop(old_lat)
+
+        # Flat indices of the in-region points within the window, in row-major order
+        # (ie the order of looping over the old grid)
+        self.pixels = np.flatnonzero(in_region)
+
+        # Find which point on the new grid each in-region point corresponds to (truncating, as int() does)
+        new_i = ((np.ravel(old_lon)[self.pixels] - min_lon) / dx).astype(int)
+        new_j = ((np.ravel(old_lat)[self.pixels] - min_lat) / dy).astype(int)
+        self.cells = np.ravel_multi_index((new_j, new_i), self.shape)
+
+        # Number of original points in each new grid point. Empty grid points are set to nan, which
+        # prevents division by zero warnings and leaves them as missing data.
+        count = np.bincount(self.cells, minlength=ncells).astype(float)
+        count[count==0] = np.nan
+        self.count = count
+
+    def crop(self, data):
+        """
+        Cut the window out of an array (or stack of arrays) on the full original grid
+
+        :param data: Array on the original grid, with the rows and columns as the last two dimensions
+        :return: The part of the array inside the window
+        """
+        xoffset, yoffset, width, height = self.window
+        return data[..., yoffset:yoffset+height, xoffset:xoffset+width]
+
+    def regrid(self, data):
+        """
+        Re-grid a data array, or a stack of data arrays, using this plan
+
+        The data can be either on the full original grid, or just the window of it (ie as read from the file
+        using :py:attr:`window`).
+
+        A stack of bands is regridded in one pass: each in-region value gets a combined (band, new grid point)
+        index, so a single scatter-add fills every band at once. np.bincount adds the values in the order they
+        are given, which is the same row-major order as looping over the old grid, so the result is identical
+        to accumulating each point in turn.
+
+        :param data: 2d array of data on the original grid, or 3d array with dimensions (nbands, rows, cols)
+        :return: array containing the mean value for each new grid point, with dimensions (nbands, nlat, nlon)
+                 if a stack of bands was given.
+        """
+        data = np.asarray(data, dtype=float)
+        if data.ndim == 2:
+            return self.regrid(data[np.newaxis])[0]
+        if data.shape[1:] == self.full_shape:
+            data = self.crop(data)
+
+        nbands = data.shape[0]
+        ncells = self.count.size
+        values = data.reshape(nbands, -1)[:, self.pixels]
+        index = np.arange(nbands)[:, np.newaxis]*ncells + self.cells
+        new_data = np.bincount(index.ravel(), weights=values.ravel(), minlength=nbands*ncells)
+        new_data = new_data.reshape(nbands, ncells) / self.count  # Take the mean
+        return new_data.reshape((nbands,) + self.shape)
@@ -6,6 +6,7 @@ Replace this with more appropriate tests for your application.
 """
 
 from django.test import TestCase
+from mock import patch
 from ingest_data.ingest import *
 import os
 
@@ -21,6 +22,38 @@ class InjestToolsTest(TestCase):
         """Check that read_data runs ok"""
         read_data(self.sampleData, self.instrument.id, self.filename)
         
+    def test_read_file_copy(self):
+        """Check that read_data saves the same measurements using COPY as with bulk_create"""
+        read_data(self.sampleData, self.instrument.id, self.filename, use_copy=True)
+        copied = sorted(Measurement.objects.values_list('value', 'measurement_type__type', 'wavelength__wavelength'))
+        Measurement.objects.all().delete()
+        read_data(open(self.testfile, "r"), self.instrument.id, self.filename)
+        created = sorted(Measurement.objects.values_list('value', 'measurement_type__type', 'wavelength__wavelength'))
+        self.assertEqual(len(copied), 2)
+        self.assertEqual(copied, created)
+
+    def test_read_rows(self):
+        """Check that read_rows strips blanks, and the extra semicolon at the end of NOMAD lines"""
+        from StringIO import StringIO
+        rows = list(read_rows(StringIO("a;b;c;\n 1 ; 2;3;\n\n4;5;6\n")))
+        self.assertEqual(rows, [['a', 'b', 'c'], ['1', '2', '3'], ['4', '5', '6']])
+
+    def test_read_chunks(self):
+        """Check that read_chunks groups rows into chunks of the requested size"""
+        self.assertEqual(list(read_chunks(iter(range(5)), 2)), [[0, 1], [2, 3], [4]])
+
+    def test_read_data_progress(self):
+        """Check that read_data reports its progress after each chunk"""
+        lines = self.sampleData.readlines()
+        row = lines[1].replace('matchup_id_test', 'matchup_id_test{0}')
+        from StringIO import StringIO
+        testdata = StringIO(lines[0] + ''.join(row.format(i) for i in range(5)))
+        progress = []
+        nrows = read_data(testdata, self.instrument.id, self.filename, chunk_size=2, progress=progress.append)
+        self.assertEqual(nrows, 5)
+        self.assertEqual(progress, [2, 4, 5])
+        self.assertEqual(Point.objects.count(), 5)
+
     def test_units_and_name(self):
         """Check that units_and_name returns the right format:
         a dictionary with keys 'units' and 'long_name', which both point to strings
@@ -28,6 +61,91 @@ class InjestToolsTest(TestCase):
         result = units_and_name('rho_w_IS')
         self.assertTrue( isinstance(result['units'], basestring) and isinstance(result['long_name'], basestring))
 
+
+class IngestSessionTest(TestCase):
+
+    def setUp(self):
+        self.header = ['MATCHUP_ID', 'Site', 'PI', 'Lat_IS', 'Lon_IS', 'TIME_IS', 'PQC', 'MQC', 'land_dist_IS',
+                       'Theta_S', 'Rho_wn_IS_412', 'Wind_speed_IS', 'Rho_wn_IS_443', 'not_a_measurement']
+
+    def test_parse_header(self):
+        """Check that parse_header finds the type and wavelength of each measurement column"""
+        columns = IngestSession().parse_header(self.header)
+        self.assertEqual([(j, t.type, (w.wavelength if w else None)) for j, t, w in columns],
+                         [(10, 'rho_wn_is', 412.0), (11, 'wind_speed_is', None), (12, 'rho_wn_is', 443.0)])
+
+    def test_no_duplicates(self):
+        """Check that sessions reuse existing types and wavelengths rather than creating new ones"""
+        IngestSession().parse_header(self.header)
+        IngestSession().parse_header(self.header)
+        self.assertEqual(MeasurementType.objects.count(), 2)
+        self.assertEqual(MeasurementWavelength.objects.count(), 2)
+
+    def test_types_created_concurrently(self):
+        """Check that types created by another session since they were looked up are used, rather than failing"""
+        other = MeasurementType.objects.create(type='wind_speed_is', units='m/s', long_name='Wind speed')
+        # The other session creates the type just after this one looked it up
+        lookups = [MeasurementType.objects.none(),
+                   MeasurementType.objects.filter(type__in=['rho_wn_is', 'wind_speed_is'])]
+        with patch.object(MeasurementType.objects, 'filter', side_effect=lookups):
+            columns = IngestSession().parse_header(self.header)
+        self.assertEqual([t.type for j, t, w in columns], ['rho_wn_is', 'wind_speed_is', 'rho_wn_is'])
+        self.assertEqual(columns[1][1].id, other.id)
+        self.assertEqual(MeasurementType.objects.count(), 2)
+
+    def test_cached(self):
+        """Check that once a session has looked up the foreign keys, it doesn't query the database again"""
+        session = IngestSession()
+        campaign = session.get_campaign('test')
+        session.parse_header(self.header)
+        session.get_deployments([('site', 'pi')], campaign)
+        with self.assertNumQueries(0):
+            session.get_campaign('test')
+            session.parse_header(self.header)
+            session.get_deployments([('site', 'pi')], campaign)
+
+    def test_non_ascii(self):
+        """Check that deployments and types with non-ASCII names are found again in the database, not duplicated"""
+        from StringIO import StringIO
+        instrument = Instrument.objects.create(name='Unknown')
+        data = ('MATCHUP_ID;Site;PI;Lat_IS;Lon_IS;TIME_IS;PQC;MQC;land_dist_IS;Theta_S;Temp\xc3\xa9rature_IS\n'
+                'matchup_id_test;Bouss\xc3\xa9;Ren\xc3\xa9e;0;0;10000101T000000Z;P00000000;M000000000000000000;0;0;1\n')
+        read_data(StringIO(data), instrument.id, 'extraction_Test_.csv')
+        read_data(StringIO(data), instrument.id, 'extraction_Test_.csv')
+        self.assertEqual(list(Deployment.objects.values_list('site', 'pi')), [(u'Bouss\xe9', u'Ren\xe9e')])
+        self.assertEqual(list(MeasurementType.objects.values_list('type', flat=True)), [u'temp\xe9rature_is'])
+        self.assertEqual(Measurement.objects.count(), 2)
+
+    def test_get_points(self):
+        """Check that get_points creates each distinct point once, in a constant number of queries"""
+        row = ['matchup_id_test', 'site_test', 'pi_test', '0', '0', '10000101T000000Z', 'P00000000',
+               'M000000000000000000', '0', '0']
+        other = list(row)
+        other[0] = 'other_matchup_id'
+        rows = [row, other, row, other, row]
+        session = IngestSession()
+        deployments = session.get_deployments([('site_test', 'pi_test')], session.get_campaign('test'))
+        with self.assertNumQueries(3):  # look up, bulk create, then look up again to get the new ids
+            point_ids = session.get_points(rows, deployments)
+        self.assertEqual(Point.objects.count(), 2)
+        self.assertEqual(point_ids[0], point_ids[2])
+        self.assertNotEqual(point_ids[0], point_ids[1])
+
+        # A new session should find the existing points rather than creating new ones
+        self.assertEqual(IngestSession().get_points(rows, deployments), point_ids)
+        self.assertEqual(Point.objects.count(), 2)
+
+    def test_get_points_non_ascii(self):
+        """Check that points with non-ASCII fields are found again in the database, not duplicated"""
+        row = ['matchup_\xc3\xa9t\xc3\xa9', 'site_test', 'pi_test', '0', '0', '10000101T000000Z', 'P00000000',
+               'M000000000000000000', '0', '0']
+        session = IngestSession()
+        deployments = session.get_deployments([('site_test', 'pi_test')], session.get_campaign('test'))
+        point_ids = session.get_points([row], deployments)
+        self.assertEqual(IngestSession().get_points([row, [field.decode('utf-8') for field in row]], deployments),
+                         point_ids * 2)
+        self.assertEqual(Point.objects.get().matchup_id, u'matchup_\xe9t\xe9')
+
         
 class DuplicationTests(TestCase):
     
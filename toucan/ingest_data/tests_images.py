@@ -9,6 +9,31 @@ from ingest_data.ingest_images import *
 from ingest_data.ingest_images_file_readers import *
 from ingest_data.ingest_images_geo_tools import *
 
+def loop_regrid(old_lon, old_lat, new_lon, new_lat, data):
+    """
+    Original pixel-by-pixel implementation of GeoTools.extract_region_and_regrid, kept as a
+    reference to check that the vectorised version gives exactly the same answer
+    """
+    dx = np.diff(new_lon)[0]
+    dy = np.diff(new_lat)[0]
+
+    new_data = np.zeros((len(new_lat), len(new_lon)))
+    count = np.zeros((len(new_lat), len(new_lon)))
+
+    in_region = (np.min(new_lon) <= old_lon) & (old_lon < np.max(new_lon)+dx) & \
+                (np.min(new_lat) <= old_lat) & (old_lat < np.max(new_lat)+dy)
+
+    for j in np.arange(old_lon.shape[0]):
+        for i in np.arange(old_lon.shape[1]):
+            if in_region[j,i]:
+                new_i = int((old_lon[j,i] - np.min(new_lon)) / dx)
+                new_j = int((old_lat[j,i] - np.min(new_lat)) / dy)
+                new_data[new_j, new_i] += data[j,i]
+                count[new_j, new_i] += 1
+    count[count==0] = np.nan
+    return new_data/count
+
+
 class InjestToolsSetup(TestCase):
     """Setup the test directory and files
     """
@@ -68,6 +93,24 @@ class InjestToolsTest(InjestToolsSetup):
                                        self.ingest.metadata['instrument'].upper(),str(self.ingest.metadata['datetime'].year))),
                           True)
 
+    def test_save_geotiff_existing_dir(self):
+        """
+        Check that saving a geotiff doesn't fail when another process has just created its directory
+        """
+        import datetime
+        import errno
+
+        self.ingest.metadata = {'region_name': 'Libya4', 'instrument': 'MERIS', 'filename': 'a.N1',
+                                'datetime': datetime.datetime(2006, 1, 1, 10, 0)}
+        self.ingest.data = {'longitude': np.arange(3.0), 'latitude': np.arange(3.0),
+                            'bands': np.zeros((2, 3, 3)), 'angles': np.zeros((4, 3, 3))}
+        with patch('ingest_data.ingest_images.GeoTools.array2raster') as mock:
+            with patch('os.makedirs', side_effect=OSError(errno.EEXIST, 'File exists')):
+                self.ingest.save_geotiff()
+            self.assertEqual(mock.call_count, 2)
+            with patch('os.makedirs', side_effect=OSError(errno.EACCES, 'Permission denied')):
+                self.assertRaises(OSError, self.ingest.save_geotiff)
+
     @unittest.skip('No X server running')  # to do, make a skipif 
     def test_make_quicklook(self):
         """
@@ -92,7 +135,135 @@ class InjestToolsTest(InjestToolsSetup):
         mock1.assert_called()
         mock2.assert_called_with(outfile)
 
+    def test_image_record(self):
+        """
+        Test that image_record copies the metadata and adds the mean viewing angles
+        """
+        self.ingest.metadata = {'filename': 'test.hdf'}
+        self.ingest.data = {'SZA': np.array([10.0, np.nan, 20.0]), 'SAA': np.zeros(3),
+                            'VZA': np.ones(3), 'VAA': np.ones(3)*2}
+        record = self.ingest.image_record()
+        self.assertEqual(record['filename'], 'test.hdf')
+        self.assertDictEqual(record['angles'], {'SZA': 15.0, 'SAA': 0.0, 'VZA': 1.0, 'VAA': 2.0})
+        self.assertFalse('angles' in self.ingest.metadata)
+
     # Save an object to the database, storing the metadata and the location of the geotiff
+    def test_register_images(self):
+        """
+        Test that register_images adds every record to the database, and tidies up each image file once
+        (after all its directions), and the metafile after the last one
+        """
+        records = [{'filename': 'a.N1', 'direction': 'fward'},
+                   {'filename': 'a.N1', 'direction': 'nadir'},
+                   {'filename': 'b.N1', 'direction': ''}]
+        with patch.object(IngestImages, 'add_to_database') as mock_db:
+            with patch.object(IngestImages, 'tidy_up') as mock_tidy:
+                self.ingest.register_images(records)
+        self.assertEqual(mock_db.call_count, 3)
+        self.assertEqual(mock_tidy.call_args_list, [call(meta=False), call(meta=True)])
+
+    def test_ingest_image_per_image(self):
+        """
+        Test that ingest_image registers each image as it is processed, and tidies up the metafile at the end
+        """
+        images = [[{'filename': 'a.N1'}], [{'filename': 'b.N1'}]]
+        with patch.object(IngestImages, 'iter_images', return_value=iter(images)):
+            with patch.object(IngestImages, 'register_images') as mock_db:
+                with patch.object(IngestImages, 'tidy_up') as mock_tidy:
+                    self.ingest.ingest_image('test.json')
+        self.assertEqual(mock_db.call_args_list, [call(images[0], meta=False), call(images[1], meta=False)])
+        mock_tidy.assert_called_once_with(meta=True, data=False)
+
+    def test_ingest_all_failure(self):
+        """
+        Test that a metafile failing to ingest is reported, and the others are still ingested
+        """
+        def fake_ingest(thisfile):
+            if thisfile == 'bad.json':
+                raise IOError('bad file')
+            return {}
+
+        with patch.object(IngestImages, 'get_file_list', return_value=['bad.json', 'good.json']):
+            with patch.object(IngestImages, 'ingest_image', side_effect=fake_ingest) as mock:
+                failures = self.ingest.ingest_all()
+        self.assertEqual(mock.call_count, 2)
+        self.assertEqual(failures.keys(), ['bad.json'])
+        self.assertIsInstance(failures['bad.json'], IOError)
+
+    def test_ingest_all_granule_failures(self):
+        """
+        Test that the images that fail are reported, and the other images of the same metafile are still
+        registered, with one worker or several
+        """
+        from django.db import connection
+
+        granules = {'a.json': ['a1.N1', 'bad.N1', 'a2.N1'], 'b.json': ['b1.N1', 'b2.N1']}
+
+        def fake_read_meta_file(ingest):
+            if ingest.metafile == 'unreadable.json':
+                raise ValueError('No JSON object could be decoded')
+            return [{'filename': filename, 'instrument': 'MERIS'} for filename in granules[ingest.metafile]]
+
+        def fake_image_records(ingest):
+            if ingest.metadata['filename'] == 'bad.N1':
+                raise IOError('bad granule')
+            return [dict(ingest.metadata)]
+
+        for workers in (1, 2):
+            tidied = []
+            with patch.object(IngestImages, 'get_file_list', return_value=['a.json', 'unreadable.json', 'b.json']), \
+                    patch.object(IngestImages, 'read_meta_file', autospec=True, side_effect=fake_read_meta_file), \
+                    patch.object(IngestImages, 'image_records', autospec=True, side_effect=fake_image_records), \
+                    patch.object(IngestImages, 'register_images') as mock_db, \
+                    patch.object(IngestImages, 'tidy_up', autospec=True,
+                                 side_effect=lambda ingest, **kwargs: tidied.append(ingest.metafile)), \
+                    patch.object(connection, 'close'):  # keep the test transaction open
+                failures = self.ingest.ingest_all(workers=workers)
+
+            self.assertEqual(sorted(failures), ['bad.N1', 'unreadable.json'], workers)
+            self.assertIsInstance(failures['bad.N1'], IOError)
+            self.assertIsInstance(failures['unreadable.json'], ValueError)
+            self.assertEqual(sorted(args[0][0]['filename'] for args, kwargs in mock_db.call_args_list),
+                             ['a1.N1', 'a2.N1', 'b1.N1', 'b2.N1'])
+            # Only the metafile with no failures is tidied up
+            self.assertEqual(tidied, ['b.json'])
+
+    def test_ingest_images_command(self):
+        """
+        Test the ingest_images command passes the number of workers on, from the option or the settings
+        """
+        from django.core.management import call_command
+
+        with patch.object(IngestImages, 'ingest_all', return_value={}) as mock:
+            call_command('ingest_images', 'input', 'output', workers=3)
+            with self.settings(INGEST_WORKERS=2):
+                call_command('ingest_images', 'input', 'output')
+        self.assertEqual(mock.call_args_list, [call(workers=3), call(workers=2)])
+
+    def test_add_to_database_statistics(self):
+        """
+        Test that add_to_database stores the statistics of the image bands, once
+        """
+        import datetime
+        from toucan_db.statistics import band_statistics
+
+        bands = np.ones((2, 3, 4))
+        bands[1, 0, :] = np.nan
+        self.ingest.metadata = {'region_name': 'Libya4', 'instrument': 'MERIS', 'vartype': 'reflectance',
+                                'wavelengths': [412.5, 442.5], 'region_coords': [27.0, 30.0, 21.0, 25.0],
+                                'archive_location': 'a.tif', 'web_location': 'a.jpg',
+                                'datetime': datetime.datetime(2006, 1, 1, 10, 0),
+                                'angles': {'SZA': 1.0, 'SAA': 2.0, 'VZA': 3.0, 'VAA': 4.0},
+                                'statistics': band_statistics(bands)}
+        self.ingest.add_to_database()
+        self.ingest.add_to_database()
+
+        statistics = ImageStatistics.objects.order_by('band')
+        self.assertEqual([stats.band for stats in statistics], [0, 1])
+        self.assertEqual(statistics[1].valid_count, 8)
+        self.assertAlmostEqual(statistics[1].valid_fraction, 8 / 12.0)
+        self.assertEqual(statistics[1].mean, 1.0)
+        self.assertEqual(statistics[1].area_mean, 1.0)
 
     # Remove ingested file to a temporary folder, which we will clear up offline (eg once a week)
     def test_tidy_up(self):
@@ -135,6 +306,114 @@ class GeoToolsTests(InjestToolsSetup):
         data = GeoTools.extract_region_and_regrid(old_lon, old_lat, new_lon, new_lat, np.ones(old_lon.shape))
         self.assertEqual(data.shape,(len(new_lon), len(new_lat)))
 
+    def test_regrid_matches_loop(self):
+        """
+        Test the vectorised regridding gives identical results to the pixel loop, on a skewed swath with missing data
+        """
+        rows, cols = np.mgrid[0:60, 0:80]
+        old_lon = 10 + 0.011*cols + 0.002*rows + 0.0005*np.sin(rows)
+        old_lat = 20 + 0.009*rows - 0.001*cols
+        data = np.random.RandomState(0).rand(*old_lon.shape)
+        data[5:9, 30:50] = np.nan
+        new_lon, new_lat = GeoTools.get_new_lat_lon(old_lon, old_lat, (20.1, 20.4, 10.2, 10.7))
+
+        expected = loop_regrid(old_lon, old_lat, new_lon, new_lat, data)
+        result = GeoTools.extract_region_and_regrid(old_lon, old_lat, new_lon, new_lat, data)
+        self.assertTrue(np.array_equal(np.isnan(result), np.isnan(expected)))
+        self.assertTrue(np.array_equal(result[~np.isnan(result)], expected[~np.isnan(expected)]))
+
+    def test_regrid_plan_reuse(self):
+        """
+        Test that one RegridPlan can be reused for several variables, giving the same result as regridding each alone
+        """
+        rows, cols = np.mgrid[0:30, 0:40]
+        old_lon = 0.1*cols + 0.01*rows
+        old_lat = 0.1*rows
+        new_lon, new_lat = GeoTools.get_new_lat_lon(old_lon, old_lat, (0.5, 2.0, 0.5, 3.0))
+        plan = RegridPlan(old_lon, old_lat, new_lon, new_lat)
+        for data in (np.ones(old_lon.shape), old_lon*old_lat, np.arange(old_lon.size).reshape(old_lon.shape)):
+            expected = loop_regrid(old_lon, old_lat, new_lon, new_lat, data)
+            result = plan.regrid(data)
+            self.assertEqual(result.shape, (len(new_lat), len(new_lon)))
+            self.assertTrue(np.array_equal(result[~np.isnan(result)], expected[~np.isnan(expected)]))
+
+    def test_regrid_stack(self):
+        """
+        Test that regridding a stack of bands in one go gives the same result as regridding each band separately
+        """
+        rows, cols = np.mgrid[0:30, 0:40]
+        old_lon = 0.1*cols + 0.01*rows
+        old_lat = 0.1*rows
+        new_lon, new_lat = GeoTools.get_new_lat_lon(old_lon, old_lat, (0.5, 2.0, 0.5, 3.0))
+        plan = RegridPlan(old_lon, old_lat, new_lon, new_lat)
+        stack = np.random.RandomState(0).rand(3, *old_lon.shape)
+        stack[1, 3:6, 10:20] = np.nan
+
+        result = plan.regrid(stack)
+        self.assertEqual(result.shape, (3, len(new_lat), len(new_lon)))
+        for band in range(3):
+            expected = plan.regrid(stack[band])
+            self.assertTrue(np.array_equal(np.isnan(result[band]), np.isnan(expected)))
+            self.assertTrue(np.array_equal(result[band][~np.isnan(expected)], expected[~np.isnan(expected)]))
+
+    def test_regrid_window(self):
+        """
+        Test that the plan's window covers the region, and that regridding just the window gives the same result
+        """
+        rows, cols = np.mgrid[0:50, 0:60]
+        old_lon = 0.1*cols + 0.01*rows
+        old_lat = 0.1*rows
+        new_lon, new_lat = GeoTools.get_new_lat_lon(old_lon, old_lat, (1.0, 2.0, 2.0, 3.0))
+        plan = RegridPlan(old_lon, old_lat, new_lon, new_lat)
+        xoffset, yoffset, width, height = plan.window
+        self.assertTrue(width < old_lon.shape[1] and height < old_lon.shape[0])
+
+        data = old_lon * old_lat
+        window = data[yoffset:yoffset+height, xoffset:xoffset+width]
+        expected = loop_regrid(old_lon, old_lat, new_lon, new_lat, data)
+        for result in (plan.regrid(window), plan.regrid(data)):
+            self.assertTrue(np.array_equal(np.isnan(result), np.isnan(expected)))
+            self.assertTrue(np.array_equal(result[~np.isnan(result)], expected[~np.isnan(expected)]))
+
+    def test_regrid_window_no_overlap(self):
+        """
+        Test that a region that doesn't overlap the original grid gives an all missing result
+        """
+        old_lon = np.tile(np.arange(10),(10,1))
+        old_lat = np.tile(np.arange(10),(10,1)).T
+        plan = RegridPlan(old_lon, old_lat, [20, 21, 22], [20, 21, 22])
+        self.assertEqual(plan.window, (0, 0, 1, 1))
+        self.assertTrue(np.isnan(plan.regrid(np.ones((1, 1)))).all())
+
+    def test_array2raster_stack(self):
+        """
+        Test that array2raster writes each band of a stack to its own GeoTiff band
+        """
+        stack = np.zeros((3, 4, 5))
+        with patch('ingest_data.ingest_images_geo_tools.gdal.GetDriverByName') as mock:
+            GeoTools.array2raster('test.tif', (0, 0), 1, 1, stack)
+        mock.return_value.Create.assert_called_with('test.tif', 5, 4, 3, gdal.GDT_Float32)
+        self.assertEqual(mock.return_value.Create.return_value.GetRasterBand.call_count, 3)
+
+    def test_regrid_matches_loop_sample_granule(self):
+        """
+        Test the vectorised regridding gives identical results to the pixel loop for the sample VIIRS granule
+        """
+        metadata = eval(open(self.testmeta).read())[0]
+        hdf = gdal.Open(str(metadata['filename']))
+        datasets = hdf.GetSubDatasets()
+        read = lambda name: gdal.Open([ds for ds,descr in datasets if ' '+name+' ' in descr][0]).ReadAsArray()
+        longitude = read('Longitude')
+        latitude = read('Latitude')
+        new_lon, new_lat = GeoTools.get_new_lat_lon(longitude, latitude, metadata['region_coords'])
+
+        for variable in ('SolarZenithAngle', 'Reflectance_M1'):
+            array = read(variable).astype(float)
+            expected = loop_regrid(longitude, latitude, new_lon, new_lat, array)
+            result = GeoTools.extract_region_and_regrid(longitude, latitude, new_lon, new_lat, array)
+            self.assertTrue(np.array_equal(np.isnan(result), np.isnan(expected)))
+            self.assertTrue(np.array_equal(result[~np.isnan(result)], expected[~np.isnan(expected)]))
+
 
 class FiletypeTests(InjestToolsSetup):
     """Tests for the various file types, to check that the correct method is called for each one
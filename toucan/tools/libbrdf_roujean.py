@@ -20,10 +20,11 @@ def main():
               'order_by': 'time',
               }
     Q = Querydb()
-    results = Q.get_images(search)
+    results = Q.get_image_arrays(search)
+    statistics = Q.get_image_statistics(search)
 
     brdf = RoujeanBRDF()
-    brdf.run(results)
+    brdf.run(results, statistics)
 
 
 class RoujeanBRDF(ToolBase):
@@ -35,28 +36,32 @@ class RoujeanBRDF(ToolBase):
     def __init__(self):
         pass
 
-    def run(self, jsonresults):
+    def run(self, jsonresults, statistics=None, workers=1):
         """
         Compute and plot BRDF. Take results from a database query, extract the reflectance
         values from the returned files, calculate BRDF timeseries, plot the timeseries, and
         output to a csv text file.
 
-        :param jsonresults: The results from a database query, as JSON format
+        :param jsonresults: The results from a database query, as JSON format or as arrays
+        :param statistics: [Optional] The statistics of the images, as returned by
+         :py:meth:`libquerydb.Querydb.get_image_statistics`, used instead of reading the files if they cover them
+        :param workers: [Optional] Number of files to read at the same time (default 1)
         """
 
         # -------------------------------
         # Extract fields we need
         # -------------------------------
-        files = np.array([result['archive_location'] for result in jsonresults])
-        dates = np.array([datetime.datetime.strptime(result['time'], '%Y-%m-%dT%H:%M:%S.%f') for result in jsonresults])
-        sun_zenith, sensor_zenith, relative_azimuth = libtools.get_angles(jsonresults)
-        instrument = jsonresults[0]['instrument']['name']
-        region = jsonresults[0]['region']['region']
+        columns = libtools.get_columns(jsonresults)
+        files = np.asarray(columns['archive_location'])
+        dates = libtools.get_dates(columns['time'])
+        sun_zenith, sensor_zenith, relative_azimuth = libtools.get_angles(columns)
+        instrument = columns['instrument__name'][0]
+        region = columns['region__region'][0]
 
         # -------------------------------
         # Read reflectance from the archived files
         # -------------------------------
-        reflectance_arr = libtools.get_mean_reflectance(files)
+        reflectance_arr = libtools.get_mean_reflectance(files, statistics, workers=workers)
 
         # -------------------------------
         # Get list of wavelengths
@@ -1,26 +1,165 @@
+import os
+import json
+import time
+import hashlib
 import requests
+import numpy as np
+from io import BytesIO
+
 
 class Querydb(object):
     """
     Perform queries on the TOUCAN database
+
+    Queries go through one pooled HTTP session, so the connections to the server are kept alive between them.
+    Long lists of results are fetched in pages of page_size, several pages at a time, and put back together.
+    Responses can also be cached on disk, so that tools repeating the same queries don't have to wait for the
+    server each time.
+
+    Tools running on the same host as the database can use the 'orm' backend instead of the default 'http' one.
+    The queries then go straight to the database through the Django ORM (see :py:class:`OrmBackend`), skipping
+    the web server, and give the same results.
+
+    The defaults can be set with environment variables, so that the tools (which make their own Querydb) use them:
+    TOUCAN_QUERYDB_BACKEND for the backend, TOUCAN_API_URL for the base URL, TOUCAN_QUERY_CACHE_DIR to turn on the
+    cache and TOUCAN_QUERY_CACHE_TTL for the time cached responses are kept.
     """
 
-    def __init__(self):
-        pass
+    def __init__(self, base_url=None, page_size=1000, workers=4, cache_dir=None, cache_ttl=None, backend=None):
+        """
+        :param base_url: [Optional] The URL of the API (default http://127.0.0.1:8000/api/v1/)
+        :param page_size: [Optional] Number of results to fetch with each request (default 1000)
+        :param workers: [Optional] Number of pages to fetch at the same time (default 4)
+        :param cache_dir: [Optional] Directory to cache responses in (default no caching)
+        :param cache_ttl: [Optional] Time in seconds that cached responses are used for (default 3600)
+        :param backend: [Optional] 'http' to query the API (default), or 'orm' to query the database directly
+        """
+        self.backend = backend or os.environ.get('TOUCAN_QUERYDB_BACKEND', 'http')
+        if self.backend not in ('http', 'orm'):
+            raise ValueError(self.backend + " not a valid Querydb backend, use 'http' or 'orm'")
+        self.orm = (OrmBackend() if self.backend == 'orm' else None)
 
-    @staticmethod
-    def get(url, params):
+        self.base_url = base_url or os.environ.get('TOUCAN_API_URL', 'http://127.0.0.1:8000/api/v1/')
+        if not self.base_url.endswith('/'):
+            self.base_url += '/'
+        self.page_size = page_size
+        self.workers = workers
+        self.cache_dir = cache_dir or os.environ.get('TOUCAN_QUERY_CACHE_DIR')
+        self.cache_ttl = float(cache_ttl or os.environ.get('TOUCAN_QUERY_CACHE_TTL', 3600))
+
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max(workers, 1))
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def fetch(self, resource, params):
         """
-        Do GET request and return objects
-        
-        :param url: The base URL for the query
+        Do GET request and return the content of the response, from the cache if there is a recent enough copy
+
+        :param resource: Name of the API resource, eg image
         :param params: Dictionary of search parameters, format search_parameter:value
-        :returns: JSON objects returned by the query
+        :returns: Content of the response
         """
-        r = requests.get(url, params=params)
+        url = self.base_url + resource + '/'
+        cache_file = None
+        if self.cache_dir:
+            key = json.dumps([url, sorted(params.items())])
+            cache_file = os.path.join(self.cache_dir, hashlib.sha1(key).hexdigest())
+            if os.path.isfile(cache_file) and time.time() - os.path.getmtime(cache_file) < self.cache_ttl:
+                with open(cache_file, 'rb') as cached:
+                    return cached.read()
+
+        r = self.session.get(url, params=params)
         # Raise error if status not ok
         r.raise_for_status()
-        return r.json()['objects']
+
+        if cache_file:
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            # Write to a temporary file first, so that other processes never read half a file
+            temp_file = '%s.%i.tmp' % (cache_file, os.getpid())
+            with open(temp_file, 'wb') as cached:
+                cached.write(r.content)
+            os.rename(temp_file, cache_file)
+        return r.content
+
+    def count(self, resource, params):
+        """
+        :param resource: Name of the API resource, eg image
+        :param params: Dictionary of search parameters
+        :returns: The number of results the query matches
+        """
+        content = self.fetch(resource, dict(params, format='json', limit=1))
+        return json.loads(content)['meta']['total_count']
+
+    def fetch_pages(self, resource, params, decode):
+        """
+        Fetch all the results of a query, a page at a time, fetching up to self.workers pages at once. The API
+        orders the results by primary key after any requested ordering, so the pages fit together without gaps
+        or repeats, even when results tie on the requested ordering.
+
+        :param resource: Name of the API resource, eg image
+        :param params: Dictionary of search parameters, including the format
+        :param decode: Function turning the content of a response into a page of results
+        :returns: List of the pages of results, in order
+        :raises IOError: if the server returned shorter pages than page_size, eg because its limit per page is
+         lower, which would leave gaps between the pages
+        """
+        offsets = range(0, self.count(resource, params), self.page_size) or [0]
+        page = lambda offset: decode(self.fetch(resource, dict(params, limit=self.page_size, offset=offset)))
+        if self.workers <= 1 or len(offsets) == 1:
+            pages = [page(offset) for offset in offsets]
+        else:
+            from multiprocessing.pool import ThreadPool
+            pool = ThreadPool(min(self.workers, len(offsets)))
+            try:
+                pages = pool.map(page, offsets)
+            finally:
+                pool.terminate()
+
+        # A page is a list of objects, or a dictionary of arrays
+        size = lambda page: len(page) if isinstance(page, list) else len(next(iter(page.values()), ()))
+        if any(size(page) < self.page_size for page in pages[:-1]):
+            raise IOError('The server returned fewer than %i results in a page of %s: reduce page_size to the '
+                          'limit per page of the server' % (self.page_size, resource))
+        return pages
+
+    def get(self, resource, params):
+        """
+        Do GET request and return objects, following the pagination to get all of them
+        
+        :param resource: Name of the API resource, eg image
+        :param params: Dictionary of search parameters, format search_parameter:value
+        :returns: JSON objects returned by the query
+        """
+        if self.orm:
+            return self.orm.get(resource, params)
+        pages = self.fetch_pages(resource, dict(params, format='json'),
+                                 lambda content: json.loads(content)['objects'])
+        return [result for page in pages for result in page]
+
+    def get_arrays(self, resource, params):
+        """
+        Do GET request for the results in the npz format, and return them as arrays
+
+        :param resource: Name of the API resource, eg image
+        :param params: Dictionary of search parameters, format search_parameter:value
+        :returns: Dictionary of arrays, one for each field. Fields of nested objects are named parent__field,
+         eg instrument__name
+        """
+        if self.orm:
+            return self.orm.get_arrays(resource, params)
+
+        def decode(content):
+            npz = np.load(BytesIO(content))
+            return dict((field, npz[field]) for field in npz.files)
+
+        pages = [page for page in self.fetch_pages(resource, dict(params, format='npz'), decode) if page]
+        if not pages:
+            return {}
+        # A field can be missing from a page, eg a nested object that is null for all of its results
+        fields = set.intersection(*[set(page) for page in pages])
+        return dict((field, np.concatenate([page[field] for page in pages])) for field in fields)
 
     def get_wavelengths(self, instrument):
         """
@@ -29,9 +168,8 @@ class Querydb(object):
         :param instrument: Instrument name, as it is spelled in the database
         :returns: List of wavelengths
         """
-        url = "http://127.0.0.1:8000/api/v1/instrumentwavelength/"
         params = {'instrument__name': instrument.lower()}
-        r = self.get(url, params)
+        r = self.get('instrumentwavelength', params)
 
         wavelengths = [result['value'] for result in r]
         return wavelengths
@@ -43,11 +181,37 @@ class Querydb(object):
         :param search_list: Dictionary of search parameters
         :returns: JSON query results
         """
-        url = "http://127.0.0.1:8000/api/v1/image/"
         params = self.construct_search_params(search_list)
-        r = self.get(url, params)
+        r = self.get('image', params)
         return r
 
+    def get_image_arrays(self, search_list):
+        """
+        Get the images matching the input search parameters, as arrays. This is much faster than
+        :py:meth:`get_images` for long lists of images, and the results can be passed to the tools in the same way.
+
+        :param search_list: Dictionary of search parameters
+        :returns: Dictionary of arrays, one for each field (see :py:meth:`get_arrays`)
+        """
+        params = self.construct_search_params(search_list)
+        return self.get_arrays('image', params)
+
+    def get_image_statistics(self, search_list):
+        """
+        Get the band statistics of the images matching the input search parameters, as arrays, one entry per
+        image and band. They can be passed to the tools with the images, so that the tools use them instead of
+        reading the rasters (see :py:func:`libtools.get_band_statistics`).
+
+        :param search_list: Dictionary of search parameters, as for :py:meth:`get_images`
+        :returns: Dictionary of arrays, one for each field (see :py:meth:`get_arrays`), including band and
+         image__archive_location
+        """
+        params = self.construct_search_params(search_list)
+        # The statistics are matched to the images by file, so their order doesn't matter
+        params.pop('order_by', None)
+        params = dict(('image__' + key, value) for key, value in params.items())
+        return self.get_arrays('imagestatistics', params)
+
     @staticmethod
     def construct_search_params(search_list):
         """
@@ -81,3 +245,96 @@ class Querydb(object):
                 raise KeyError(item+" not a valid search parameter")
 
         return params
+
+
+class OrmBackend(object):
+    """
+    Querydb backend running the queries directly against the database with the Django ORM, instead of through
+    the API. The search parameters are the same, and the results have the same structure, as JSON records or as
+    the arrays of the npz format, but no model instances, HTTP or JSON are involved.
+
+    The Django project must be on the python path; DJANGO_SETTINGS_MODULE defaults to toucan.settings.
+    Only the resources used by the tools are available.
+    """
+    # Model and fields returned for each resource. Fields of nested objects are named parent__field, as in the API
+    resources = {'image': ('Image', ('web_location', 'archive_location', 'top_left_point', 'bot_right_point', 'time',
+                                     'version', 'SZA', 'SAA', 'VZA', 'VAA', 'direction', 'instrument__name',
+                                     'region__region', 'measurement_type__type', 'measurement_type__units',
+                                     'measurement_type__long_name')),
+                 'instrumentwavelength': ('InstrumentWavelength', ('value', 'instrument__name')),
+                 'imagestatistics': ('ImageStatistics', ('band', 'mean', 'std', 'median', 'min', 'max',
+                                                         'area_mean', 'valid_count', 'valid_fraction',
+                                                         'image__archive_location', 'image__time')),
+                 }
+    # Parameters that control the API output, rather than filter the results
+    output_params = ('format', 'limit', 'offset', 'order_by')
+
+    def __init__(self):
+        os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'toucan.settings')
+
+    def query(self, resource, params):
+        """
+        Run the query for this resource
+
+        :param resource: Name of the API resource, eg image
+        :param params: Dictionary of search parameters, as for the API
+        :returns: The field names, and the list of rows
+        """
+        from toucan_db import models
+
+        try:
+            model, fields = self.resources[resource]
+        except KeyError:
+            raise KeyError(resource + " not available with the orm backend")
+        filters = dict((key, value) for key, value in params.items() if key not in self.output_params)
+        queryset = getattr(models, model).objects.filter(**filters)
+        if 'order_by' in params:
+            queryset = queryset.order_by(*params['order_by'].split(','))
+        return fields, list(queryset.values_list(*fields))
+
+    def get(self, resource, params):
+        """
+        :param resource: Name of the API resource, eg image
+        :param params: Dictionary of search parameters
+        :returns: List of records, as given by the API in JSON format
+        """
+        import datetime
+        from django.utils import timezone
+
+        def convert(value):
+            # Times and geometries as the API formats them
+            if isinstance(value, datetime.datetime):
+                if timezone.is_aware(value):
+                    value = timezone.make_naive(value, timezone.get_current_timezone())
+                return value.strftime('%Y-%m-%dT%H:%M:%S.%f')
+            if hasattr(value, 'wkt'):
+                return unicode(value)
+            return value
+
+        fields, rows = self.query(resource, params)
+        records = []
+        for row in rows:
+            record = {}
+            for field, value in zip(fields, row):
+                parents = field.split('__')
+                nested = record
+                for parent in parents[:-1]:
+                    nested = nested.setdefault(parent, {})
+                nested[parents[-1]] = convert(value)
+            records.append(record)
+        return records
+
+    def get_arrays(self, resource, params):
+        """
+        :param resource: Name of the API resource, eg image
+        :param params: Dictionary of search parameters
+        :returns: Dictionary of arrays, one for each field, as given by the API in npz format
+        """
+        from toucan_db.serializers import to_column
+
+        fields, rows = self.query(resource, params)
+        if not rows:
+            return {}
+        columns = zip(*rows)
+        return dict((field, to_column([(unicode(value) if hasattr(value, 'wkt') else value) for value in column]))
+                    for field, column in zip(fields, columns))
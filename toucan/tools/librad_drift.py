@@ -17,20 +17,34 @@ def main():
               'end_date': '2006-12-31',
               'order_by': 'time',
               }
-    reference = Q.get_images(search)
+    reference = Q.get_image_arrays(search)
+
+    statistics = {'reference': Q.get_image_statistics(search)}
 
     search['sensor'] = 'meris'
-    target = Q.get_images(search)
+    target = Q.get_image_arrays(search)
+    statistics['target'] = Q.get_image_statistics(search)
 
     drift = RadiometricDrift()
-    drift.run(reference, target)
+    drift.run(reference, target, statistics)
 
 
 class RadiometricDrift(ToolBase):
     """
     Class for computing radiometric drift
     """
-    def run(self, reference, target):
+    def run(self, reference, target, statistics=None, workers=1):
+        """
+        Compute the radiometric drift of the target sensor against the reference sensor, for each of the target
+        bands with a reference band close to it, plot it, and save it to a csv text file.
+
+        :param reference: The results from a database query for the reference sensor, as JSON format or as arrays
+        :param target: The results from a database query for the target sensor, as for the reference
+        :param statistics: [Optional] The statistics of the images, in a dictionary with reference and target keys,
+         as returned by :py:meth:`libquerydb.Querydb.get_image_statistics`. Where they cover all the images
+         and bands needed, they are used instead of reading the files.
+        :param workers: [Optional] Number of files to read at the same time (default 1)
+        """
         # User specifies reference sensor and target sensor, date range, and site
         jsonresults = {'reference': reference,
                        'target': target
@@ -66,9 +80,14 @@ class RadiometricDrift(ToolBase):
         # If we do, carry on and process that band,
         # else skip to the next one
         # -------------------------------
-        ref_ratio_all = []
-        drift_all = []
-        bands = []
+        # -------------------------------
+        # Candidate doublets are found using the
+        # dates and angular matching criteria, which
+        # are the same for all the bands
+        # -------------------------------
+        candidates = libtools.get_doublet_candidates(data['reference'], data['target'], amc_threshold=15)
+
+        matches = []
         for target_idx, target_band in enumerate(wavelengths['target']):
             ref_idx = np.argmin(np.abs(np.array(wavelengths['reference'] - target_band)))
             ref_band = wavelengths['reference'][ref_idx]
@@ -76,32 +95,59 @@ class RadiometricDrift(ToolBase):
             if np.abs(target_band - ref_band) > 10:
                 pass
             else:
-                band_idx = {'reference': ref_idx, 'target': target_idx}
-                bands.append(target_band)
-                # -------------------------------
-                # Read reflectance from geotiffs
-                # -------------------------------
-                for sensor in ('reference', 'target'):
-                    data[sensor]['reflectance'] = libtools.get_reflectance_band(data[sensor]['files'], band_idx[sensor])
-
-                # -------------------------------
-                # Doublets are found using angular matching criteria
-                # -------------------------------
-                doublets, doublet_times = libtools.get_doublets(data['reference'], data['target'], amc_threshold=15)
-
-                # -------------------------------
-                # Timeseries of drift is calculated
-                # -------------------------------
-                ref_ratio = self.get_drift_timeseries(data, doublets)
-                ref_ratio_all.append(ref_ratio)
-
-                # -------------------------------
-                # Plot displayed and/or saved
-                # -------------------------------
-                savename = 'drift_%s_ref_%s_%i.png' % (instrument['target'], instrument['reference'], target_band)
-                drift = self.plot_radiometric_drift(doublet_times, ref_ratio, instrument['target'], 
-                                                    instrument['reference'], target_band, savename)
-                drift_all.append(drift)
+                matches.append({'reference': ref_idx, 'target': target_idx})
+
+        # -------------------------------
+        # Get the mean reflectance and coverage
+        # from the image statistics, or else
+        # compute them from the geotiffs, all
+        # the matched bands in one pass over
+        # each sensor's files, reducing each
+        # file as it is read
+        # -------------------------------
+        statistics = statistics or {}
+        reflectance = {}
+        coverage = {}
+        for sensor in ('reference', 'target'):
+            band_indices = [match[sensor] for match in matches]
+            reflectance[sensor] = libtools.get_band_statistics(data[sensor]['files'], statistics.get(sensor),
+                                                               band_indices, 'mean')
+            coverage[sensor] = libtools.get_band_statistics(data[sensor]['files'], statistics.get(sensor),
+                                                            band_indices, 'valid_fraction')
+            if reflectance[sensor] is None or coverage[sensor] is None:
+                reduced = libtools.read_bands(data[sensor]['files'], band_indices, reducer=libtools.mean_coverage,
+                                              workers=workers)
+                reflectance[sensor], coverage[sensor] = reduced[:, 0], reduced[:, 1]
+
+        ref_ratio_all = []
+        drift_all = []
+        bands = []
+        for match_idx, band_idx in enumerate(matches):
+            target_band = wavelengths['target'][band_idx['target']]
+            bands.append(target_band)
+            for sensor in ('reference', 'target'):
+                data[sensor]['reflectance'] = reflectance[sensor][:, match_idx]
+                data[sensor]['coverage'] = coverage[sensor][:, match_idx]
+
+            # -------------------------------
+            # Doublets are the candidates with enough
+            # ROI coverage in this band
+            # -------------------------------
+            doublets, doublet_times = libtools.filter_doublets(data['reference'], data['target'], candidates)
+
+            # -------------------------------
+            # Timeseries of drift is calculated
+            # -------------------------------
+            ref_ratio = self.get_drift_timeseries(data, doublets)
+            ref_ratio_all.append(ref_ratio)
+
+            # -------------------------------
+            # Plot displayed and/or saved
+            # -------------------------------
+            savename = 'drift_%s_ref_%s_%i.png' % (instrument['target'], instrument['reference'], target_band)
+            drift = self.plot_radiometric_drift(doublet_times, ref_ratio, instrument['target'], 
+                                                instrument['reference'], target_band, savename)
+            drift_all.append(drift)
 
         # -------------------------------
         # Text file saved
@@ -116,16 +162,17 @@ class RadiometricDrift(ToolBase):
         Extract fields that we need from the JSON object
         and return as a dictionary
         
-        :param jsonresults: The results from a database query, as JSON format
+        :param jsonresults: The results from a database query, as JSON format or as arrays
         :returns: Dictionary containing all the data
         """
-        files = np.array([result['archive_location'] for result in jsonresults])
-        dates = np.array([datetime.datetime.strptime(result['time'], '%Y-%m-%dT%H:%M:%S.%f') for result in jsonresults])
-        angles = libtools.get_angles(jsonresults)
+        columns = libtools.get_columns(jsonresults)
+        files = np.asarray(columns['archive_location'])
+        dates = libtools.get_dates(columns['time'])
+        angles = libtools.get_angles(columns)
         sun_zenith, sensor_zenith, relative_azimuth = np.rad2deg(angles)
         # Make the instrument and region fields lists, so that they work when we take timeslice later
-        instrument = np.tile(jsonresults[0]['instrument']['name'], (len(files)))
-        region = np.tile(jsonresults[0]['region']['region'], (len(files)))
+        instrument = np.tile(columns['instrument__name'][0], (len(files)))
+        region = np.tile(columns['region__region'][0], (len(files)))
 
         # Create dictionary holding all fields
         data = {'files': files,
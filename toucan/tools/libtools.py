@@ -37,17 +37,58 @@ def mean_date(dates):
     return mean_date
 
 
+def get_columns(results):
+    """
+    Arrange the results of a database query as columns, ie a dictionary of arrays, one for each field.
+    Results that are already in columns (as returned by :py:meth:`libquerydb.Querydb.get_image_arrays`) are
+    returned as they are. For JSON results, the fields of nested objects are named parent__field, as in
+    the arrays, eg instrument__name.
+
+    :param results: JSON results (list of records) or dictionary of arrays
+    :returns: Dictionary of arrays
+    """
+    if isinstance(results, dict):
+        return results
+
+    def flatten(record, prefix=''):
+        flat = {}
+        for key, value in record.items():
+            if isinstance(value, dict):
+                flat.update(flatten(value, prefix + key + '__'))
+            else:
+                flat[prefix + key] = value
+        return flat
+
+    records = [flatten(result) for result in results]
+    keys = set(key for record in records for key in record)
+    return {key: np.array([record.get(key) for record in records]) for key in keys}
+
+
+def get_dates(times):
+    """
+    Convert the times of the database query results to an array of datetime objects
+
+    :param times: Array of datetime64, or of time strings as formatted in the JSON results
+    :returns: Array of python datetimes
+    """
+    times = np.asarray(times)
+    if np.issubdtype(times.dtype, np.datetime64):
+        return times.astype('datetime64[us]').astype(datetime.datetime)
+    return np.array([datetime.datetime.strptime(time, '%Y-%m-%dT%H:%M:%S.%f') for time in times])
+
+
 def get_angles(jsonresults):
     """
-    Extract the viewing angle information from the JSON object returned
+    Extract the viewing angle information from the results returned
     from the database
 
-    :param jsonresults: JSON formatted string result from database query
+    :param jsonresults: JSON formatted string result from database query, or the results as arrays
     :returns: sun zenith angle, sensor zenith angle, relative azimuth angle (in radians)
     """
+    columns = get_columns(jsonresults)
     angles = {}
     for angle in ('SZA', 'SAA', 'VZA', 'VAA'):
-        angles[angle] = np.array([entry[angle] for entry in jsonresults])
+        angles[angle] = np.asarray(columns[angle], dtype=float)
 
     sun_zenith = scipy.deg2rad(angles['SZA'])
     sensor_zenith = scipy.deg2rad(angles['VZA'])
@@ -60,101 +101,294 @@ def get_angles(jsonresults):
     return sun_zenith, sensor_zenith, relative_azimuth
 
 
-def get_mean_reflectance(filelist):
+def read_file_bands(thisfile, band_indices=None, reducer=None):
+    """
+    Read reflectance bands from one GeoTiff file, opening it once for all the bands
+
+    :param thisfile: File name to read
+    :param band_indices: [Optional] Indices of the bands to read (0-based), default all the bands
+    :param reducer: [Optional] Function reducing the bands, an array of nbands x rows x cols, eg :py:func:`area_mean`
+    :returns: Array of reflectances, dimensions nbands x rows x cols, or the result of the reducer
+    """
+    image = gdal.Open(thisfile)
+    if band_indices is None:
+        data = image.ReadAsArray()
+        if data.ndim == 2:   # Single band file
+            data = data[np.newaxis]
+    else:
+        data = np.array([image.GetRasterBand(band_idx + 1).ReadAsArray()   # convert to 1 based index
+                         for band_idx in band_indices])
+    image = None
+
+    if reducer is not None:
+        data = reducer(data)
+    return data
+
+
+def iter_file_bands(filelist, band_indices=None, reducer=None, workers=1):
+    """
+    Read reflectance bands from a list of GeoTiff files with :py:func:`read_file_bands`, one file after another.
+
+    With more than one worker, several files are read at the same time by a pool of threads (GDAL releases the
+    GIL while it reads), which is much faster when the reads wait on the storage rather than the CPU. The
+    results are in the same order either way.
+
+    :param filelist: List of file names to read
+    :param band_indices: [Optional] Indices of the bands to read (0-based), default all the bands
+    :param reducer: [Optional] Function reducing the bands of each file (see :py:func:`read_file_bands`)
+    :param workers: [Optional] Number of files to read at the same time (default 1)
+    :returns: Iterator over the reflectances of each file
+    """
+    read = lambda thisfile: read_file_bands(thisfile, band_indices, reducer)
+    if workers <= 1 or len(filelist) <= 1:
+        for thisfile in filelist:
+            yield read(thisfile)
+        return
+
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(workers)
+    try:
+        for data in pool.imap(read, filelist):
+            yield data
+    finally:
+        pool.terminate()
+
+
+def read_bands(filelist, band_indices=None, reducer=None, workers=1):
+    """
+    Read reflectance bands from a list of GeoTiff files into one array. Each file is opened once, and all the
+    bands needed are read from it, into an array allocated once for all the files.
+
+    Without a reducer, all the files must be the same size; read images of different sizes (eg regridded to
+    different grids) with :py:func:`iter_file_bands`, or reduce them.
+
+    :param filelist: List of file names to read
+    :param band_indices: [Optional] Indices of the bands to read (0-based), default all the bands
+    :param reducer: [Optional] Function reducing the bands of one file, an array of nbands x rows x cols, to one
+     value per band, eg :py:func:`area_mean`
+    :param workers: [Optional] Number of files to read at the same time (see :py:func:`iter_file_bands`, default 1)
+    :returns: Array of reflectances, dimensions nfiles x nbands x rows x cols, or nfiles x nbands with a reducer
+    :raises ValueError: if the files don't all give the same shape of array
+    """
+    reflectance_arr = None
+    for file_idx, data in enumerate(iter_file_bands(filelist, band_indices, reducer, workers)):
+        if reflectance_arr is None:
+            reflectance_arr = np.empty((len(filelist),) + data.shape, dtype=data.dtype)
+        elif data.shape != reflectance_arr.shape[1:]:
+            raise ValueError('%s has shape %s, but %s has shape %s: read files of different sizes with '
+                             'iter_file_bands, or reduce them' % (filelist[file_idx], data.shape, filelist[0],
+                                                                   reflectance_arr.shape[1:]))
+        reflectance_arr[file_idx] = data
+
+    if reflectance_arr is None:
+        return np.empty((0, 0))
+    return reflectance_arr
+
+
+def area_mean(data):
+    """
+    Area mean of each band of an image, ignoring NaNs: the mean over the rows, then over the columns. It is
+    computed in double precision, as the area_mean of the image statistics is.
+
+    :param data: Array of reflectances, dimensions nbands x rows x cols
+    :returns: Array of the area mean of each band
+    """
+    data = np.asarray(data, dtype=float)
+    return np.nanmean(np.nanmean(data, axis=1), axis=1)
+
+
+def mean_coverage(data):
+    """
+    Mean of the valid pixels of each band of an image, and the fraction of the pixels that are valid (its ROI
+    coverage), as stored in the image statistics
+
+    :param data: Array of reflectances, dimensions nbands x rows x cols
+    :returns: Array of dimensions 2 x nbands, the means then the valid fractions
+    """
+    data = data.reshape((len(data), -1))
+    return np.array([np.nanmean(data, axis=1), np.mean(~np.isnan(data), axis=1)])
+
+
+def get_band_statistics(filelist, statistics, band_indices=None, field='mean'):
+    """
+    Look up a summary statistic of the bands of a list of GeoTiff files in the statistics stored at ingest,
+    without reading the files.
+
+    :param filelist: List of file names (archive locations)
+    :param statistics: The statistics of the images, as returned by :py:meth:`libquerydb.Querydb.get_image_statistics`
+    :param band_indices: [Optional] Indices of the bands (0-based), default all the bands
+    :param field: [Optional] The statistic, eg mean, area_mean, median or valid_fraction (default mean)
+    :returns: Array of the statistic, dimensions nfiles x nbands, or None if it is missing for any of the files
+     or bands, in which case the files need to be read
+    """
+    if not statistics or field not in statistics:
+        return None
+    bands = np.asarray(statistics['band']).astype(int)
+    if band_indices is None:
+        band_indices = range(bands.max() + 1)
+    lookup = dict(((thisfile, band), value) for thisfile, band, value
+                  in zip(statistics['image__archive_location'], bands, statistics[field]))
+    try:
+        return np.array([[lookup[(thisfile, band)] for band in band_indices] for thisfile in filelist], dtype=float)
+    except KeyError:
+        return None
+
+
+def get_mean_reflectance(filelist, statistics=None, workers=1):
     """
     Read in reflectance data from list of GeoTiff files, and compute the area mean
     for each band for each file.
 
+    If the statistics of the files are given, and cover all of them, their area means are used instead of
+    reading the files. They are computed the same way, so both give the same values.
+
     :param filelist: List of file names to read
+    :param statistics: [Optional] The statistics of the images (see :py:func:`get_band_statistics`)
+    :param workers: [Optional] Number of files to read at the same time (see :py:func:`read_bands`, default 1)
     :returns: Array of reflectances, dimensions nbands x nfiles
     """
-    def read_file(thisfile):
-        """
-        Function to open Geotiff and read data as array
-        Returns area mean
-        """
-        image = gdal.Open(thisfile)
-        data = image.ReadAsArray()
-        arr = np.nanmean(np.nanmean(data, axis=1), axis=1)
-        image = None
-        return arr
-
-    # Loop over all the files and read reflectances
-    first = True
-    for thisfile in filelist:
-        dat = read_file(thisfile)
-        if first:
-            reflectance_arr = dat
-            first = False
-        else:
-            reflectance_arr = np.vstack([reflectance_arr, dat])
-
+    reflectance_arr = get_band_statistics(filelist, statistics, field='area_mean')
+    if reflectance_arr is None:
+        reflectance_arr = read_bands(filelist, reducer=area_mean, workers=workers)
     # Return the array, transposed so first dimension is the band
     return reflectance_arr.T
 
 
-def get_reflectance_band(filelist, band_idx):
+def get_reflectance_band(filelist, band_idx, workers=1):
     """
     Read in reflectance data for specified band from a list of GeoTiff files and return a list of 2d reflectance arrays
 
     :param filelist: List of file names to read
     :param band_idx: Index of the band to read (0-based)
-    :returns: List (nfiles long) of 2d reflectance arrays
+    :param workers: [Optional] Number of files to read at the same time (see :py:func:`iter_file_bands`, default 1)
+    :returns: List (nfiles long) of 2d reflectance arrays, which can be of different sizes
     """
-    def read_file(thisfile):
-        """
-        Function to open Geotiff and read the specified band as 2d array
-        """
-        image = gdal.Open(thisfile)
-        data = image.GetRasterBand(band_idx + 1).ReadAsArray()  # convert to 1 based index
-        image = None
-        return data
-
-    # Loop over all the files and read reflectances
-    reflectance_list = []
-    for thisfile in filelist:
-        dat = read_file(thisfile)
-        reflectance_list.append(dat)
-
-    return reflectance_list
+    return [data[0] for data in iter_file_bands(filelist, [band_idx], workers=workers)]
 
 
 def get_doublets(reference, target, amc_threshold=15, day_threshold=3, roi_threshold=0.75):
     """
     Get doublets that fit the angular matching criteria
 
+    This is done in two stages: :py:func:`get_doublet_candidates` finds the pairs of images that meet the date and
+    AMC criteria, which don't depend on the band, and :py:func:`filter_doublets` keeps the ones that meet the ROI
+    coverage criterion for the band being processed. To process several bands, find the candidates once and
+    filter them for each band.
+
     :param reference: Dictionary containing the reference sensor data
     :param target: Dictionary containing the target sensor data
     :param amc_threshold: [Optional] Threshold value to use for AMC (default 15)
     :param day_threshold: [Optional] Threshold value for time offset allowed, in days (default 3)
     :param roi_threshold: [Optional] Minimum ROI coverage allowed as a fraction (default 0.75)
     :returns: List of index pairs (ie index of the image in the reference and target image lists),
-     and list of the mean time for each doublet.
-    """
-    maxdays = datetime.timedelta(days=day_threshold)
-    doublets = []
-    times = []
-
-    # Loop over each target sensor image
-    for target_idx,_ in enumerate(target['dates']):
-        # Find which reference images are within the day threshold. These are the ones we'll check
-        target_date = target['dates'][target_idx]
-        candidates = np.where(np.abs(reference['dates'] - target_date) < maxdays)[0]
-
-        # Loop through these candidates and see if they fulfil all criteria to be a match
-        for ref_idx in candidates:
-            # Get just this pair of images from the dictionaries
-            reference_image = slice_dictionary(reference, ref_idx)
-            target_image = slice_dictionary(target, target_idx)
-            valid = check_doublet(reference_image, target_image, amc_threshold, day_threshold, roi_threshold)
-            # Check if this pair of images meets the criteria to be a doublet
-            # and store the indices if so. Also store the mean date for plotting
-            if valid:
-                doublets.append((target_idx, ref_idx))
-                # Get the mean time for the two images
-                times.append(mean_date((target_image['dates'], reference_image['dates'])))
-
-    return doublets, times
+     and list of the mean time for each doublet. The pairs are ordered by target index, then reference index.
+    """
+    candidates = get_doublet_candidates(reference, target, amc_threshold, day_threshold)
+    return filter_doublets(reference, target, candidates, roi_threshold)
+
+
+def get_doublet_candidates(reference, target, amc_threshold=15, day_threshold=3):
+    """
+    Find the pairs of images that meet the doublet criteria which don't depend on the band: the date and AMC
+    criteria of :py:func:`check_doublet`.
+
+    The reference dates are sorted, so that the reference images within the day threshold of each target image
+    are found by binary search (see :py:func:`get_candidates`). The criteria are then checked for all these pairs
+    at once, with array operations, rather than pair by pair.
+
+    :param reference: Dictionary containing the reference sensor data (dates and viewing angles)
+    :param target: Dictionary containing the target sensor data (dates and viewing angles)
+    :param amc_threshold: [Optional] Threshold value to use for AMC (default 15)
+    :param day_threshold: [Optional] Threshold value for time offset allowed, in days (default 3)
+    :returns: Arrays of the target indices, the reference indices and the mean dates of the pairs, ordered by
+     target index then reference index
+    """
+    target_idx, ref_idx = get_candidates(reference['dates'], target['dates'], day_threshold)
+
+    # Check AMC. NaN angles give a NaN AMC, which doesn't fail the test (as in check_doublet)
+    amc = calc_amc((np.asarray(reference['SZA'])[ref_idx], np.asarray(target['SZA'])[target_idx]),
+                   (np.asarray(reference['VZA'])[ref_idx], np.asarray(target['VZA'])[target_idx]),
+                   (np.asarray(reference['RAA'])[ref_idx], np.asarray(target['RAA'])[target_idx]))
+    with np.errstate(invalid='ignore'):
+        valid = ~(amc > amc_threshold)
+
+    # Check dates, in whole days as timedelta.days does
+    date_diff = np.abs(to_microseconds(reference['dates'])[ref_idx] - to_microseconds(target['dates'])[target_idx])
+    valid &= ~(date_diff // to_microseconds(datetime.timedelta(days=1)) > day_threshold)
+
+    order = np.lexsort((ref_idx[valid], target_idx[valid]))
+    target_idx, ref_idx = target_idx[valid][order], ref_idx[valid][order]
+    # Get the mean time for the two images, for plotting
+    times = np.empty(len(target_idx), dtype=object)
+    times[:] = [mean_date((target['dates'][t_idx], reference['dates'][r_idx]))
+                for t_idx, r_idx in zip(target_idx, ref_idx)]
+
+    return target_idx, ref_idx, times
+
+
+def filter_doublets(reference, target, candidates, roi_threshold=0.75):
+    """
+    Keep the candidate doublets that meet the ROI coverage criterion of :py:func:`check_doublet`, for the
+    reflectance of the band being processed
+
+    :param reference: Dictionary containing the reference sensor data, with the reflectance of this band, and
+     optionally its ROI coverage for each image under the key 'coverage'
+    :param target: Dictionary containing the target sensor data, as for the reference
+    :param candidates: Candidate doublets, as returned by :py:func:`get_doublet_candidates`
+    :param roi_threshold: [Optional] Minimum ROI coverage allowed as a fraction (default 0.75)
+    :returns: List of index pairs (ie index of the image in the reference and target image lists),
+     and list of the mean time for each doublet
+    """
+    target_idx, ref_idx, times = candidates
+
+    # Check ROI coverage, computed once for each image unless it is given (from the image statistics)
+    coverage = lambda data: (np.asarray(data['coverage']) if 'coverage' in data else
+                             np.array([float(np.sum(~np.isnan(arr))) / arr.size for arr in data['reflectance']]))
+    valid = ~(coverage(reference)[ref_idx] < roi_threshold)
+    valid &= ~(coverage(target)[target_idx] < roi_threshold)
+
+    doublets = [(int(t_idx), int(r_idx)) for t_idx, r_idx in zip(target_idx[valid], ref_idx[valid])]
+    return doublets, list(times[valid])
+
+
+def get_candidates(reference_dates, target_dates, day_threshold):
+    """
+    Find all the pairs of reference and target images less than day_threshold days apart
+
+    :param reference_dates: Array of the reference image dates (datetimes)
+    :param target_dates: Array of the target image dates (datetimes)
+    :param day_threshold: Time offset allowed, in days
+    :returns: Arrays of the target indices and of the reference indices of the pairs
+    """
+    reference_times = to_microseconds(reference_dates)
+    target_times = to_microseconds(target_dates)
+    maxdays = to_microseconds(datetime.timedelta(days=day_threshold))
+
+    # For each target image, the candidates are a window of the sorted reference dates
+    order = np.argsort(reference_times, kind='mergesort')
+    sorted_times = reference_times[order]
+    first = np.searchsorted(sorted_times, target_times - maxdays, side='right')
+    last = np.searchsorted(sorted_times, target_times + maxdays, side='left')
+    counts = np.maximum(last - first, 0)
+
+    # Expand the windows into the list of pairs
+    target_idx = np.repeat(np.arange(len(target_times)), counts)
+    position = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    ref_idx = order[np.repeat(first, counts) + position]
+
+    return target_idx, ref_idx
+
+
+def to_microseconds(dates):
+    """
+    Convert dates or a time offset to integer microseconds, so that they can be compared exactly in arrays
+
+    :param dates: Array of datetimes, or a timedelta
+    :returns: Array of microseconds since 1970, or the number of microseconds of the timedelta
+    """
+    if isinstance(dates, datetime.timedelta):
+        return (dates.days * 86400 + dates.seconds) * 10**6 + dates.microseconds
+    return np.asarray(dates, dtype='datetime64[us]').astype(np.int64)
 
 
 def check_doublet(reference, target, amc_threshold, day_threshold, roi_threshold):
@@ -0,0 +1,147 @@
+from django.test import TestCase
+from mock import *
+from io import BytesIO
+import numpy as np
+import json
+import shutil
+import tempfile
+
+from tools import libquerydb
+
+
+class QuerydbTests(TestCase):
+    """
+    Test the database query library
+    """
+    def setUp(self):
+        self.results = [{'value': float(i)} for i in range(25)]
+        self.requests = []
+        self.max_limit = None
+
+    def fake_get(self, url, params):
+        """
+        Stand in for the server: returns a page of self.results, in the requested format
+        """
+        self.requests.append((url, params))
+        if self.max_limit:
+            params = dict(params, limit=min(params['limit'], self.max_limit))
+        page = self.results[params['offset']:params['offset'] + params['limit']] if 'offset' in params \
+            else self.results[:params['limit']]
+        response = Mock()
+        if params['format'] == 'json':
+            response.content = json.dumps({'meta': {'total_count': len(self.results)}, 'objects': page})
+        else:
+            npz = BytesIO()
+            np.savez_compressed(npz, value=np.array([result['value'] for result in page]))
+            response.content = npz.getvalue()
+        return response
+
+    def test_base_url(self):
+        """
+        Test that the base URL can be set, and is used for all the queries
+        """
+        q = libquerydb.Querydb(base_url='http://example.com/api/v1', workers=1)
+        with patch.object(q.session, 'get', side_effect=self.fake_get):
+            q.get('image', {})
+        self.assertTrue(all(url == 'http://example.com/api/v1/image/' for url, params in self.requests))
+
+    def test_pagination(self):
+        """
+        Test that all the pages are fetched and put back together in order, with and without concurrent requests
+        """
+        for workers in (1, 3):
+            q = libquerydb.Querydb(page_size=10, workers=workers)
+            with patch.object(q.session, 'get', side_effect=self.fake_get):
+                self.assertEqual(q.get('measurement', {'point__matchup_id': 'test'}), self.results)
+                arrays = q.get_arrays('measurement', {})
+            np.testing.assert_array_equal(arrays['value'], np.arange(25))
+        offsets = sorted(params['offset'] for url, params in self.requests if params['format'] == 'npz')
+        self.assertEqual(offsets, [0, 0, 10, 10, 20, 20])
+
+    def test_page_size_above_server_limit(self):
+        """
+        Test that pages cut short by the server's limit per page are an error, rather than gaps in the results
+        """
+        self.max_limit = 10
+        for workers in (1, 3):
+            q = libquerydb.Querydb(page_size=20, workers=workers)
+            with patch.object(q.session, 'get', side_effect=self.fake_get):
+                self.assertRaises(IOError, q.get, 'measurement', {})
+                self.assertRaises(IOError, q.get_arrays, 'measurement', {})
+        q = libquerydb.Querydb(page_size=10, workers=3)
+        with patch.object(q.session, 'get', side_effect=self.fake_get):
+            self.assertEqual(q.get('measurement', {}), self.results)
+
+    def test_cache(self):
+        """
+        Test that repeated queries are read from the cache, until it expires
+        """
+        cache_dir = tempfile.mkdtemp()
+        try:
+            q = libquerydb.Querydb(page_size=10, workers=1, cache_dir=cache_dir, cache_ttl=60)
+            with patch.object(q.session, 'get', side_effect=self.fake_get):
+                first = q.get('measurement', {})
+                nrequests = len(self.requests)
+                self.assertEqual(q.get('measurement', {}), first)
+                self.assertEqual(len(self.requests), nrequests)
+                # Different parameters aren't in the cache
+                q.get('measurement', {'point__matchup_id': 'test'})
+                self.assertGreater(len(self.requests), nrequests)
+
+                q.cache_ttl = 0
+                nrequests = len(self.requests)
+                q.get('measurement', {})
+                self.assertGreater(len(self.requests), nrequests)
+        finally:
+            shutil.rmtree(cache_dir)
+
+
+class OrmBackendTests(TestCase):
+    """
+    Test that the orm backend gives the same results as the API
+    """
+    def setUp(self):
+        from toucan_db.models import Instrument, InstrumentWavelength, ImageRegion, MeasurementType, Image
+        from django.utils import timezone
+        import datetime
+
+        instrument = Instrument.objects.create(name='meris')
+        region = ImageRegion.objects.create(region='libya4')
+        measurement_type = MeasurementType.objects.create(type='reflectance', units='dl', long_name='Reflectance')
+        for i in range(5):
+            InstrumentWavelength.objects.create(value=400 + 10 * i, instrument=instrument)
+            Image.objects.create(web_location='', archive_location='image%i' % i, top_left_point='POINT(0 0)',
+                                 bot_right_point='POINT(1 1)',
+                                 time=datetime.datetime(2006, 5, 17 + i, 10, 1, 2, 345, tzinfo=timezone.utc),
+                                 instrument=instrument, measurement_type=measurement_type, region=region,
+                                 SZA=10 + i, SAA=20, VZA=30, VAA=40 + i)
+        self.search = {'site': 'Libya4', 'sensor': 'MERIS', 'end_date': '2006-05-20', 'order_by': 'time'}
+
+    def test_get_images(self):
+        q = libquerydb.Querydb(backend='orm')
+        params = q.construct_search_params(self.search)
+        api = json.loads(self.client.get('/api/v1/image/', dict(params, format='json')).content)['objects']
+        orm = q.get_images(self.search)
+
+        self.assertEqual(len(orm), 3)
+        for api_record, orm_record in zip(api, orm):
+            self.assertItemsEqual(orm_record.keys(), api_record.keys())
+            for key in ('archive_location', 'time', 'SZA', 'VAA', 'instrument', 'region', 'measurement_type'):
+                self.assertEqual(orm_record[key], api_record[key], key)
+        self.assertEqual(sorted(q.get_wavelengths('meris')), [400, 410, 420, 430, 440])
+
+    def test_get_image_arrays(self):
+        q = libquerydb.Querydb(backend='orm')
+        params = q.construct_search_params(self.search)
+        npz = np.load(BytesIO(self.client.get('/api/v1/image/', dict(params, format='npz')).content))
+        arrays = q.get_image_arrays(self.search)
+
+        self.assertItemsEqual(arrays.keys(), npz.files)
+        for key in ('archive_location', 'time', 'SZA', 'instrument__name', 'region__region'):
+            np.testing.assert_array_equal(arrays[key], npz[key], key)
+
+    def test_backend_switch(self):
+        with patch.dict('os.environ', {'TOUCAN_QUERYDB_BACKEND': 'orm'}):
+            self.assertIsNotNone(libquerydb.Querydb().orm)
+        self.assertIsNone(libquerydb.Querydb(backend='http').orm)
+        self.assertRaises(ValueError, libquerydb.Querydb, backend='ftp')
@@ -37,6 +37,27 @@ class RadiometricDriftTests(TestCase):
             data = librad_drift.RadiometricDrift.extract_fields(testjson)
         self.assertDictEqual(data, expected_data)
 
+    def test_extract_fields_arrays(self):
+        """
+        Test that results in arrays (npz format) give the same fields as JSON results
+        """
+        dates = [datetime.datetime(2000, 1, 1), datetime.datetime(2000, 1, 2, 3)]
+        testjson = [{'archive_location': 'file%i' % i, 'time': date.strftime('%Y-%m-%dT%H:%M:%S.%f'),
+                     'SZA': 10. * i, 'SAA': 20., 'VZA': 30., 'VAA': 250., 'instrument': {'name': 'meris'},
+                     'region': {'region': 'libya4'}} for i, date in enumerate(dates)]
+        testarrays = {'archive_location': np.array(['file0', 'file1']),
+                      'time': np.array(dates, dtype='datetime64[us]'),
+                      'SZA': np.array([0., 10.]), 'SAA': np.array([20., 20.]),
+                      'VZA': np.array([30., 30.]), 'VAA': np.array([250., 250.]),
+                      'instrument__name': np.array(['meris', 'meris']),
+                      'region__region': np.array(['libya4', 'libya4'])}
+
+        from_json = librad_drift.RadiometricDrift.extract_fields(testjson)
+        from_arrays = librad_drift.RadiometricDrift.extract_fields(testarrays)
+        self.assertItemsEqual(from_json.keys(), from_arrays.keys())
+        for key in from_json:
+            np.testing.assert_array_equal(from_json[key], from_arrays[key], key)
+
     def test_region_check(self):
         """
         Check that exception is raised if target and reference regions don't match (and not if they do)
@@ -6,6 +6,24 @@ import datetime
 from tools import libtools
 
 
+def loop_doublets(reference, target, amc_threshold=15, day_threshold=3, roi_threshold=0.75):
+    """
+    Reference doublet matcher: check every pair of images with check_doublet, as get_doublets used to
+    """
+    maxdays = datetime.timedelta(days=day_threshold)
+    doublets = []
+    times = []
+    for target_idx, target_date in enumerate(target['dates']):
+        candidates = np.where(np.abs(reference['dates'] - target_date) < maxdays)[0]
+        for ref_idx in candidates:
+            reference_image = libtools.slice_dictionary(reference, ref_idx)
+            target_image = libtools.slice_dictionary(target, target_idx)
+            if libtools.check_doublet(reference_image, target_image, amc_threshold, day_threshold, roi_threshold):
+                doublets.append((target_idx, ref_idx))
+                times.append(libtools.mean_date((target_image['dates'], reference_image['dates'])))
+    return doublets, times
+
+
 class ToolsTests(TestCase):
     """
     Test the shared tools library
@@ -40,6 +58,28 @@ class ToolsTests(TestCase):
         self.assertEquals(sensor_zenith, 0)
         self.assertEquals(relative_azimuth, 0)
 
+    def test_get_columns(self):
+        """
+        Test that JSON results are arranged in the same columns as the npz results, and that arrays are unchanged
+        """
+        testjson = [{'SZA': 10, 'time': '2000-01-01T00:00:00.000000', 'instrument': {'name': 'meris'}},
+                    {'SZA': 20, 'time': '2000-01-02T12:00:00.000000', 'instrument': {'name': 'meris'}}]
+        columns = libtools.get_columns(testjson)
+        self.assertItemsEqual(columns.keys(), ['SZA', 'time', 'instrument__name'])
+        np.testing.assert_array_equal(columns['SZA'], [10, 20])
+        np.testing.assert_array_equal(columns['instrument__name'], ['meris', 'meris'])
+        self.assertIs(libtools.get_columns(columns), columns)
+
+    def test_get_dates(self):
+        """
+        Test that dates are the same from JSON time strings and from datetime64 arrays
+        """
+        expected = [datetime.datetime(2000, 1, 1), datetime.datetime(2000, 1, 2, 12, 0, 0, 5)]
+        strings = libtools.get_dates(['2000-01-01T00:00:00.000000', '2000-01-02T12:00:00.000005'])
+        arrays = libtools.get_dates(np.array(expected, dtype='datetime64[us]'))
+        self.assertEqual(list(strings), expected)
+        self.assertEqual(list(arrays), expected)
+
     def test_get_mean_reflectance(self):
         """
         Test get_mean_reflectance returns correct array shape
@@ -74,6 +114,164 @@ class ToolsTests(TestCase):
         # Check the arrays in the list have correct dimensions
         self.assertEquals(out[0].shape, (nx, ny))
 
+    def test_read_bands(self):
+        """
+        Test read_bands opens each file once, and returns the bands asked for
+        """
+        fake_files = ('file1', 'file2', 'file3')
+        bands = np.arange(4 * 2 * 3, dtype=float).reshape((4, 2, 3))
+
+        with patch('osgeo.gdal.Open') as mock:
+            mock.return_value.GetRasterBand.side_effect = \
+                lambda band: Mock(**{'ReadAsArray.return_value': bands[band - 1]})
+            out = libtools.read_bands(fake_files, [3, 0])
+            self.assertEquals(mock.call_count, len(fake_files))
+            self.assertEquals(out.shape, (len(fake_files), 2, 2, 3))
+            self.assertTrue((out[1] == bands[[3, 0]]).all())
+
+            means = libtools.read_bands(fake_files, [3, 0], reducer=libtools.area_mean)
+            self.assertEquals(means.shape, (len(fake_files), 2))
+            self.assertTrue((means[2] == [bands[3].mean(), bands[0].mean()]).all())
+
+    def test_read_bands_sizes(self):
+        """
+        Test files of different sizes can be reduced, or read as a list of bands, but not into one array
+        """
+        fake_files = ('small', 'large')
+        images = {'small': np.arange(2 * 2 * 3, dtype=float).reshape((2, 2, 3)),
+                  'large': np.arange(2 * 4 * 5, dtype=float).reshape((2, 4, 5))}
+        images['large'][1, :2] = np.nan
+
+        def fake_open(thisfile):
+            image = images[thisfile]
+            return Mock(**{'ReadAsArray.return_value': image,
+                           'GetRasterBand.side_effect':
+                               lambda band: Mock(**{'ReadAsArray.return_value': image[band - 1]})})
+
+        with patch('osgeo.gdal.Open', side_effect=fake_open):
+            self.assertRaises(ValueError, libtools.read_bands, fake_files)
+            self.assertRaises(ValueError, libtools.read_bands, fake_files, [1], workers=2)
+
+            bands = libtools.get_reflectance_band(fake_files, 1, workers=2)
+            self.assertEquals([band.shape for band in bands], [(2, 3), (4, 5)])
+
+            np.testing.assert_array_equal(libtools.get_mean_reflectance(fake_files),
+                                          [[2.5, 9.5], [8.5, 34.5]])
+            reduced = libtools.read_bands(fake_files, [1], reducer=libtools.mean_coverage)
+            np.testing.assert_array_equal(reduced[:, 0], [[8.5], [34.5]])
+            np.testing.assert_array_equal(reduced[:, 1], [[1.0], [0.5]])
+
+    def test_read_bands_workers(self):
+        """
+        Test that reading the files in parallel gives the results in the same order as reading them one at a time
+        """
+        import time
+        fake_files = ['file%i' % i for i in range(20)]
+
+        def fake_open(thisfile):
+            # The first files are the slowest to read, so they finish last
+            index = int(thisfile[4:])
+            time.sleep((len(fake_files) - index) * 0.002)
+            return Mock(**{'ReadAsArray.return_value': np.full((2, 3, 3), index, dtype=float)})
+
+        with patch('osgeo.gdal.Open', side_effect=fake_open):
+            expected = libtools.get_mean_reflectance(fake_files)
+            for workers in (2, 8):
+                np.testing.assert_array_equal(libtools.get_mean_reflectance(fake_files, workers=workers), expected)
+            np.testing.assert_array_equal(expected[0], np.arange(20))
+
+    def test_get_band_statistics(self):
+        """
+        Test the image statistics are arranged by file and band, and used instead of reading the files if complete
+        """
+        statistics = {'image__archive_location': np.array(['file2', 'file1', 'file2', 'file1']),
+                      'band': np.array([1, 0, 0, 1]),
+                      'mean': np.array([4.0, 1.0, 3.0, 2.0]),
+                      'area_mean': np.array([4.5, 1.5, 3.5, 2.5])}
+        out = libtools.get_band_statistics(('file1', 'file2'), statistics)
+        np.testing.assert_array_equal(out, [[1.0, 2.0], [3.0, 4.0]])
+        np.testing.assert_array_equal(libtools.get_band_statistics(('file2',), statistics, [1]), [[4.0]])
+        self.assertIsNone(libtools.get_band_statistics(('file1', 'file3'), statistics))
+        self.assertIsNone(libtools.get_band_statistics(('file1',), statistics, field='median'))
+
+        with patch('osgeo.gdal.Open') as mock:
+            np.testing.assert_array_equal(libtools.get_mean_reflectance(('file1', 'file2'), statistics),
+                                          [[1.5, 3.5], [2.5, 4.5]])
+            self.assertFalse(mock.called)
+
+    def test_get_mean_reflectance_statistics(self):
+        """
+        Test the mean reflectance is the same from the image statistics as from the files, when the columns have
+        different numbers of NaNs
+        """
+        from toucan_db.statistics import band_statistics
+
+        rng = np.random.RandomState(0)
+        images = {}
+        statistics = {'image__archive_location': [], 'band': [], 'area_mean': []}
+        for thisfile in ('file1', 'file2', 'file3'):
+            image = rng.rand(3, 5, 4).astype(np.float32)
+            image[rng.rand(3, 5, 4) < 0.4] = np.nan
+            image[2, :, 1] = np.nan   # A column with no valid pixels
+            images[thisfile] = image
+            for band, stats in enumerate(band_statistics(image)):
+                statistics['image__archive_location'].append(thisfile)
+                statistics['band'].append(band)
+                statistics['area_mean'].append(stats['area_mean'])
+            self.assertNotEqual(stats['area_mean'], stats['mean'])
+
+        with patch('osgeo.gdal.Open', side_effect=lambda thisfile: Mock(**{'ReadAsArray.return_value':
+                                                                               images[thisfile]})) as mock:
+            from_files = libtools.get_mean_reflectance(sorted(images))
+            self.assertEquals(mock.call_count, len(images))
+            from_statistics = libtools.get_mean_reflectance(sorted(images), statistics)
+            self.assertEquals(mock.call_count, len(images))
+        self.assertEquals(from_statistics.shape, (3, 3))
+        np.testing.assert_allclose(from_statistics, from_files, rtol=1e-12)
+
+    def test_get_doublets(self):
+        """
+        Test that get_doublets gives the same doublets and times as checking every pair of images
+        """
+        rng = np.random.RandomState(0)
+
+        def sensor(nimages):
+            start = datetime.datetime(2002, 1, 1)
+            hours = rng.randint(0, 24*200, nimages)
+            dates = np.array([start + datetime.timedelta(hours=int(hour)) for hour in hours])
+            dates[::7] = dates[0]   # Some images at the same time
+            reflectance = []
+            for i in range(nimages):
+                image = rng.rand(4, 4)
+                image[rng.rand(4, 4) < rng.rand() * 0.5] = np.nan
+                reflectance.append(image)
+            data = {'dates': dates, 'SZA': rng.rand(nimages) * 40, 'VZA': rng.rand(nimages) * 40,
+                    'RAA': rng.rand(nimages) * 180 - 90, 'reflectance': reflectance}
+            data['SZA'][::11] = np.nan
+            return data
+
+        reference, target = sensor(200), sensor(150)
+        for thresholds in ({}, {'amc_threshold': 20, 'day_threshold': 1.5, 'roi_threshold': 0.6}, {'day_threshold': 0}):
+            expected = loop_doublets(reference, target, **thresholds)
+            result = libtools.get_doublets(reference, target, **thresholds)
+            self.assertEqual(result, expected)
+
+        # Candidates found once can be filtered for each band
+        candidates = libtools.get_doublet_candidates(reference, target)
+        for band in range(2):
+            for data in (reference, target):
+                for image in data['reflectance']:
+                    image[rng.rand(*image.shape) < 0.2] = np.nan
+            self.assertEqual(libtools.filter_doublets(reference, target, candidates),
+                             loop_doublets(reference, target))
+
+        # The coverage can be given, from the image statistics
+        expected = libtools.filter_doublets(reference, target, candidates)
+        for data in (reference, target):
+            data['coverage'] = [np.mean(~np.isnan(image)) for image in data['reflectance']]
+            data['reflectance'] = [np.nanmean(image) for image in data['reflectance']]
+        self.assertEqual(libtools.filter_doublets(reference, target, candidates), expected)
+
     def test_check_doublet(self):
         """
         Test that check doublet returns correct results
@@ -26,6 +26,16 @@ DATABASES = {
     }
 }
 
+# The choice lists (toucan_db.choices) are cached, and cleared when their tables change. The cache is kept in
+# the database so that every server process sees the same lists, and a change made in one process clears them
+# for all of them. Create the table with: python manage.py createcachetable toucan_cache
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'toucan_cache',
+    }
+}
+
 # Hosts/domain names that are valid for this site; required if DEBUG is False
 # See https://docs.djangoproject.com/en/1.5/ref/settings/#allowed-hosts
 ALLOWED_HOSTS = []
@@ -178,6 +188,12 @@ HAYSTACK_CONNECTIONS = {
     },
 }
 
+# Directory where uploaded in-situ files are kept until the process_uploads command ingests them
+UPLOAD_STAGING_DIR = os.path.abspath(os.path.join(DIR, '..', 'staging'))
+
+# Number of processes the ingest_images command uses to process the images, unless given with --workers
+INGEST_WORKERS = 1
+
 API_LIMIT_PER_PAGE = 0
 TASTYPIE_DEFAULT_FORMATS = ['json']
 
@@ -16,6 +16,7 @@ v1_api.register(MeasurementTypeResource())
 v1_api.register(MeasurementWavelengthResource())
 v1_api.register(MeasurementResource())
 v1_api.register(ImageResource())
+v1_api.register(ImageStatisticsResource())
 
 urlpatterns = patterns('',
     # Examples:
@@ -24,11 +25,14 @@ urlpatterns = patterns('',
     #url(r'^search_data/$', 'toucan_db.views.search_data'),
     #url(r'^add_data/$', 'toucan_db.views.add_data'),
     url(r'^add_data/$', 'toucan_db.views.upload_data'),
+    url(r'^upload_status/(\d+)/$', 'toucan_db.views.upload_status'),
     url(r'^add_instrument/$', 'toucan_db.views.add_instrument'),
     url(r'^add_wavelengths/(\w+)/(\d+)$', 'toucan_db.views.add_wavelengths'),
     #(r'^search/', include('haystack.urls')),
     url(r'^search_measurement/$', 'toucan_db.views.search_measurement'),
+    url(r'^search_measurement/results/$', 'toucan_db.views.measurement_results'),
     url(r'^search_point/$', 'toucan_db.views.search_point'),
+    url(r'^search_point/results/$', 'toucan_db.views.point_results'),
     
     #url(r'^add_image/$', 'toucan_db.views.add_image'),
     #url(r'^see_image/$', 'toucan_db.views.see_image'),
@@ -2,11 +2,133 @@ from tastypie.resources import ModelResource
 from tastypie.contrib.gis.resources import ModelResource as ModelResourceGeoDjango
 from tastypie import fields
 from toucan_db.models import *
+from toucan_db.serializers import ColumnarSerializer
+from toucan_db.spatial import filter_bbox, bbox_polygon, parse_bbox
+from tastypie.exceptions import BadRequest
 from tastypie.constants import ALL, ALL_WITH_RELATIONS
+from tastypie.utils import trailing_slash
+from django.conf.urls import url
+from django.http import StreamingHttpResponse
+from django.db.models import Q
 import math
 
 
-class DeploymentResource(ModelResource):
+class BboxFilterMixin(object):
+    """
+    Adds a bounding box filter to a resource: bbox=lat_min,lon_min,lat_max,lon_max keeps the results whose point
+    is inside the box. It is answered from the spatial index (see :py:func:`toucan_db.spatial.filter_bbox`), in
+    the same query as the other filters, eg time_is or deployment.
+    bbox_point is the path from the resource's model to its Point, or None for the points themselves.
+    """
+    bbox_point = None
+
+    def apply_filters(self, request, applicable_filters):
+        objects = super(BboxFilterMixin, self).apply_filters(request, applicable_filters)
+        bbox = request.GET.get('bbox') if request is not None else None
+        if not bbox:
+            return objects
+        try:
+            bbox = parse_bbox(bbox)
+        except ValueError as error:
+            raise BadRequest(str(error))
+        if self.bbox_point is None:
+            return filter_bbox(objects, *bbox)
+        return objects.filter(**{self.bbox_point + '__point__bboverlaps': bbox_polygon(*bbox)})
+
+
+class TotalOrderingMixin(object):
+    """
+    Orders the lists by the primary key after the requested ordering, if any. The order of the results is then
+    the same for every request, so that reading a list a page at a time (by offset, eg with Querydb) doesn't
+    skip or repeat the results that tie on the requested ordering, eg images at the same time.
+    """
+    def apply_sorting(self, obj_list, options=None):
+        obj_list = super(TotalOrderingMixin, self).apply_sorting(obj_list, options=options)
+        return obj_list.order_by(*(list(obj_list.query.order_by) + ['pk']))
+
+
+def keyset_after(fields, values, pk):
+    """
+    Filter keeping the objects that come after a given one, in the order of these fields then the primary key.
+    Nulls are taken to sort as PostgreSQL sorts them: after the other values in ascending order, before them in
+    descending order.
+
+    :param fields: The order_by fields (without the primary key), '-' in front for a descending order
+    :param values: The values of these fields for the given object
+    :param pk: The primary key of the given object
+    :return: Q object
+    """
+    after = Q(pk__gt=pk)
+    for field, value in reversed(zip(fields, values)):
+        name = field.lstrip('-')
+        descending = field.startswith('-')
+        if value is None:
+            same = Q(**{name + '__isnull': True})
+            beyond = Q(**{name + '__isnull': False}) if descending else None
+        else:
+            same = Q(**{name: value})
+            beyond = (Q(**{name + '__lt': value}) if descending else
+                      Q(**{name + '__gt': value}) | Q(**{name + '__isnull': True}))
+        after = (same & after) if beyond is None else (beyond | (same & after))
+    return after
+
+
+class StreamingMixin(object):
+    """
+    Adds a streaming mode to the list endpoint of a resource: with ?stream=ndjson, the objects are written one JSON
+    record per line as they are read, instead of serialising the whole list in memory first. The objects are read
+    from the database in chunks of stream_chunk_size, so the memory used doesn't depend on the number of results.
+    The usual filters and ordering apply; limit and offset are ignored, as all the results are streamed.
+    """
+    stream_chunk_size = 1000
+
+    def dispatch_list(self, request, **kwargs):
+        if request.method != 'GET' or request.GET.get('stream') != 'ndjson':
+            return super(StreamingMixin, self).dispatch_list(request, **kwargs)
+
+        self.method_check(request, allowed=['get'])
+        self.is_authenticated(request)
+        self.throttle_check(request)
+
+        base_bundle = self.build_bundle(request=request)
+        objects = self.obj_get_list(bundle=base_bundle, **self.remove_api_resource_names(kwargs))
+        self.log_throttled_access(request)
+        return StreamingHttpResponse(self.stream_records(request, objects), content_type='application/x-ndjson')
+
+    def stream_chunks(self, request, objects):
+        """
+        Read the objects a chunk at a time, by keyset pagination: each chunk starts after the last object of the
+        previous one, which stays fast however far into the results we are. Without an ordering, chunks are read
+        by primary key. With an ordering, they are read by the requested ordering, then the primary key so that
+        the order is total.
+
+        :param request: The request, holding the order_by options
+        :param objects: The filtered queryset
+        :return: Generator of lists of objects
+        """
+        fields = []
+        if 'order_by' in request.GET:
+            objects = self.apply_sorting(objects, options=request.GET)
+            fields = [field for field in objects.query.order_by if field.lstrip('-') != 'pk']
+        objects = objects.order_by(*(fields + ['pk']))
+        names = [field.lstrip('-') for field in fields]
+
+        chunk = list(objects[:self.stream_chunk_size])
+        while chunk:
+            yield chunk
+            last = chunk[-1].pk
+            values = objects.filter(pk=last).values_list(*names)[0] if names else ()
+            chunk = list(objects.filter(keyset_after(fields, values, last))[:self.stream_chunk_size])
+
+    def stream_records(self, request, objects):
+        """Generator giving the dehydrated objects as lines of JSON"""
+        for chunk in self.stream_chunks(request, objects):
+            for obj in chunk:
+                bundle = self.full_dehydrate(self.build_bundle(obj=obj, request=request), for_list=True)
+                yield self.serialize(None, bundle, 'application/json') + '\n'
+
+
+class DeploymentResource(TotalOrderingMixin, ModelResource):
     class Meta:
         queryset = Deployment.objects.all()
         excludes = ['id']
@@ -20,7 +142,7 @@ class DeploymentResource(ModelResource):
         }
         
 
-class InstrumentResource(ModelResource):
+class InstrumentResource(TotalOrderingMixin, ModelResource):
     class Meta:
         queryset = Instrument.objects.all()
         excludes = ['id']
@@ -31,25 +153,26 @@ class InstrumentResource(ModelResource):
         }     
 
 
-class InstrumentWavelengthResource(ModelResource):
+class InstrumentWavelengthResource(TotalOrderingMixin, ModelResource):
     instrument = fields.ForeignKey(InstrumentResource, 'instrument', full=True)
 
     class Meta:
-        queryset = InstrumentWavelength.objects.all()
+        queryset = InstrumentWavelength.objects.select_related('instrument')
         excludes = ['id']
         include_resource_uri = False
         filtering = {
             'instrument': ALL_WITH_RELATIONS,
             'value': ALL,
         }
+        max_limit = None
 
 
-class PointResource(ModelResourceGeoDjango):
+class PointResource(TotalOrderingMixin, BboxFilterMixin, StreamingMixin, ModelResourceGeoDjango):
 
     deployment = fields.ForeignKey(DeploymentResource, 'deployment', full=True)
     
     class Meta:
-        queryset = Point.objects.all()
+        queryset = Point.objects.select_related('deployment')
         excludes = ['id']
         include_resource_uri = False
         filtering = { 
@@ -61,7 +184,7 @@ class PointResource(ModelResourceGeoDjango):
         max_limit = None
       
          
-class MeasurementTypeResource(ModelResource):
+class MeasurementTypeResource(TotalOrderingMixin, ModelResource):
     class Meta:
         queryset = MeasurementType.objects.all()
         excludes = ['id']
@@ -76,7 +199,7 @@ class MeasurementTypeResource(ModelResource):
         }
 
 
-class MeasurementWavelengthResource(ModelResource):
+class MeasurementWavelengthResource(TotalOrderingMixin, ModelResource):
     class Meta:
         queryset = MeasurementWavelength.objects.all()
         excludes = ['id']
@@ -86,7 +209,7 @@ class MeasurementWavelengthResource(ModelResource):
         }
         
                      
-class MeasurementResource(ModelResource):
+class MeasurementResource(TotalOrderingMixin, BboxFilterMixin, StreamingMixin, ModelResource):
 
     point = fields.ForeignKey(PointResource, 'point', full=True)
     instrument = fields.ForeignKey(InstrumentResource, 'instrument', full=True)
@@ -94,7 +217,10 @@ class MeasurementResource(ModelResource):
     wavelength = fields.ForeignKey(MeasurementWavelengthResource, 'wavelength', full=True, null=True)
     
     class Meta:
-        queryset = Measurement.objects.all()
+        # Join the nested resources in the same query, rather than one query each for every measurement
+        queryset = Measurement.objects.select_related('point__deployment', 'instrument', 'measurement_type',
+                                                      'wavelength')
+        serializer = ColumnarSerializer()
         excludes = ['id']
         include_resource_uri = False
         filtering = { 
@@ -104,14 +230,83 @@ class MeasurementResource(ModelResource):
         }
         max_limit = None
 
+    bbox_point = 'point'
+
+    # Columns of the flat export, and the fields they are read from
+    flat_columns = (('matchup_id', 'point__matchup_id'),
+                    ('lat', 'lat'),
+                    ('lon', 'lon'),
+                    ('time', 'point__time_is'),
+                    ('site', 'point__deployment__site'),
+                    ('type', 'measurement_type__type'),
+                    ('wavelength', 'wavelength__wavelength'),
+                    ('value', 'value'))
+
     def dehydrate(self, bundle):
         if math.isnan(bundle.data['value']):
             bundle.data['value'] = -999
 
         return bundle       
 
+    def prepend_urls(self):
+        return [
+            url(r"^(?P<resource_name>%s)/flat%s$" % (self._meta.resource_name, trailing_slash()),
+                self.wrap_view('get_flat'), name="api_measurement_flat"),
+        ]
 
-class ImageRegionResource(ModelResource):
+    def get_flat(self, request, **kwargs):
+        """
+        Flat export of the measurements, as one list per column (see flat_columns) rather than nested objects.
+        Takes the same filters and ordering as the list endpoint, plus optional offset and limit (all the
+        measurements are returned by default). The rows are read with values_list, so no model instances are
+        made. As in :py:meth:`dehydrate`, NaN values are returned as -999.
+        """
+        self.method_check(request, allowed=['get'])
+        self.is_authenticated(request)
+        self.throttle_check(request)
+
+        filters = request.GET.copy()
+
+        def count_param(name):
+            value = filters.pop(name, [None])[0]
+            if not value:
+                return 0
+            try:
+                value = int(value)
+            except (TypeError, ValueError):
+                raise BadRequest(u"%s should be a whole number, not '%s'" % (name, value))
+            if value < 0:
+                raise BadRequest(u'%s should not be negative' % name)
+            return value
+
+        offset = count_param('offset')
+        limit = count_param('limit')
+        measurements = self.apply_filters(request, self.build_filters(filters=filters))
+        if 'order_by' in filters:
+            measurements = self.apply_sorting(measurements, options=filters)
+        else:
+            measurements = measurements.order_by('id')
+        # The points are stored as (lat lon)
+        measurements = measurements.extra(select={'lat': 'ST_X(toucan_db_point.point)',
+                                                  'lon': 'ST_Y(toucan_db_point.point)'})
+        measurements = measurements.values_list(*[field for column, field in self.flat_columns])
+        if limit:
+            measurements = measurements[offset:offset + limit]
+        elif offset:
+            measurements = measurements[offset:]
+
+        rows = list(measurements)
+        columns = zip(*rows) if rows else [()] * len(self.flat_columns)
+        data = dict((column, list(values)) for (column, field), values in zip(self.flat_columns, columns))
+        data['time'] = [time.isoformat() for time in data['time']]
+        data['value'] = [(-999 if math.isnan(value) else value) for value in data['value']]
+        data['count'] = len(rows)
+
+        self.log_throttled_access(request)
+        return self.create_response(request, data)
+
+
+class ImageRegionResource(TotalOrderingMixin, ModelResource):
 
     class Meta:
         queryset = ImageRegion.objects.all()
@@ -125,7 +320,7 @@ class ImageRegionResource(ModelResource):
         }
 
 
-class ImageResource(ModelResource):
+class ImageResource(TotalOrderingMixin, ModelResource):
 
     #point = fields.ForeignKey(PointResource, 'point', full=True)  
     instrument = fields.ForeignKey(InstrumentResource, 'instrument', full=True, blank=True, null=True)
@@ -133,7 +328,8 @@ class ImageResource(ModelResource):
     measurement_type = fields.ForeignKey(MeasurementTypeResource, 'measurement_type', full=True, blank=True, null=True)
 
     class Meta:
-        queryset = Image.objects.all()
+        queryset = Image.objects.select_related('instrument', 'region', 'measurement_type')
+        serializer = ColumnarSerializer()
         excludes = ['id']
         include_resource_uri = False
         filtering = {
@@ -148,3 +344,25 @@ class ImageResource(ModelResource):
         ordering = {
             'time': ALL,
         }
+        max_limit = None
+
+
+class ImageStatisticsResource(TotalOrderingMixin, ModelResource):
+
+    image = fields.ForeignKey(ImageResource, 'image', full=True)
+
+    class Meta:
+        queryset = ImageStatistics.objects.select_related('image__instrument', 'image__region',
+                                                          'image__measurement_type')
+        serializer = ColumnarSerializer()
+        excludes = ['id']
+        include_resource_uri = False
+        filtering = {
+            'image': ALL_WITH_RELATIONS,
+            'band': ALL,
+        }
+        ordering = {
+            'image': ALL_WITH_RELATIONS,
+            'band': ALL,
+        }
+        max_limit = None
@@ -0,0 +1,59 @@
+"""
+Choice lists for the TOUCAN Database forms
+
+The lists are read with a single values_list query, and cached until one of the tables they come from changes.
+Saving or deleting an object clears the lists made from its table (through the post_save and post_delete
+signals); code creating objects with bulk_create, which sends no signals, should call
+:py:func:`invalidate_choices` itself. The lists also expire after CHOICES_TIMEOUT, as a safety net.
+
+The cache must be shared by all the server processes (see CACHES in the settings), or a list cleared in one
+process would stay stale in the others until it expires.
+"""
+
+from django.core.cache import cache
+from django.db.models import get_model
+from django.db.models.signals import post_save, post_delete
+
+# Choice lists: model, field used for the values, field used for the labels
+CHOICE_LISTS = {
+    'instrument': ('Instrument', 'id', 'name'),
+    'deployment': ('Deployment', 'site', 'site'),
+    'measurement_type': ('MeasurementType', 'type', 'type'),
+    'wavelength': ('MeasurementWavelength', 'wavelength', 'wavelength'),
+}
+CHOICES_TIMEOUT = 3600
+
+
+def cache_key(name):
+    return 'toucan_db.choices.' + name
+
+
+def get_choices(name):
+    """
+    Get a choice list, from the cache if possible
+
+    :param name: Name of the list, one of the keys of CHOICE_LISTS
+    :return: List of [value, label] pairs, without duplicates, ordered by label
+    """
+    choices = cache.get(cache_key(name))
+    if choices is None:
+        model, value, label = CHOICE_LISTS[name]
+        rows = get_model('toucan_db', model).objects.order_by(label).values_list(value, label).distinct()
+        choices = [[row[0], row[1]] for row in rows]
+        cache.set(cache_key(name), choices, CHOICES_TIMEOUT)
+    return choices
+
+
+def invalidate_choices(sender, **kwargs):
+    """
+    Clear the cached choice lists made from this model. Receiver for the post_save and post_delete signals.
+
+    :param sender: The model class
+    """
+    for name, (model, value, label) in CHOICE_LISTS.items():
+        if sender._meta.app_label == 'toucan_db' and sender._meta.object_name == model:
+            cache.delete(cache_key(name))
+
+
+post_save.connect(invalidate_choices)
+post_delete.connect(invalidate_choices)
@@ -1,17 +1,13 @@
 from django import forms
 from toucan_db.models import Deployment, Point, Instrument, Measurement, InstrumentWavelength
+from toucan_db.choices import get_choices
 
              
 def choices():
     """Fonction making the list of available instruments
     """
 
-    list_instruments = []  # create empty list
-
-    for instrument in Instrument.objects.all():  # get all instrument objects
-        list_instruments.append([instrument.id, instrument.name])  # add the object to the list
-
-    return list_instruments
+    return get_choices('instrument')
 
 
 class UploadForm(forms.Form):
@@ -0,0 +1,139 @@
+"""
+Database indexes for TOUCAN Database
+
+The indexes that can be declared on the models (the composite indexes, the unique natural keys and the spatial
+indexes on the geometry columns) are created by syncdb for a new database. The functions here add the index on
+:py:attr:`Point.time_is`, which Django can't declare, and bring an existing database up to date with the models.
+"""
+
+import re
+
+from django.core.management.color import no_style
+from django.db import connection
+
+POINT_TIME_INDEX = 'toucan_db_point_time_is_brin'
+
+
+def index_exists(cursor, name):
+    """
+    :param cursor: Database cursor
+    :param name: Name of the index
+    :return: True if there is an index with this name in the database
+    """
+    cursor.execute('SELECT 1 FROM pg_indexes WHERE indexname = %s', [name])
+    return cursor.fetchone() is not None
+
+
+def create_point_time_index(cursor):
+    """
+    Index the in-situ point times. The points are mostly loaded in time order, so a BRIN index is a tiny fraction
+    of the size of a b-tree, for the same time range queries. BRIN needs PostgreSQL 9.5, a b-tree is used before that.
+
+    :param cursor: Database cursor
+    :return: True if the index was created, False if it already existed
+    """
+    if index_exists(cursor, POINT_TIME_INDEX):
+        return False
+    method = 'brin' if connection.pg_version >= 90500 else 'btree'
+    cursor.execute('CREATE INDEX {0} ON toucan_db_point USING {1} (time_is)'.format(POINT_TIME_INDEX, method))
+    return True
+
+
+def unique_fields(model):
+    """
+    :param model: Model class
+    :return: List of the fields of the model declared unique (other than the primary key)
+    """
+    return [field for field in model._meta.local_fields if field.unique and not field.primary_key]
+
+
+def unique_statements(model):
+    """
+    SQL adding the unique constraints declared on a model. The constraints are named as PostgreSQL names them
+    when the table is created, so that they are recognised whichever way the table was made.
+
+    :param model: Model class
+    :return: List of (constraint name, sql statement), one for each of :py:func:`unique_fields`
+    """
+    table = model._meta.db_table
+    return [('{0}_{1}_key'.format(table, field.column),
+             'ALTER TABLE "{0}" ADD CONSTRAINT "{0}_{1}_key" UNIQUE ("{1}")'.format(table, field.column))
+            for field in unique_fields(model)]
+
+
+def duplicate_values(cursor, model, field, limit=5):
+    """
+    Find values of a field that are in more than one row, which stop a unique constraint being added
+
+    :param cursor: Database cursor
+    :param model: Model class
+    :param field: The field
+    :param limit: [Optional] Maximum number of values to return (default 5)
+    :return: List of the duplicated values
+    """
+    cursor.execute('SELECT "{1}" FROM "{0}" GROUP BY "{1}" HAVING COUNT(*) > 1 LIMIT %s'.format(
+        model._meta.db_table, field.column), [limit])
+    return [row[0] for row in cursor.fetchall()]
+
+
+def index_statements(model):
+    """
+    SQL creating the indexes declared on a model: the foreign key and db_index indexes, the index_together
+    composite indexes, and the spatial indexes of the geometry fields
+
+    :param model: Model class
+    :return: List of (index name, sql statement)
+    """
+    statements = []
+    for sql in connection.creation.sql_indexes_for_model(model, no_style()):
+        statements.append((re.search(r'CREATE INDEX "?(\w+)"?', sql).group(1), sql))
+    return statements
+
+
+def create_indexes(app_models, stdout=None):
+    """
+    Add any missing indexes and unique constraints to the tables of these models, and the point time index.
+
+    A unique constraint can't be added to a column holding duplicate values. These constraints are skipped, and
+    reported, so that the duplicates can be merged and the command run again, and the other indexes are still
+    created.
+
+    :param app_models: List of model classes
+    :param stdout: Stream to write the names of the created indexes, and the skipped constraints, to if given
+    :return: List of the names of the created indexes, and list of the names of the skipped unique constraints
+    """
+    if connection.vendor != 'postgresql':
+        return [], []
+    created = []
+    skipped = []
+    cursor = connection.cursor()
+    for model in app_models:
+        for field, (name, sql) in zip(unique_fields(model), unique_statements(model)):
+            if index_exists(cursor, name):
+                continue
+            duplicates = duplicate_values(cursor, model, field)
+            if duplicates:
+                skipped.append(name)
+                if stdout is not None:
+                    stdout.write('Skipped unique constraint %s: %s.%s has duplicate values, eg %s. Merge the rows '
+                                 'and run again to add it.' % (name, model.__name__, field.name,
+                                                               ', '.join(repr(value) for value in duplicates)))
+                continue
+            cursor.execute(sql)
+            created.append(name)
+        for name, sql in index_statements(model):
+            if not index_exists(cursor, name):
+                cursor.execute(sql)
+                created.append(name)
+    if create_point_time_index(cursor):
+        created.append(POINT_TIME_INDEX)
+    if stdout is not None:
+        for name in created:
+            stdout.write('Created index %s' % name)
+    return created, skipped
+
+
+def post_syncdb_indexes(sender, app, created_models, **kwargs):
+    """Receiver for the post_syncdb signal, adding the point time index when the point table is created"""
+    if connection.vendor == 'postgresql' and any(model._meta.db_table == 'toucan_db_point' for model in created_models):
+        create_point_time_index(connection.cursor())
@@ -0,0 +1,19 @@
+"""Management command adding the indexes declared on the models to an existing database"""
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import get_models, get_app
+
+from toucan_db.indexes import create_indexes
+
+
+class Command(BaseCommand):
+    help = ('Add the indexes and unique constraints declared on the toucan_db models, and the point time index, '
+            'to a database created before they were declared. Indexes that already exist are left alone, and unique '
+            'constraints on columns holding duplicate values are skipped and reported.')
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            created, skipped = create_indexes(get_models(get_app('toucan_db')), stdout=self.stdout)
+        if not created and not skipped:
+            self.stdout.write('All the indexes already exist')
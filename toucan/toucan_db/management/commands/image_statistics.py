@@ -0,0 +1,41 @@
+"""Management command computing the band statistics of images ingested before they were stored"""
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from toucan_db.models import Image
+from toucan_db.statistics import band_statistics, save_statistics
+
+
+class Command(BaseCommand):
+    help = ('Compute the summary statistics of the bands of the archived images that have none yet, '
+            'reading their GeoTIFFs')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--all', action='store_true', dest='all', default=False,
+                    help='Recompute the statistics of all the images, not only those without any'),
+    )
+
+    def handle(self, *args, **options):
+        from osgeo import gdal
+
+        images = Image.objects.order_by('id')
+        if not options['all']:
+            images = images.filter(statistics__isnull=True)
+
+        done = 0
+        for image in images.iterator():
+            dataset = gdal.Open(image.archive_location)
+            if dataset is None:
+                self.stderr.write('Could not read %s (image %i)' % (image.archive_location, image.id))
+                continue
+            bands = dataset.ReadAsArray()
+            dataset = None
+            if bands.ndim == 2:   # Single band file
+                bands = bands[None]
+            with transaction.atomic():
+                save_statistics(image, band_statistics(bands))
+            done += 1
+        self.stdout.write('Computed the statistics of %i images' % done)
@@ -0,0 +1,29 @@
+"""Management command ingesting the satellite images described by the metadata files in a directory"""
+
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from ingest_data.ingest_images import IngestImages
+
+
+class Command(BaseCommand):
+    args = '<inputdir> <outputdir>'
+    help = ('Ingest the images described by the metadata (.json) files in inputdir, saving their geotiffs and '
+            'quicklooks under outputdir')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--workers', type='int', dest='workers', default=None,
+                    help='Number of processes processing the images at once (default settings.INGEST_WORKERS)'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 2:
+            raise CommandError('Give the input and output directories')
+        workers = options['workers'] or getattr(settings, 'INGEST_WORKERS', 1)
+
+        failures = IngestImages(*args).ingest_all(workers=workers)
+        for thisfile, error in sorted(failures.items()):
+            self.stderr.write('Failed to ingest %s: %s' % (thisfile, error))
+        self.stdout.write('Ingested the images of %s, %i failures' % (args[0], len(failures)))
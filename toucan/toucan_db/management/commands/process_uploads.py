@@ -0,0 +1,75 @@
+"""Management command ingesting the in-situ files queued by the upload page"""
+
+import os
+import time
+import traceback
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from toucan_db.models import UploadJob
+from ingest_data.ingest import read_data
+
+
+class Command(BaseCommand):
+    help = 'Ingest the uploaded in-situ data files waiting in the job queue'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--once', action='store_true', dest='once', default=False,
+                    help='Process the jobs that are waiting, then stop (rather than waiting for new ones)'),
+        make_option('--sleep', type='float', dest='sleep', default=5.0,
+                    help='Number of seconds to wait between checks for new jobs'),
+    )
+
+    def handle(self, *args, **options):
+        while True:
+            job = self.next_job()
+            if job is not None:
+                self.run_job(job)
+            elif options['once']:
+                break
+            else:
+                time.sleep(options['sleep'])
+
+    @staticmethod
+    def next_job():
+        """
+        Take the oldest queued job and mark it as running. The row is locked while we do this, so that
+        several workers can share the queue without running the same job twice.
+
+        :return: The UploadJob, or None if there are no queued jobs
+        """
+        with transaction.atomic():
+            job = UploadJob.objects.select_for_update().filter(status=UploadJob.QUEUED).order_by('created').first()
+            if job is not None:
+                job.status = UploadJob.RUNNING
+                job.started = timezone.now()
+                job.save()
+        return job
+
+    def run_job(self, job):
+        """
+        Ingest the staged file for this job, recording the progress as we go, and the result at the end.
+        The staged file is deleted if the ingestion succeeded, and kept for checking if it failed.
+
+        :param UploadJob job: The job to run
+        """
+        self.stdout.write('Ingesting %s (job %i)' % (job.file_name, job.id))
+
+        def progress(nrows):
+            UploadJob.objects.filter(pk=job.pk).update(rows_ingested=nrows)
+
+        try:
+            with open(job.staging_path) as file_data:
+                job.rows_ingested = read_data(file_data, job.instrument_id, job.file_name, progress=progress)
+            job.status = UploadJob.DONE
+            os.remove(job.staging_path)
+        except Exception:
+            job.rows_ingested = UploadJob.objects.get(pk=job.pk).rows_ingested
+            job.status = UploadJob.FAILED
+            job.error = traceback.format_exc()
+            self.stderr.write('Job %i failed:\n%s' % (job.id, job.error))
+        job.finished = timezone.now()
+        job.save()
@@ -1,6 +1,9 @@
 """Django models for TOUCAN Database"""
 
 from django.contrib.gis.db import models
+from django.db.models.signals import post_syncdb
+from toucan_db.indexes import post_syncdb_indexes
+import toucan_db.choices  # connects the signals clearing the cached choice lists
 
 
 class Campaign(models.Model):
@@ -51,7 +54,7 @@ class Instrument(models.Model):
     - name (CharField)
     """
 
-    name = models.CharField(max_length=255)
+    name = models.CharField(max_length=255, unique=True)
 
 
 class MeasurementType(models.Model):
@@ -61,7 +64,7 @@ class MeasurementType(models.Model):
     - long_name (CharField)
     """
 
-    type = models.CharField(max_length=255)
+    type = models.CharField(max_length=255, unique=True)
     units = models.CharField(max_length=255)
     long_name = models.CharField(max_length=255)
 
@@ -88,6 +91,10 @@ class Measurement(models.Model):
     wavelength = models.ForeignKey(MeasurementWavelength, blank=True, null=True)
     instrument = models.ForeignKey(Instrument)
 
+    class Meta:
+        # MeasurementResource and the tools look measurements up by point, type and wavelength
+        index_together = [['point', 'measurement_type', 'wavelength']]
+
 
 class InstrumentWavelength(models.Model):
     """Instrument Wavelength model defined by :\n
@@ -103,7 +110,7 @@ class ImageRegion(models.Model):
     Image region model, defined by:
     - site (text field)
     """
-    region = models.TextField()
+    region = models.TextField(unique=True)
 
 
 class Image(models.Model):
@@ -136,4 +143,64 @@ class Image(models.Model):
     SAA = models.FloatField()
     VZA = models.FloatField()
     VAA = models.FloatField()
-    direction = models.CharField(max_length=255, blank=True, null=True)
\ No newline at end of file
+    direction = models.CharField(max_length=255, blank=True, null=True)
+
+    class Meta:
+        # Querydb.get_images filters on instrument and region, and orders by time
+        index_together = [['instrument', 'region', 'time']]
+
+
+class ImageStatistics(models.Model):
+    """Image statistics model, summary statistics of one band of an image, computed at ingest. Defined by :\n
+    - image (ForeignKey)
+    - band : index of the band in the GeoTIFF, from 0 (IntegerField)
+    - mean, std, median, min, max : statistics of the valid pixels, null if there are none (FloatField)
+    - area_mean : mean of the valid pixels of each column, averaged over the columns, as the tools compute it
+      from the rasters, null if there are no valid pixels (FloatField)
+    - valid_count : number of valid (not NaN) pixels (IntegerField)
+    - valid_fraction : fraction of the pixels that are valid (FloatField)
+    """
+    image = models.ForeignKey(Image, related_name='statistics')
+    band = models.IntegerField()
+    mean = models.FloatField(blank=True, null=True)
+    std = models.FloatField(blank=True, null=True)
+    median = models.FloatField(blank=True, null=True)
+    min = models.FloatField(blank=True, null=True)
+    max = models.FloatField(blank=True, null=True)
+    area_mean = models.FloatField(blank=True, null=True)
+    valid_count = models.IntegerField()
+    valid_fraction = models.FloatField()
+
+    class Meta:
+        unique_together = [['image', 'band']]
+
+
+class UploadJob(models.Model):
+    """Upload job model, for in-situ data files waiting to be ingested by the process_uploads command. Defined by :\n
+    - file_name : name of the uploaded file, the name of the campaign is extracted from it (CharField)
+    - staging_path : where the uploaded file is stored until it is ingested (TextField)
+    - instrument (ForeignKey)
+    - status : queued, running, done or failed (CharField)
+    - rows_ingested : number of rows of the file saved so far (IntegerField)
+    - error : error message, if the ingestion failed (TextField)
+    - created, started, finished : times the job was queued, started and finished (DateTimeField)
+    """
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = ((QUEUED, 'Queued'), (RUNNING, 'Running'), (DONE, 'Done'), (FAILED, 'Failed'))
+
+    file_name = models.CharField(max_length=255)
+    staging_path = models.TextField()
+    instrument = models.ForeignKey(Instrument)
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=QUEUED, db_index=True)
+    rows_ingested = models.IntegerField(default=0)
+    error = models.TextField(blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    started = models.DateTimeField(blank=True, null=True)
+    finished = models.DateTimeField(blank=True, null=True)
+
+
+# Add the point time index when syncdb creates the tables
+post_syncdb.connect(post_syncdb_indexes)
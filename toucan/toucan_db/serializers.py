@@ -0,0 +1,89 @@
+"""Serializers for the TOUCAN Database API"""
+
+import datetime
+from io import BytesIO
+
+from django.utils import timezone
+from tastypie.bundle import Bundle
+from tastypie.serializers import Serializer
+
+
+def flatten_record(data, prefix=''):
+    """
+    Flatten a dehydrated object into a single level dictionary. The fields of nested objects (full ForeignKeys)
+    are named parent__field, as in the query filters.
+
+    :param data: Bundle or dictionary
+    :param prefix: Prefix for the field names
+    :return: Dictionary of the fields
+    """
+    if isinstance(data, Bundle):
+        data = data.data
+    flat = {}
+    for key, value in data.items():
+        if isinstance(value, (Bundle, dict)):
+            flat.update(flatten_record(value, prefix + key + '__'))
+        else:
+            flat[prefix + key] = value
+    return flat
+
+
+def to_column(values):
+    """
+    Make an array from the values of one field.
+    Times are converted to naive local time (as in the JSON output) and stored as datetime64[us], numbers with
+    missing values as floats with NaN, and missing strings as empty strings, so that no arrays need pickling.
+
+    :param values: List of the values
+    :return: numpy array
+    """
+    import numpy as np
+
+    present = [value for value in values if value is not None]
+    if present and all(isinstance(value, datetime.datetime) for value in present):
+        naive = [(timezone.make_naive(value, timezone.get_current_timezone()) if timezone.is_aware(value) else value)
+                 for value in present]
+        times = iter(naive)
+        return np.array([(np.datetime64(next(times)) if value is not None else np.datetime64('NaT'))
+                         for value in values], dtype='datetime64[us]')
+    if len(present) < len(values) and all(isinstance(value, (int, long, float)) for value in present):
+        return np.array([(np.nan if value is None else value) for value in values], dtype=float)
+    column = np.array(values)
+    if column.dtype == object:
+        column = np.array([(u'' if value is None else unicode(value)) for value in values])
+    return column
+
+
+class ColumnarSerializer(Serializer):
+    """
+    Adds a columnar binary format to the API: format=npz (or Accept: application/x-npz) returns a compressed
+    numpy .npz file, holding one array per field. Nested objects are flattened, with the fields named
+    parent__field, eg instrument__name. The arrays can be read with no per-record work, eg with
+    :py:meth:`tools.libquerydb.Querydb.get_image_arrays`.
+    """
+    formats = Serializer.formats + ['npz']
+    content_types = dict(Serializer.content_types, npz='application/x-npz')
+
+    def to_npz(self, data, options=None):
+        import numpy as np
+
+        if isinstance(data, dict) and 'objects' not in data:
+            # Already in columns (eg the flat measurement export), or a message such as an error
+            columns = dict((key, (to_column(value) if isinstance(value, list) else np.array(value)))
+                           for key, value in data.items())
+        else:
+            records = [flatten_record(obj) for obj in (data['objects'] if isinstance(data, dict) else [data])]
+            keys = set()
+            for record in records:
+                keys.update(record)
+            columns = {}
+            for key in keys:
+                values = [record.get(key) for record in records]
+                # A null ForeignKey gives a single empty field, where the other records have the nested fields
+                if all(value is None for value in values) and any(other.startswith(key + '__') for other in keys):
+                    continue
+                columns[key] = to_column(values)
+
+        npz = BytesIO()
+        np.savez_compressed(npz, **columns)
+        return npz.getvalue()
@@ -0,0 +1,57 @@
+"""Spatial queries for TOUCAN Database"""
+
+from django.contrib.gis.geos import Polygon
+
+# SRID of the point geometries (the PointField default)
+POINT_SRID = 4326
+
+
+def filter_bbox(points, lat_min, lon_min, lat_max, lon_max):
+    """
+    Keep the points inside a lat/lon box, boundaries included.
+
+    The test is the && (bounding box overlap) operator against ST_MakeEnvelope, which the planner answers from
+    the GiST index on the point column, and combines with the other filters of the query. For points, overlapping
+    the box is the same as being inside it, so no exact containment test is needed afterwards.
+
+    :param points: Queryset of Point
+    :param lat_min:
+    :param lon_min:
+    :param lat_max:
+    :param lon_max:
+    :return: The filtered queryset
+    """
+    # The points are stored as (lat lon)
+    return points.extra(where=['toucan_db_point.point && ST_MakeEnvelope(%s, %s, %s, %s, {0})'.format(POINT_SRID)],
+                        params=[min(lat_min, lat_max), min(lon_min, lon_max),
+                                max(lat_min, lat_max), max(lon_min, lon_max)])
+
+
+def bbox_polygon(lat_min, lon_min, lat_max, lon_max):
+    """
+    The lat/lon box as a polygon, for filtering on the points of related objects with the bboverlaps lookup
+    (eg point__point__bboverlaps), which is the same && test as :py:func:`filter_bbox`
+
+    :param lat_min:
+    :param lon_min:
+    :param lat_max:
+    :param lon_max:
+    :return: Polygon
+    """
+    # The points are stored as (lat lon)
+    box = Polygon.from_bbox((min(lat_min, lat_max), min(lon_min, lon_max),
+                             max(lat_min, lat_max), max(lon_min, lon_max)))
+    box.srid = POINT_SRID
+    return box
+
+
+def parse_bbox(bbox):
+    """
+    :param bbox: Box as a string: lat_min,lon_min,lat_max,lon_max
+    :return: Tuple of the four floats
+    :raises ValueError: if the string isn't four numbers
+    """
+    values = tuple(float(value) for value in bbox.split(','))
+    if len(values) != 4:
+        raise ValueError('bbox must be lat_min,lon_min,lat_max,lon_max')
+    return values
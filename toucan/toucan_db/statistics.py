@@ -0,0 +1,52 @@
+"""Summary statistics of the image bands, stored with the images so that the tools don't need to read the rasters"""
+
+import numpy as np
+
+# Statistics stored for each band, see ImageStatistics
+STATISTICS = ('mean', 'std', 'median', 'min', 'max', 'area_mean', 'valid_count', 'valid_fraction')
+
+
+def band_statistics(bands):
+    """
+    Compute the summary statistics of each band of an image. NaNs are the invalid pixels.
+
+    The values are rounded to float32 first, as they are stored in the GeoTIFFs, so that the statistics are the
+    same whether they are computed at ingest or from the archived file.
+
+    The area mean is the mean of each column then the mean of the columns, like the area mean the tools compute
+    from the rasters (tools.libtools.area_mean). It differs from the mean of all the valid pixels when the
+    columns have different numbers of NaNs.
+
+    :param bands: Array of the bands, dimensions nbands x rows x cols
+    :return: List of dictionaries (one per band) of the statistics, the statistics of the valid pixels are None
+     for a band with no valid pixels
+    """
+    bands = np.asarray(bands, dtype=np.float32).astype(float)
+    statistics = []
+    for data in bands:
+        valid = data[~np.isnan(data)]
+        stats = {'valid_count': int(valid.size),
+                 'valid_fraction': float(valid.size) / data.size}
+        if valid.size:
+            column_counts = np.sum(~np.isnan(data), axis=0)
+            column_means = np.nansum(data, axis=0)[column_counts > 0] / column_counts[column_counts > 0]
+            stats.update(mean=float(valid.mean()), std=float(valid.std()), median=float(np.median(valid)),
+                         min=float(valid.min()), max=float(valid.max()), area_mean=float(column_means.mean()))
+        else:
+            stats.update(mean=None, std=None, median=None, min=None, max=None, area_mean=None)
+        statistics.append(stats)
+    return statistics
+
+
+def save_statistics(image, statistics):
+    """
+    Store the statistics of an image, replacing any it already has
+
+    :param image: The Image
+    :param statistics: List of the statistics of each band, as returned by :py:func:`band_statistics`
+    """
+    from toucan_db.models import ImageStatistics
+
+    ImageStatistics.objects.filter(image=image).delete()
+    ImageStatistics.objects.bulk_create([ImageStatistics(image=image, band=band, **stats)
+                                         for band, stats in enumerate(statistics)])
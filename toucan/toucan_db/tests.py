@@ -6,10 +6,23 @@ Replace this with more appropriate tests for your application.
 """
 
 from django.test import TestCase
+from django.core.management import call_command
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django.core.cache import cache, get_cache
+from mock import patch, Mock
+from toucan_db.api import StreamingMixin
+from toucan_db.choices import cache_key
 from toucan_db.models import Deployment, Point
 from toucan_db.views import *
 import re
 import datetime
+import os
+import shutil
+import tempfile
+import numpy
+from io import BytesIO
 
 
 def lat_lon_ok(point):
@@ -91,3 +104,340 @@ class ImageTests(TestCase):
         image_region = ImageRegion(region="testregion")
         self.assertTrue(image_region.region.isalnum())
              
+
+
+class UploadJobTests(TestCase):
+    def setUp(self):
+        self.staging_dir = tempfile.mkdtemp()
+        self.instrument = Instrument.objects.create(name='Unknown')
+
+    def tearDown(self):
+        shutil.rmtree(self.staging_dir)
+
+    def test_upload_queued(self):
+        """checks that uploading a file queues a job without ingesting it, and the job can then be run by the worker"""
+
+        with self.settings(UPLOAD_STAGING_DIR=self.staging_dir):
+            with open(os.path.join('ingest_data', 'extraction_Test_.csv')) as testfile:
+                response = self.client.post('/add_data/', {'data': testfile, 'name': self.instrument.id})
+        self.assertEqual(response.status_code, 200)
+        job = UploadJob.objects.get()
+        self.assertEqual(job.status, UploadJob.QUEUED)
+        self.assertTrue(os.path.isfile(job.staging_path))
+        self.assertEqual(Measurement.objects.count(), 0)
+
+        call_command('process_uploads', once=True)
+        job = UploadJob.objects.get()
+        self.assertEqual(job.status, UploadJob.DONE)
+        self.assertEqual(job.rows_ingested, 1)
+        self.assertEqual(Measurement.objects.count(), 2)
+        self.assertFalse(os.path.isfile(job.staging_path))
+
+        status = json.loads(self.client.get('/upload_status/%i/' % job.id).content)
+        self.assertEqual(status['status'], UploadJob.DONE)
+        self.assertEqual(status['rows_ingested'], 1)
+
+    def test_upload_failed(self):
+        """checks that a bad file marks the job as failed, with the error recorded"""
+
+        staging_path = os.path.join(self.staging_dir, 'extraction_bad_.csv')
+        with open(staging_path, 'w') as staged:
+            staged.write('not;a;valid;header\n')
+        job = UploadJob.objects.create(file_name='extraction_bad_.csv', staging_path=staging_path,
+                                       instrument=self.instrument)
+        call_command('process_uploads', once=True)
+        job = UploadJob.objects.get(pk=job.pk)
+        self.assertEqual(job.status, UploadJob.FAILED)
+        self.assertTrue('IOError' in job.error)
+
+
+class IndexTests(TestCase):
+    def test_create_indexes_duplicates(self):
+        """checks that a unique constraint on a column with duplicates is skipped, and the other indexes still created"""
+        from django.db.models import get_models, get_app
+        from toucan_db.indexes import create_indexes, POINT_TIME_INDEX
+
+        cursor = connection.cursor()
+        cursor.execute('ALTER TABLE toucan_db_imageregion DROP CONSTRAINT toucan_db_imageregion_region_key')
+        cursor.execute('DROP INDEX IF EXISTS ' + POINT_TIME_INDEX)
+        ImageRegion.objects.create(region='duplicate')
+        ImageRegion.objects.create(region='duplicate')
+
+        created, skipped = create_indexes(get_models(get_app('toucan_db')))
+        self.assertEqual(skipped, ['toucan_db_imageregion_region_key'])
+        self.assertEqual(created, [POINT_TIME_INDEX])
+
+    def test_add_existing_instrument(self):
+        """checks that adding an instrument that already exists is a form error, not a server error"""
+        Instrument.objects.create(name='meris')
+        response = self.client.post('/add_instrument/', {'name': 'meris', 'wavelengths': 1})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('name', response.context['form'].errors)
+
+        # the instrument can also be added between the two steps
+        response = self.client.post('/add_wavelengths/meris/1', {'wavelength 1': 412.5})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.context['form'].non_field_errors())
+        self.assertEqual(Instrument.objects.count(), 1)
+        self.assertEqual(InstrumentWavelength.objects.count(), 0)
+
+
+class ApiQueryTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        campaign = Campaign.objects.create(campaign='test')
+        instrument = Instrument.objects.create(name='test')
+        measurement_type = MeasurementType.objects.create(type='rho_wn_is', units='dl', long_name='test')
+        region = ImageRegion.objects.create(region='test')
+        for i in range(10):
+            deployment = Deployment.objects.create(site='site%i' % i, pi='pi', campaign=campaign)
+            point = Point.objects.create(matchup_id='test%i' % i, point='POINT(%i 0)' % i,
+                                         time_is=datetime.datetime(2006, 5, 17, i, tzinfo=timezone.utc),
+                                         pqc='P00000000', mqc='M000000000000000000', land_dist_is=0, thetas_is=0,
+                                         deployment=deployment)
+            wavelength = MeasurementWavelength.objects.create(wavelength=400 + i)
+            Measurement.objects.create(value=i, measurement_type=measurement_type, point=point,
+                                       wavelength=(wavelength if i % 2 else None), instrument=instrument)
+            InstrumentWavelength.objects.create(value=400 + i, instrument=instrument)
+            Image.objects.create(web_location='', archive_location='image%i' % i, top_left_point='POINT(0 0)',
+                                 bot_right_point='POINT(1 1)',
+                                 time=datetime.datetime(2006, 5, 17, i, tzinfo=timezone.utc),
+                                 instrument=instrument, measurement_type=measurement_type, region=region,
+                                 SZA=0, SAA=0, VZA=0, VAA=0)
+
+    def count_queries(self, resource, limit):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/v1/%s/?format=json&limit=%i' % (resource, limit))
+        self.assertEqual(len(json.loads(response.content)['objects']), limit)
+        return len(queries)
+
+    def test_constant_queries(self):
+        """checks that the number of queries for a page of results doesn't depend on the number of results"""
+
+        for resource in ('measurement', 'point', 'image', 'instrumentwavelength'):
+            self.assertEqual(self.count_queries(resource, 1), self.count_queries(resource, 10), resource)
+
+    def test_pages_total_order(self):
+        """checks that reading a list a page at a time gives every result once, when they tie on the ordering"""
+
+        Image.objects.update(time=datetime.datetime(2006, 5, 17, tzinfo=timezone.utc))
+        for resource, query in (('image', 'order_by=time'), ('instrumentwavelength', 'instrument__name=test')):
+            pages = [json.loads(self.client.get('/api/v1/%s/?format=json&limit=3&offset=%i&%s'
+                                                % (resource, offset, query)).content)['objects']
+                     for offset in range(0, 10, 3)]
+            listed = json.loads(self.client.get('/api/v1/%s/?format=json&%s' % (resource, query)).content)['objects']
+            self.assertEqual([obj for page in pages for obj in page], listed, resource)
+
+    def test_querydb_page_size(self):
+        """checks Querydb can read the lists in pages larger than tastypie's default limit of 1000 results"""
+        from tools.libquerydb import Querydb
+
+        instrument = Instrument.objects.get()
+        InstrumentWavelength.objects.bulk_create([InstrumentWavelength(value=500 + i, instrument=instrument)
+                                                  for i in range(1100)])
+        time = datetime.datetime(2007, 1, 1, tzinfo=timezone.utc)
+        Image.objects.bulk_create([Image(web_location='', archive_location='extra%i' % i,
+                                         top_left_point='POINT(0 0)', bot_right_point='POINT(1 1)', time=time,
+                                         instrument=instrument, measurement_type=MeasurementType.objects.get(),
+                                         region=ImageRegion.objects.get(), SZA=0, SAA=0, VZA=0, VAA=0)
+                                   for i in range(1100)])
+
+        def fake_get(url, params):
+            response = self.client.get(url, params)
+            self.assertEqual(response.status_code, 200)
+            return Mock(content=response.content)
+
+        q = Querydb(base_url='/api/v1/', page_size=1500, workers=1)
+        with patch.object(q.session, 'get', side_effect=fake_get):
+            self.assertEqual(len(q.get('instrumentwavelength', {'instrument__name': 'test'})), 1110)
+            self.assertEqual(len(q.get_arrays('image', {'order_by': 'time'})['archive_location']), 1110)
+
+    def test_flat_measurements(self):
+        """checks the flat measurement export against the nested list endpoint, with the same filters"""
+
+        Measurement.objects.filter(point__matchup_id='test4').update(value=float('nan'))
+        query = 'format=json&point__deployment__site__in=site3,site4'
+        with CaptureQueriesContext(connection) as queries:
+            flat = json.loads(self.client.get('/api/v1/measurement/flat/?' + query).content)
+        self.assertEqual(len(queries), 1)
+        nested = json.loads(self.client.get('/api/v1/measurement/?' + query).content)['objects']
+        nested.sort(key=lambda measurement: measurement['point']['matchup_id'])
+
+        self.assertEqual(flat['count'], 2)
+        self.assertEqual(flat['matchup_id'], [measurement['point']['matchup_id'] for measurement in nested])
+        self.assertEqual(flat['site'], ['site3', 'site4'])
+        self.assertEqual(flat['value'], [3, -999])
+        self.assertEqual(flat['wavelength'], [403, None])
+        self.assertEqual(flat['lat'], [3, 4])
+        self.assertEqual(flat['lon'], [0, 0])
+        self.assertEqual(flat['type'], ['rho_wn_is', 'rho_wn_is'])
+
+    def test_flat_measurements_bad_paging(self):
+        """checks that a malformed offset or limit in the flat export is a bad request, not a server error"""
+
+        for query in ('offset=x', 'limit=1.5', 'offset=-1', 'limit=-2', u'limit=\xe9t\xe9'):
+            response = self.client.get('/api/v1/measurement/flat/', dict([query.split('=')]))
+            self.assertEqual(response.status_code, 400, query)
+            self.assertIn('error', json.loads(response.content))
+
+        flat = json.loads(self.client.get('/api/v1/measurement/flat/?offset=2&limit=3').content)
+        self.assertEqual(flat['value'], [2, 3, 4])
+
+    def test_stream_ndjson(self):
+        """checks that the streamed records match the list endpoint, when read over several chunks"""
+
+        with patch.object(StreamingMixin, 'stream_chunk_size', 3):
+            for resource, query in (('measurement', 'point__deployment__site__in=site1,site2,site3,site5,site8'),
+                                    ('point', 'deployment__pi=pi'),
+                                    ('measurement', 'measurementtype__type=rho_wn_is')):
+                listed = json.loads(self.client.get('/api/v1/%s/?format=json&%s' % (resource, query)).content)
+                response = self.client.get('/api/v1/%s/?format=json&stream=ndjson&%s' % (resource, query))
+                self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+                streamed = [json.loads(line) for line in ''.join(response.streaming_content).splitlines()]
+                self.assertEqual(sorted(streamed), sorted(listed['objects']), query)
+
+    def test_stream_ordered(self):
+        """checks that ordered streams come in order over several chunks, with ties and nulls in the ordering"""
+        from toucan_db.api import MeasurementResource
+
+        request = Mock(GET={'order_by': 'wavelength'})
+        for fields in (['wavelength__wavelength'], ['-wavelength__wavelength'], ['point__deployment__pi', '-value']):
+            sort = lambda resource, objects, options: objects.order_by(*fields)
+            with patch.object(MeasurementResource, 'apply_sorting', sort):
+                with patch.object(StreamingMixin, 'stream_chunk_size', 3):
+                    chunks = list(MeasurementResource().stream_chunks(request, Measurement.objects.all()))
+            expected = list(Measurement.objects.order_by(*(fields + ['pk'])).values_list('pk', flat=True))
+            self.assertEqual([measurement.pk for chunk in chunks for measurement in chunk], expected, fields)
+
+    def test_npz_format(self):
+        """checks that the npz format holds the same data as the JSON list, one array per field"""
+
+        query = 'region__region=test&order_by=time'
+        listed = json.loads(self.client.get('/api/v1/image/?format=json&' + query).content)['objects']
+        response = self.client.get('/api/v1/image/?format=npz&' + query)
+        self.assertEqual(response['Content-Type'], 'application/x-npz')
+        arrays = numpy.load(BytesIO(response.content))
+
+        self.assertEqual(list(arrays['archive_location']), [image['archive_location'] for image in listed])
+        self.assertEqual(list(arrays['instrument__name']), [image['instrument']['name'] for image in listed])
+        self.assertEqual([time.isoformat() for time in arrays['time'].astype(datetime.datetime)],
+                         [image['time'] for image in listed])
+        self.assertEqual(list(arrays['SZA']), [image['SZA'] for image in listed])
+
+        # Null foreign keys give NaN in the nested fields
+        arrays = numpy.load(BytesIO(self.client.get('/api/v1/measurement/?format=npz').content))
+        self.assertEqual(numpy.isnan(arrays['wavelength__wavelength']).sum(), 5)
+        self.assertFalse('wavelength' in arrays.files)
+
+    def test_search_views(self):
+        """checks the search pages query the database for the selected points and measurements"""
+
+        response = self.client.post('/search_point/', {'top_left_lat': 5.5, 'top_left_lon': -1,
+                                                       'bot_right_lat': 1.5, 'bot_right_lon': 1})
+        self.assertEqual([point['deployment__site'] for point in response.context['objects']],
+                         ['site2', 'site3', 'site4', 'site5'])
+
+        response = self.client.post('/search_measurement/', {'deployment': ['site3', 'site5', 'site6'],
+                                                             'wavelengths': ['403.0', '405.0']})
+        self.assertEqual([(measurement['value'], measurement['lat']) for measurement in response.context['objects']],
+                         [(3, 3), (5, 5)])
+
+    def test_choices_cached(self):
+        """checks the choice lists are cached, and updated when the tables change"""
+
+        self.assertEqual(get_deployment_choices()[:2], [['site0', 'site0'], ['site1', 'site1']])
+        self.assertEqual(len(get_measurement_type_choices()), 1)
+        with self.assertNumQueries(2):
+            # One read of the cache table each, instead of the model tables
+            get_deployment_choices()
+            get_measurement_type_choices()
+
+        # Another server process has its own cache connection, and sees the same lists, cleared with the tables
+        other_process = get_cache('default')
+        self.assertIsNot(other_process, cache)
+        self.assertEqual(other_process.get(cache_key('deployment')), get_deployment_choices())
+        Deployment.objects.create(site='a_site', pi='pi', campaign=Campaign.objects.get())
+        self.assertIsNone(other_process.get(cache_key('deployment')))
+        self.assertEqual(get_deployment_choices()[0], ['a_site', 'a_site'])
+        MeasurementType.objects.filter(type='rho_wn_is').delete()
+        self.assertEqual(get_measurement_type_choices(), [])
+
+    def test_results_pages(self):
+        """checks the search results can be read a page at a time, with the pages following each other"""
+
+        with patch('toucan_db.views.RESULTS_PAGE_SIZE', 3):
+            response = self.client.post('/search_point/', {'top_left_lat': 10, 'top_left_lon': -1,
+                                                           'bot_right_lat': -1, 'bot_right_lon': 1})
+            self.assertGreater(response.context['count'], 0)
+            sites = [point['deployment__site'] for point in response.context['objects']]
+            next_url = response.context['next_url']
+            while next_url:
+                page = json.loads(self.client.get(next_url).content)
+                self.assertLessEqual(len(page['objects']), 3)
+                sites += [point['deployment__site'] for point in page['objects']]
+                next_url = page['next']
+        self.assertEqual(sites, ['site%i' % i for i in range(10)])
+
+        # measurements at the same time are ordered by id
+        Measurement.objects.create(value=10, measurement_type=MeasurementType.objects.get(),
+                                   point=Point.objects.get(matchup_id='test4'), instrument=Instrument.objects.get())
+        with patch('toucan_db.views.RESULTS_PAGE_SIZE', 2):
+            response = self.client.post('/search_measurement/', {'deployment': ['site3', 'site4', 'site5']})
+            values = [measurement['value'] for measurement in response.context['objects']]
+            page = json.loads(self.client.get(response.context['next_url']).content)
+            values += [measurement['value'] for measurement in page['objects']]
+        self.assertEqual(values, [3, 4, 10, 5])
+        self.assertIsNone(page['next'])
+
+    def test_results_page_bad_after(self):
+        """checks a malformed page position is a bad request, not a server error"""
+
+        query = 'top_left_lat=10&top_left_lon=-1&bot_right_lat=-1&bot_right_lon=1'
+        for after in ('bad', '2006-05-17T00:00:00+00:00', '2006-05-17T00:00:00+00:00,x', 'yesterday,3',
+                      '2006-13-45T00:00:00+00:00,3', u'\xe9t\xe9,3'):
+            for url in ('/search_point/results/?' + query, '/search_measurement/results/?deployment=site3'):
+                response = self.client.get(url, {'after': after})
+                self.assertEqual(response.status_code, 400, (url, after))
+                self.assertIn('after', json.loads(response.content))
+
+        response = self.client.get('/search_point/results/?' + query, {'after': '2006-05-17T00:00:00+00:00,3'})
+        self.assertEqual(response.status_code, 200)
+
+    def test_bbox_filter(self):
+        """checks the bbox filter, on its own and with the other filters"""
+
+        def sites(resource, query):
+            objects = json.loads(self.client.get('/api/v1/%s/?format=json&%s' % (resource, query)).content)['objects']
+            return sorted(obj['deployment']['site'] if resource == 'point' else obj['point']['deployment']['site']
+                          for obj in objects)
+
+        self.assertEqual(sites('point', 'bbox=1.5,-1,5.5,1'), ['site2', 'site3', 'site4', 'site5'])
+        # the corners can be given in any order, and the boundaries are included
+        self.assertEqual(sites('point', 'bbox=5,1,2,0'), ['site2', 'site3', 'site4', 'site5'])
+        self.assertEqual(sites('point', 'bbox=1.5,-1,5.5,1&deployment__site__in=site1,site3,site5'), ['site3', 'site5'])
+        self.assertEqual(sites('point', 'bbox=1.5,-1,5.5,1&time_is__gte=2006-05-17T04:00:00Z'), ['site4', 'site5'])
+        self.assertEqual(sites('measurement', 'bbox=1.5,-1,5.5,1&point__deployment__site__in=site1,site3,site5'),
+                         ['site3', 'site5'])
+        self.assertEqual(self.client.get('/api/v1/point/?format=json&bbox=1,2,3').status_code, 400)
+
+    def test_image_statistics(self):
+        """checks the backfill command stores the band statistics of the images without any, and the API serves them"""
+
+        bands = numpy.ones((2, 3, 4))
+        bands[1, 0, :] = numpy.nan
+        with patch('osgeo.gdal.Open') as mock:
+            mock.return_value.ReadAsArray.return_value = bands
+            call_command('image_statistics')
+            self.assertEqual(mock.call_count, 10)
+            call_command('image_statistics')
+            self.assertEqual(mock.call_count, 10)
+        self.assertEqual(ImageStatistics.objects.count(), 20)
+
+        query = 'image__region__region=test&image__time__lte=2006-05-17T02:00:00Z&order_by=band'
+        arrays = numpy.load(BytesIO(self.client.get('/api/v1/imagestatistics/?format=npz&' + query).content))
+        self.assertEqual(sorted(arrays['image__archive_location']), ['image0', 'image0', 'image1', 'image1',
+                                                                     'image2', 'image2'])
+        self.assertEqual(list(arrays['band']), [0, 0, 0, 1, 1, 1])
+        self.assertEqual(list(arrays['valid_count']), [12, 12, 12, 8, 8, 8])
+        self.assertEqual(list(arrays['mean']), [1.0] * 6)
+        self.assertEqual(list(arrays['area_mean']), [1.0] * 6)
@@ -3,18 +3,29 @@
 from datetime import datetime
 from toucan_db.models import *
 from toucan_db.forms import UploadForm, AddInstrumentForm, AddWavelengthForm, SearchMeasurementForm, SearchPointForm
-from ingest_data.ingest import read_data as read_data_2
-from django.http import HttpResponse, HttpResponseRedirect
-from django.shortcuts import render
+from toucan_db.choices import get_choices
+from toucan_db.spatial import filter_bbox
+from django.core.serializers.json import DjangoJSONEncoder
+from django.core.exceptions import NON_FIELD_ERRORS
+from django.db import connection, transaction, IntegrityError
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from django.http import HttpResponse, HttpResponseRedirect, HttpResponseBadRequest
+from django.shortcuts import render, get_object_or_404
+from django.conf import settings
 import logging
+import os
 import re
+import uuid
 from django.core.urlresolvers import reverse
-import requests
 import json
 import datetime
 
 #logger = logging.getLogger(__name__)
 
+# number of results in each page of the search results
+RESULTS_PAGE_SIZE = 100
+
 
 def home(request):
     """Main page\n
@@ -53,8 +64,8 @@ def home(request):
 
 
 def search_point(request):
-    """
-
+    """Search points page\n
+    Uses the form SearchPointForm, and lists the points within the selected lat/long box
     :param request:
     :return:
     """
@@ -66,13 +77,10 @@ def search_point(request):
             top_left_lon = form.cleaned_data.get('top_left_lon')
             bot_right_lat = form.cleaned_data.get('bot_right_lat')
             bot_right_lon = form.cleaned_data.get('bot_right_lon')
-            # get the url corresponding to the lat/long
-            url = get_point_url(top_left_lat, top_left_lon, bot_right_lat, bot_right_lon)
-            # request the api
-            resp = requests.get(url=url)
-            # read the data
-            data = json.loads(resp.text)
-            objects = data['objects']
+            # query the first page of points within the lat/long, the later pages are loaded by point_results
+            points = get_points(top_left_lat, top_left_lon, bot_right_lat, bot_right_lon)
+            count = estimate_count(points)
+            objects, next_url = results_page(points, 'time_is', request.POST, 'toucan_db.views.point_results')
             # load the template
             return render(request, 'toucan_db/point_results.html', locals())
 
@@ -82,25 +90,43 @@ def search_point(request):
     return render(request, 'toucan_db/search_data.html', locals())
 
 
-def get_point_url(top_left_lat, top_left_lon, bot_right_lat, bot_right_lon):
+def get_points(top_left_lat, top_left_lon, bot_right_lat, bot_right_lon):
     """
-    Get the right url for the selected lat/long
+    Get the points within the selected lat/long
     :param top_left_lat:
     :param top_left_lon:
     :param bot_right_lat:
     :param bot_right_lon:
-    :return:
+    :return: the points, as dictionaries with keys id, deployment__site, lat, lon and time_is
     """
-    url = 'http://0.0.0.0:8000/api/v1/point/?format=json&point__within={"type":"MultiPolygon","coordinates":' + \
-          '[[[[{2},{1}],[{2},{3}],[{0},{3}],[{0},{1}],[{2},{1}]]]]'.format(top_left_lat, top_left_lon, bot_right_lat,
-                                                                           bot_right_lon) + '}'
-
-    return url
+    points = filter_bbox(Point.objects.all(), top_left_lat, top_left_lon, bot_right_lat, bot_right_lon)
+    points = points.order_by('time_is')
+    points = points.extra(select={'lat': 'ST_X(toucan_db_point.point)', 'lon': 'ST_Y(toucan_db_point.point)'})
+    return points.values('id', 'deployment__site', 'lat', 'lon', 'time_is')
 
 
-def search_measurement(request):
+def point_results(request):
+    """Page of point search results, as JSON, for loading the results of :py:func:`search_point` on demand\n
+    Takes the fields of SearchPointForm, and the position to start from (after)
+    :param request:
     """
+    form = SearchPointForm(request.GET)
+    if not form.is_valid():
+        return HttpResponseBadRequest(json.dumps(form.errors), content_type='application/json')
+    points = get_points(form.cleaned_data.get('top_left_lat'), form.cleaned_data.get('top_left_lon'),
+                        form.cleaned_data.get('bot_right_lat'), form.cleaned_data.get('bot_right_lon'))
+    try:
+        objects, next_url = results_page(points, 'time_is', request.GET, 'toucan_db.views.point_results')
+    except ValueError as error:
+        return HttpResponseBadRequest(json.dumps({'after': [unicode(error)]}), content_type='application/json')
+    return HttpResponse(json.dumps({'objects': objects, 'next': next_url}, cls=DjangoJSONEncoder),
+                        content_type='application/json')
+
 
+def search_measurement(request):
+    """Search measurements page\n
+    Uses the form SearchMeasurementForm, and lists the measurements for the selected deployments, measurement
+    types and wavelengths
     :param request:
     :return:
     """
@@ -115,10 +141,10 @@ def search_measurement(request):
             deployment = form.cleaned_data.get('deployment')
             measurement_type = form.cleaned_data.get('measurement_type')
             wavelengths = form.cleaned_data.get('wavelengths')
-            url = get_measurement_url(deployment, measurement_type, wavelengths)
-            resp = requests.get(url=url)
-            data = json.loads(resp.text)
-            objects = data['objects']
+            measurements = get_measurements(deployment, measurement_type, wavelengths)
+            count = estimate_count(measurements)
+            objects, next_url = results_page(measurements, 'point__time_is', request.POST,
+                                             'toucan_db.views.measurement_results')
 
             return render(request, 'toucan_db/measurement_results.html', locals())
 
@@ -131,91 +157,141 @@ def search_measurement(request):
 
 def get_deployment_choices():
     """
-
-
+    List of the deployment sites, for the search form (cached, see :py:mod:`toucan_db.choices`)
     :return:
     """
-    deployment_choices = []
-    temp_choices = []
-    resp = requests.get(url='http://0.0.0.0:8000/api/v1/deployment/?format=json')
-    data = json.loads(resp.text)
-    objects = data['objects']
-
-    for deployment in objects:
-        temp_choices.append(deployment['site'])
-        temp_choices.append(deployment['site'])
-        deployment_choices.append(temp_choices)
-        temp_choices = []
-    return deployment_choices
+    return get_choices('deployment')
 
 
 def get_measurement_type_choices():
     """
-
-
+    List of the measurement types, for the search form (cached, see :py:mod:`toucan_db.choices`)
     :return:
     """
-    measurement_type_choices = []
-    temp_choices = []
-    resp = requests.get(url='http://0.0.0.0:8000/api/v1/measurementtype/?format=json')
-    data = json.loads(resp.text)
-    objects = data['objects']
-
-    for measurementtype in objects:
-        temp_choices.append(measurementtype['type'])
-        temp_choices.append(measurementtype['type'])
-        measurement_type_choices.append(temp_choices)
-        temp_choices = []
-        
-    return measurement_type_choices
+    return get_choices('measurement_type')
 
 
 def get_wavelengths_choices():
     """
-
-
+    List of the measurement wavelengths, for the search form (cached, see :py:mod:`toucan_db.choices`)
     :return:
     """
-    wavelengths_choices = []
-    temp_choices = []
-    resp = requests.get(url='http://0.0.0.0:8000/api/v1/measurementwavelength/?format=json')
-    data = json.loads(resp.text)
-    objects = data['objects']
-
-    for wavelength in objects:
-        temp_choices.append(wavelength['wavelength'])
-        temp_choices.append(wavelength['wavelength'])
-        wavelengths_choices.append(temp_choices)
-        temp_choices = []
+    return get_choices('wavelength')
 
-    return wavelengths_choices
 
-
-def get_measurement_url(deployment, measurement_type, wavelengths):
+def get_measurements(deployment, measurement_type, wavelengths):
     """
-
-    :param deployment:
-    :param measurement_type:
-    :param wavelengths:
-    :return:
+    Get the measurements for the selected deployments, measurement types and wavelengths
+    :param deployment: list of sites (all sites if empty)
+    :param measurement_type: list of measurement types (all types if empty)
+    :param wavelengths: list of wavelengths (all wavelengths if empty)
+    :return: the measurements, as dictionaries with keys id, measurement_type__type, measurement_type__units,
+             wavelength__wavelength, value, lat, lon and point__time_is
     """
-    url = 'http://0.0.0.0:8000/api/v1/measurement/?'
+    measurements = Measurement.objects.all()
 
     if deployment:
-        for dep in deployment:
-            url += 'point__deployment__site__in=' + dep + '&'
+        measurements = measurements.filter(point__deployment__site__in=deployment)
 
     if measurement_type:
-        for mes in measurement_type:
-            url += 'measurementtype__type__in=' + mes + '&'
+        measurements = measurements.filter(measurement_type__type__in=measurement_type)
 
     if wavelengths:
-        for wav in wavelengths:
-            url += 'wavelength__in=' + wav + '&'
+        measurements = measurements.filter(wavelength__wavelength__in=[float(wav) for wav in wavelengths])
+
+    measurements = measurements.order_by('point__time_is', 'id')
+    measurements = measurements.extra(select={'lat': 'ST_X(toucan_db_point.point)',
+                                              'lon': 'ST_Y(toucan_db_point.point)'})
+    return measurements.values('id', 'measurement_type__type', 'measurement_type__units', 'wavelength__wavelength',
+                               'value', 'lat', 'lon', 'point__time_is')
 
-    url += 'format=json'
 
-    return url
+def measurement_results(request):
+    """Page of measurement search results, as JSON, for loading the results of :py:func:`search_measurement`
+    on demand\n
+    Takes the fields of SearchMeasurementForm, and the position to start from (after)
+    :param request:
+    """
+    form = SearchMeasurementForm(request.GET, deployment_choices=get_deployment_choices(),
+                                 measurement_type_choices=get_measurement_type_choices(),
+                                 wavelengths_choices=get_wavelengths_choices())
+    if not form.is_valid():
+        return HttpResponseBadRequest(json.dumps(form.errors), content_type='application/json')
+    measurements = get_measurements(form.cleaned_data.get('deployment'), form.cleaned_data.get('measurement_type'),
+                                    form.cleaned_data.get('wavelengths'))
+    try:
+        objects, next_url = results_page(measurements, 'point__time_is', request.GET,
+                                         'toucan_db.views.measurement_results')
+    except ValueError as error:
+        return HttpResponseBadRequest(json.dumps({'after': [unicode(error)]}), content_type='application/json')
+    return HttpResponse(json.dumps({'objects': objects, 'next': next_url}, cls=DjangoJSONEncoder),
+                        content_type='application/json')
+
+
+def results_page(objects, time_field, params, endpoint, page_size=None):
+    """
+    Get one page of search results, ordered by time then id. The page is found by keyset pagination: it starts
+    after the (time, id) of the last result of the previous page, given by the 'after' parameter, so that every
+    page is as quick to get as the first one.
+    :param objects: the search results, a values queryset including the time field and id
+    :param time_field: the name of the time field
+    :param params: the search parameters (QueryDict), with 'after' for the pages after the first one
+    :param endpoint: the view giving the next pages
+    :param page_size: the number of results per page (default RESULTS_PAGE_SIZE)
+    :return: the results in the page, and the url of the next page (None if this is the last page)
+    :raises ValueError: if 'after' is not the position of a result
+    """
+    page_size = page_size or RESULTS_PAGE_SIZE
+    after = params.get('after')
+    if after:
+        time, pk = parse_after(after)
+        objects = objects.filter(Q(**{time_field + '__gt': time}) | Q(**{time_field: time, 'id__gt': pk}))
+    objects = list(objects.order_by(time_field, 'id')[:page_size + 1])
+
+    next_url = None
+    if len(objects) > page_size:
+        objects = objects[:page_size]
+        next_params = params.copy()
+        next_params.pop('csrfmiddlewaretoken', None)
+        next_params['after'] = '{0},{1}'.format(objects[-1][time_field].isoformat(), objects[-1]['id'])
+        next_url = reverse(endpoint) + '?' + next_params.urlencode()
+    return objects, next_url
+
+
+def parse_after(after):
+    """
+    Read the position a page of search results starts after
+    :param after: the time and id of the last result of the previous page, as 'time,id'
+    :return: the time (datetime) and id
+    :raises ValueError: if after is not a time and an id
+    """
+    time, _, pk = after.rpartition(',')
+    try:
+        time = parse_datetime(time)
+        pk = int(pk)
+    except ValueError:
+        time = None
+    if time is None:
+        raise ValueError(u"after should be the time and id of a result, not '{0}'".format(after))
+    return time, pk
+
+
+def estimate_count(queryset):
+    """
+    Estimate the number of results of a query from the query planner, which is much quicker than counting them
+    for large results. Falls back to counting them on databases other than PostgreSQL.
+    :param queryset:
+    :return: the estimated number of results
+    """
+    if connection.vendor != 'postgresql':
+        return queryset.count()
+    sql, params = queryset.query.sql_with_params()
+    cursor = connection.cursor()
+    cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+    plan = cursor.fetchone()[0]
+    if isinstance(plan, basestring):
+        plan = json.loads(plan)
+    return int(plan[0]['Plan']['Plan Rows'])
 
 
 def add_instrument(request):
@@ -257,14 +333,20 @@ def add_wavelengths(request, instrument_name, wavelengths):
         form = AddWavelengthForm(request.POST, num_wav=wavelengths)
         # create instrument instance when it's valid
         if form.is_valid():
-            instrument = Instrument(name=instrument_name)
-            instrument.save()
-            # create instrumentwavelength instances linked to the instrument
-            for wave in range(wavelengths):
-                wavelength = form.cleaned_data.get('wavelength %d' % (wave + 1))
-                InstrumentWavelength(value=wavelength, instrument=instrument).save()
+            try:
+                with transaction.atomic():
+                    instrument = Instrument(name=instrument_name)
+                    instrument.save()
+                    # create instrumentwavelength instances linked to the instrument
+                    for wave in range(wavelengths):
+                        wavelength = form.cleaned_data.get('wavelength %d' % (wave + 1))
+                        InstrumentWavelength(value=wavelength, instrument=instrument).save()
+            except IntegrityError:
+                # the instrument was added since AddInstrumentForm checked its name, eg by a second submission
+                form._errors[NON_FIELD_ERRORS] = form.error_class(['This instrument already exists.'])
+            else:
                 # go home
-            return HttpResponseRedirect(reverse('toucan_db.views.home'))
+                return HttpResponseRedirect(reverse('toucan_db.views.home'))
     # when the user access the page, create an empty form
     else:
         form = AddWavelengthForm(num_wav=wavelengths)
@@ -276,32 +358,59 @@ def upload_data(request):
     """Upload data page\n
     Gets the data from a file posted by a user\n
     Uses the form UploadForm\n
+    The file is saved to the staging area and queued, to be ingested by the process_uploads
+    management command. The page returns straight away with the job id; the progress of the
+    job can be followed with :py:func:`upload_status`.
     :param request:
     """
 
-    save = False
     # when the user sends a completed form    
     if request.method == "POST":
         form = UploadForm(request.POST, request.FILES)
-        # read the file when the form is valid
+        # queue the file when the form is valid
         if form.is_valid():
-            try:
-                # get the name of the file
-                for filename, file in request.FILES.iteritems():
-                    name = request.FILES[filename].name
-                    # read the file using the ingestion script in the ingest_data directory
-                read_data_2(form.cleaned_data.get('data'), form.cleaned_data.get('name'), name)
-                # go back home
-                return HttpResponseRedirect(reverse('toucan_db.views.home'))
-            # if the file is incorrect, an IOError is raised 
-            except IOError:
-                print 'ERROR : bad file'
-            else:
-                print 'File OK'
-            save = True
+            job = queue_upload(form.cleaned_data.get('data'), form.cleaned_data.get('name'))
     # when the user access the page, create an empty form
     else:
         form = UploadForm()
 
     return render(request, 'toucan_db/upload_data.html', locals())
 
+
+def queue_upload(uploaded_file, instrument):
+    """
+    Save an uploaded file to the staging area, and create a job to ingest it
+    :param uploaded_file: The file posted by the user
+    :param instrument: id of the instrument used for the measurements
+    :return: the new UploadJob
+    """
+    staging_dir = settings.UPLOAD_STAGING_DIR
+    if not os.path.isdir(staging_dir):
+        os.makedirs(staging_dir)
+
+    # prefix the file name with a unique id, so that uploads with the same name don't overwrite each other
+    staging_path = os.path.join(staging_dir, uuid.uuid4().hex + '_' + os.path.basename(uploaded_file.name))
+    with open(staging_path, 'wb') as staged:
+        for chunk in uploaded_file.chunks():
+            staged.write(chunk)
+
+    return UploadJob.objects.create(file_name=uploaded_file.name, staging_path=staging_path,
+                                    instrument_id=int(instrument))
+
+
+def upload_status(request, job_id):
+    """Status of an upload job, as JSON: its status, the number of rows ingested so far, and any error
+    :param request:
+    :param job_id: id of the UploadJob
+    """
+    job = get_object_or_404(UploadJob, pk=job_id)
+    status = {'id': job.id,
+              'file_name': job.file_name,
+              'status': job.status,
+              'rows_ingested': job.rows_ingested,
+              'error': job.error,
+              'created': job.created.isoformat(),
+              'started': (job.started.isoformat() if job.started else None),
+              'finished': (job.finished.isoformat() if job.finished else None),
+              }
+    return HttpResponse(json.dumps(status), content_type='application/json')